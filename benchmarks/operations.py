@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Measure how long Konfsave's main operations take on a synthetic home directory.
+
+A temporary home directory (with $XDG_CONFIG_HOME pointing to its .config) is filled with
+generated configuration: a number of groups with text files, a deep directory tree
+like .oh-my-zsh, large binary files, and symlinks. Konfsave is configured to save only
+these files, and every operation is timed in-process, except for startup.
+The results are printed as JSON, and can be compared with the results of an earlier commit, e.g.:
+	python benchmarks/operations.py --output before.json
+	git checkout my-branch
+	python benchmarks/operations.py --baseline before.json --max-regression 20
+"""
+import argparse
+import configparser
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import startup
+
+REPOSITORY = Path(__file__).resolve().parent.parent
+PROFILE_NAME = 'bench'
+
+
+def build_home(home: Path, args) -> Tuple[dict, List[Path]]:
+	"""
+	Fill ``home`` with synthetic configuration and write a Konfsave config that saves all of it.
+	Return a summary of what was created, and the paths of the created text files.
+	"""
+	config_home = home / '.config'
+	text_files = []
+	parser = configparser.ConfigParser(allow_no_value=True, interpolation=None)
+	parser.optionxform = str
+	with open(REPOSITORY / 'konfsave' / 'default_config.ini') as f:
+		parser.read_file(f)
+	groups = []
+	line = 'key{}=value with some typical contents, e.g. a color 255,255,255 or a font Noto Sans,10\n'
+	for g in range(args.groups):
+		group = f'bench-{g}'
+		groups.append(group)
+		parser['XDG_CONFIG_HOME Path Definitions'][group] = group
+		for i in range(args.files_per_group):
+			path = config_home / group / f'section-{i % 4}' / f'file-{i}rc'
+			text_files.append(path)
+	parser['Home Directory Path Definitions']['.bench-deep'] = 'bench-deep'
+	groups.append('bench-deep')
+	for i in range(args.deep_files):
+		levels = (f'level-{(i >> k) % 3}' for k in range(args.depth))
+		text_files.append(home / '.bench-deep' / Path(*levels) / f'file-{i}.zsh')
+	for path in text_files:
+		path.parent.mkdir(parents=True, exist_ok=True)
+		path.write_text(''.join(line.format(k) for k in range(max(1, args.file_size // len(line)))))
+	parser['Home Directory Path Definitions']['.local/share/bench-binary'] = 'bench-binary'
+	groups.append('bench-binary')
+	(home / '.local/share/bench-binary').mkdir(parents=True)
+	for i in range(args.binary_files):
+		(home / '.local/share/bench-binary' / f'blob-{i}.bin').write_bytes(os.urandom(args.binary_size))
+	for i in range(min(args.symlinks, len(text_files))):
+		link = text_files[i].with_name(f'link-{i}')
+		link.symlink_to(text_files[i].name)
+	parser['Metagroup Definitions']['bench'] = ','.join(groups)
+	parser['Defaults']['save-list'] = 'bench'
+	for key, value in (v.split('=', 1) for v in args.set):
+		parser['Defaults'][key] = value
+	(config_home / 'konfsave').mkdir(parents=True, exist_ok=True)
+	with open(config_home / 'konfsave' / 'konfsave.ini', 'w') as f:
+		parser.write(f)
+	return {
+		'text_files': len(text_files),
+		'binary_files': args.binary_files,
+		'symlinks': min(args.symlinks, len(text_files)),
+		'bytes': sum(p.stat().st_size for p in text_files) + args.binary_files * args.binary_size
+	}, text_files
+
+
+def measure(fn, runs: int, setup=None) -> dict:
+	"""
+	Call ``fn`` ``runs`` times, calling ``setup`` (which isn't timed) before each call,
+	and return statistics of the timings in milliseconds. Output printed by ``fn`` is discarded.
+	"""
+	timings = []
+	for _ in range(runs):
+		if setup is not None:
+			setup()
+		with contextlib.redirect_stdout(io.StringIO()):
+			started = time.perf_counter()
+			fn()
+			timings.append((time.perf_counter() - started) * 1000)
+	return {
+		'median_ms': round(statistics.median(timings), 2),
+		'min_ms': round(min(timings), 2),
+		'max_ms': round(max(timings), 2),
+		'runs': runs
+	}
+
+
+def run_operations(home: Path, text_files: list, args) -> dict:
+	# Konfsave reads the home directory when it's imported, so it can only be imported now
+	sys.path.insert(0, str(REPOSITORY))
+	from konfsave import config, profiles
+	config.load_config()
+	modified = text_files[::max(1, round(1 / args.modify_fraction))] if args.modify_fraction else []
+
+	def modify():
+		for path in modified:
+			with open(path, 'a') as f:
+				f.write('modified=true\n')
+	archive_path = home / f'{PROFILE_NAME}.konfsave.zip'
+	results = {}
+	results['paths_to_save'] = measure(lambda: sum(1 for _ in profiles.paths_to_save()), args.runs)
+	results['save_new'] = measure(
+		lambda: profiles.save('bench-new'), args.runs,
+		setup=lambda: shutil.rmtree(config.profile_home / 'bench-new', ignore_errors=True)
+	)
+	profiles.save(PROFILE_NAME)
+	results['save_unchanged'] = measure(lambda: profiles.save(PROFILE_NAME), args.runs)
+	results['save_modified'] = measure(lambda: profiles.save(PROFILE_NAME), args.runs, setup=modify)
+	load = lambda: profiles.load(PROFILE_NAME, overwrite_unsaved_configuration=True, restart=False)
+	results['load_unchanged'] = measure(load, args.runs)
+	results['load_modified'] = measure(load, args.runs, setup=modify)
+	results['archive_profile'] = measure(
+		lambda: profiles.archive_profile(PROFILE_NAME, destination=archive_path, overwrite=True), args.runs
+	)
+	results['archive_profile_dictionary'] = measure(
+		lambda: profiles.archive_profile(PROFILE_NAME, destination=archive_path, overwrite=True, dictionary=True),
+		args.runs
+	)
+	results['unarchive_profile_dictionary'] = measure(
+		lambda: profiles.unarchive_profile(archive_path, new_name='bench-unarchived', confirm=False), args.runs,
+		setup=lambda: shutil.rmtree(config.profile_home / 'bench-unarchived', ignore_errors=True)
+	)
+	profiles.archive_profile(PROFILE_NAME, destination=archive_path, overwrite=True)
+	results['unarchive_profile'] = measure(
+		lambda: profiles.unarchive_profile(archive_path, new_name='bench-unarchived', confirm=False), args.runs,
+		setup=lambda: shutil.rmtree(config.profile_home / 'bench-unarchived', ignore_errors=True)
+	)
+	env = startup._environment(home)
+	for action in ('help', 'info'):
+		results[f'startup_{action}'] = {
+			'median_ms': round(startup.median_time([sys.executable, '-m', 'konfsave', action], env, args.runs), 2),
+			'runs': args.runs
+		}
+	return results
+
+
+def regressions(results: dict, baseline: dict, max_regression: float) -> list:
+	"""
+	Return descriptions of operations whose median time grew by more than ``max_regression`` percent.
+	"""
+	slower = []
+	for operation, timing in results.items():
+		if (previous := baseline.get(operation)) is None or not previous['median_ms']:
+			continue
+		change = (timing['median_ms'] / previous['median_ms'] - 1) * 100
+		if change > max_regression:
+			slower.append(
+				f'{operation}: {previous["median_ms"]} ms -> {timing["median_ms"]} ms ({change:+.0f}%)'
+			)
+	return slower
+
+
+def _commit() -> str:
+	result = subprocess.run(
+		['git', 'rev-parse', '--short', 'HEAD'], cwd=REPOSITORY, capture_output=True, text=True
+	)
+	return result.stdout.strip() or None
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument('--groups', type=int, default=20, help='Number of groups of text files.')
+	parser.add_argument('--files-per-group', type=int, default=25)
+	parser.add_argument('--file-size', type=int, default=2048, help='Approximate size of text files in bytes.')
+	parser.add_argument('--deep-files', type=int, default=1000, help='Number of files in the deep directory tree.')
+	parser.add_argument('--depth', type=int, default=6, help='Depth of the deep directory tree.')
+	parser.add_argument('--binary-files', type=int, default=4)
+	parser.add_argument('--binary-size', type=int, default=8 * 2**20, help='Size of binary files in bytes.')
+	parser.add_argument('--symlinks', type=int, default=50)
+	parser.add_argument(
+		'--modify-fraction', type=float, default=0.1,
+		help='Fraction of text files which are modified before "save_modified" and "load_modified".'
+	)
+	parser.add_argument(
+		'--set', action='append', default=[], metavar='KEY=VALUE',
+		help='Set a value in the [Defaults] section of the config, e.g. storage=objects.'
+	)
+	parser.add_argument('--runs', type=int, default=5)
+	parser.add_argument('--output', '-o', type=Path, help='Write the results to this file instead of stdout.')
+	parser.add_argument('--baseline', type=Path, help='Results of an earlier run to compare with.')
+	parser.add_argument(
+		'--max-regression', type=float, default=25, metavar='PERCENT',
+		help='Fail if an operation is this much slower than in the baseline.'
+	)
+	args = parser.parse_args()
+	with tempfile.TemporaryDirectory(prefix='konfsave-bench-') as home:
+		home = Path(home)
+		os.environ.update({'HOME': str(home), 'XDG_CONFIG_HOME': str(home / '.config')})
+		created, text_files = build_home(home, args)
+		output = {
+			'commit': _commit(),
+			'python': platform.python_version(),
+			'parameters': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline', 'max_regression')},
+			'home': created,
+			'results': run_operations(home, text_files, args)
+		}
+	data = json.dumps(output, indent='\t')
+	if args.output:
+		args.output.write_text(data + '\n')
+	else:
+		print(data)
+	if args.baseline:
+		baseline = json.loads(args.baseline.read_text())
+		if slower := regressions(output['results'], baseline['results'], args.max_regression):
+			print('Slower than the baseline:', *slower, sep='\n  ', file=sys.stderr)
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Measure how long it takes to start Konfsave, and fail if it gets slower than expected.
+
+Every action is run as a separate process in a temporary home directory, so the results
+include the interpreter's startup time, but not the user's real configuration.
+The median of all runs is printed as JSON, e.g.:
+	python benchmarks/startup.py --runs 20 --max-ms help=80 --max-ms info=100
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPOSITORY = Path(__file__).resolve().parent.parent
+# Modules which are slow to import and aren't needed by these actions. Cheap standard library modules
+# (e.g. hashlib and configparser) are imported at module level, so they aren't listed.
+_SLOW_MODULES = (
+	'zipfile', 'tarfile', 'subprocess', 'concurrent.futures', 'multiprocessing', 'ctypes', 'pygit2'
+)
+# konfsave.profiles imports its submodules when their names are first used
+_ACTION_MODULES = tuple(f'konfsave.profiles.{m}' for m in (
+	'history', 'load', 'save', 'batch', 'deploy', 'restart', 'watch', 'git', 'archive'
+))
+UNEXPECTED_MODULES = {
+	'help': (*_SLOW_MODULES, *_ACTION_MODULES, 'konfsave.profiles.utils', 'konfsave.profiles.storage'),
+	'info': (*_SLOW_MODULES, *_ACTION_MODULES),
+	'groups': (*_SLOW_MODULES, *_ACTION_MODULES, 'konfsave.profiles.storage'),
+}
+# Runs an action and prints which of the unexpected modules were imported
+_CHECK_IMPORTS = '''
+import sys
+from konfsave import actions
+actions.parse_arguments(['konfsave', *sys.argv[2:]])
+print(__import__('json').dumps([m for m in sys.argv[1].split(',') if m in sys.modules]), file=sys.stderr)
+'''
+
+
+def _environment(home: Path) -> dict:
+	env = dict(os.environ)
+	env.update({
+		'HOME': str(home),
+		'XDG_CONFIG_HOME': str(home / '.config'),
+		'PYTHONPATH': os.pathsep.join(filter(None, (str(REPOSITORY), env.get('PYTHONPATH'))))
+	})
+	return env
+
+
+def median_time(command: list, env: dict, runs: int) -> float:
+	"""
+	Return the median time in milliseconds that ``command`` takes to finish.
+	"""
+	timings = []
+	for _ in range(runs):
+		started = time.perf_counter()
+		subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+		timings.append((time.perf_counter() - started) * 1000)
+	return statistics.median(timings)
+
+
+def unexpected_imports(action: str, env: dict) -> list:
+	modules = UNEXPECTED_MODULES.get(action, ())
+	result = subprocess.run(
+		[sys.executable, '-c', _CHECK_IMPORTS, ','.join(modules), action],
+		env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, text=True
+	)
+	return json.loads(result.stderr.strip().splitlines()[-1])
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument('actions', nargs='*', default=['help', 'info', 'groups'])
+	parser.add_argument('--runs', type=int, default=15)
+	parser.add_argument(
+		'--max-ms', action='append', default=[], metavar='ACTION=MS',
+		help='Fail if the median time of ACTION is above MS milliseconds.'
+	)
+	args = parser.parse_args()
+	limits = {action: float(ms) for action, ms in (v.split('=', 1) for v in args.max_ms)}
+	failed = False
+	with tempfile.TemporaryDirectory(prefix='konfsave-startup-') as home:
+		env = _environment(Path(home))
+		# Create the config file and its cache, so that every measured run is a typical one
+		subprocess.run(
+			[sys.executable, '-m', 'konfsave', 'info'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+		)
+		# The interpreter's own startup time, for reference
+		results = {'python': median_time([sys.executable, '-c', 'pass'], env, args.runs)}
+		for action in args.actions:
+			results[action] = median_time([sys.executable, '-m', 'konfsave', action], env, args.runs)
+			if action in limits and results[action] > limits[action]:
+				print(f'{action} took {results[action]:.1f} ms (limit: {limits[action]} ms)', file=sys.stderr)
+				failed = True
+			if imported := unexpected_imports(action, env):
+				print(f'{action} imported {", ".join(imported)}', file=sys.stderr)
+				failed = True
+	print(json.dumps({k: round(v, 1) for k, v in results.items()}, indent='\t'))
+	sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+	main()
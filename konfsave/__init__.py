@@ -1,4 +1,13 @@
-from . import constants
-from . import config
-from . import profiles
-from . import actions
+import importlib
+
+# Submodules are imported on first access, so that e.g. ``konfsave help``
+# doesn't pay for importing modules that it doesn't use.
+_SUBMODULES = ('constants', 'config', 'groups', 'tracing', 'profiles', 'session', 'actions')
+
+
+def __getattr__(name):
+	if name in _SUBMODULES:
+		return importlib.import_module(f'.{name}', __name__)
+	if name == 'Konfsave':
+		return importlib.import_module('.session', __name__).Konfsave
+	raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -2,16 +2,12 @@
 import sys
 import logging
 
-from konfsave import constants
-from konfsave import config
 from konfsave import actions
+from konfsave import constants
 
 
 def main():
-	logging.basicConfig(format='[%(levelname)s] %(message)s')
-	config.load_config()
-	_constants = {k: str(v) for k, v in constants.__dict__.items() if k.isupper()}
-	logging.getLogger('konfsave').debug(f'Constants: {_constants}')
+	logging.basicConfig(format=constants.LOG_FORMAT)
 	actions.parse_arguments(sys.argv)
 	
 
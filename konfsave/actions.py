@@ -1,17 +1,18 @@
 import sys
 import argparse
+import functools
 import itertools
 import json
 import logging
-import subprocess
 import time
-import zipfile
 from pathlib import Path
-from typing import List
+from typing import Any, Callable, List
 
 from . import constants
 from . import config
 from . import profiles
+from . import tracing
+from .session import Konfsave
 
 _N_T = '\n  '  # Backslashes are not allowed in f-string expressions, so use a variable
 HELP_TEXT = '''Konfsave is a KDE config manager.
@@ -23,14 +24,23 @@ help, --help, -h    print this message and exit
 i, info, ls         get info about the current configuration, or a profile if specified
 s, save             save the current configuration
 l, load             load a saved profile
+history             list or compact saved snapshots of a profile
 c, change           modify a profile's attributes
-a, archive          export a profile as a ZIP file
-u, unarchive        import an archived profile
+a, archive          export a profile as a ZIP or tar file
+u, unarchive        import an archived profile, or list its contents
+deploy              load a profile into other users' home directories
+sync                push or pull profiles stored in Git
+watch               track changed files to make saving faster
 f, files            list files that save would copy
 g, groups           list default or available file groups
+w, which            show which groups contain a file
 
 To see detailed usage instructions, run `konfsave <action> --help`.
-All flags starting with '--' can be abbreviated.
+All flags starting with '--' can be abbreviated, except for the following,
+which can be given to any action:
+--timings           print how long each part of the action took
+--trace FILE        write a trace of the action to FILE, which can be opened in
+                    chrome://tracing or https://ui.perfetto.dev
 
 To learn more about how to configure Konfsave, visit the GitHub wiki at
   https://github.com/selplacei/konfsave/wiki
@@ -45,24 +55,127 @@ def parse_arguments(argv):
 	# argument format, so different ArgumentParser objects have to be used.
 	if argv[0] == 'python':
 		argv = argv[1:]
+	try:
+		argv, timings, trace = _global_flags(argv)
+	except ValueError as e:
+		logger.error(f'{e}\n')
+		return
+	if timings or trace:
+		tracing.enable()
 	action = argv[1] if len(argv) > 1 else 'help'
 	try:
-		next(v for k, v in {
-			('-h', '--help', 'help'): lambda *_: print(HELP_TEXT),
-			('i', 'info', 'ls'): action_info,
-			('f', 'files'): action_list_files,
-			('g', 'groups'): action_list_groups,
-			('s', 'save'): action_save,
-			('l', 'load'): action_load,
-			('c', 'change'): action_change,
-			('d', 'delete'): action_delete,
-			('a', 'archive'): action_archive,
-			('u', 'unarchive'): action_unarchive
-		}.items() if action in k)(argv[2:])
+		fn, needs_config = next(v for k, v in {
+			('-h', '--help', 'help'): (lambda *_: print(HELP_TEXT), False),
+			('i', 'info', 'ls'): (action_info, True),
+			('f', 'files'): (action_list_files, True),
+			('g', 'groups'): (action_list_groups, True),
+			('w', 'which'): (action_which, True),
+			('s', 'save'): (action_save, True),
+			('l', 'load'): (action_load, True),
+			('history',): (action_history, True),
+			('c', 'change'): (action_change, True),
+			('d', 'delete'): (action_delete, True),
+			('a', 'archive'): (action_archive, True),
+			('u', 'unarchive'): (action_unarchive, True),
+			('sync',): (action_sync, True),
+			('deploy',): (action_deploy, True),
+			('watch',): (action_watch, True)
+		}.items() if action in k)
 	except StopIteration:
 		logger.error(f'Unrecognized action: {action}\nTry \'konfsave help\' for more info.\n')
+		return
+	try:
+		# Only load the config when the action uses it, since it's the slowest part of starting up
+		if needs_config:
+			try:
+				fn = functools.partial(Konfsave().run, fn)
+			except config.ConfigError as e:
+				logger.critical(str(e))
+				sys.exit(1)
+			if logger.isEnabledFor(logging.DEBUG):
+				_constants = {k: str(v) for k, v in constants.__dict__.items() if k.isupper()}
+				logger.debug(f'Constants: {_constants}')
+		with tracing.span(f'action: {action}'):
+			fn(argv[2:])
 	except KeyboardInterrupt:
 		print('Action cancelled.')
+	finally:
+		if timings:
+			tracing.print_timings()
+		if trace:
+			tracing.write_trace(trace)
+
+
+def _global_flags(argv):
+	"""
+	Remove the flags which apply to every action from ``argv``, and return the remaining
+	arguments, whether --timings was given, and the file given to --trace (or None).
+	"""
+	remaining = []
+	timings = False
+	trace = None
+	arguments = iter(argv)
+	for argument in arguments:
+		if argument == '--timings':
+			timings = True
+		elif argument == '--trace':
+			if (trace := next(arguments, None)) is None:
+				raise ValueError('--trace requires a file name.')
+		elif argument.startswith('--trace='):
+			trace = argument[len('--trace='):]
+		else:
+			remaining.append(argument)
+	return remaining, timings, trace
+
+
+def _selection_arguments(values: List[str], undefined_groups=False) -> set:
+	"""
+	Convert --include or --exclude arguments to the format of ``profiles.paths_to_save()``:
+	group names are kept as they are, and paths are made absolute relative to the home directory.
+	Unless ``undefined_groups`` is True, the program exits if a group isn't defined in the config.
+	"""
+	selection = set()
+	for value in values:
+		if value.startswith(':'):
+			if not undefined_groups and value not in config.paths:
+				logger.critical(f'The group "{value}" is not defined. Available groups can be checked using `konfsave groups`.')
+				sys.exit(1)
+			selection.add(value)
+		elif (path := Path(value)).is_absolute():
+			selection.add(path)
+		else:
+			selection.add(Path.home() / path)
+	return selection
+
+
+def _report_batch(names: List[str], results: list, describe: Callable[[Any], str] = None):
+	"""
+	Print the result of every job of a batch operation (see ``profiles.run_batch()``),
+	and exit with status 1 if any of them failed.
+	"""
+	width = max(len(str(name)) for name in names)
+	failed = 0
+	for name, (ok, result) in zip(names, results):
+		if ok:
+			print(f'{str(name):<{width}}  {describe(result) if describe else "Success"}')
+		else:
+			failed += 1
+			logger.error(f'{name}: {result}')
+	if failed:
+		logger.critical(f'{failed} of {len(names)} failed.')
+		sys.exit(1)
+
+
+def _format_size(size: int) -> str:
+	for unit in ('B', 'KiB', 'MiB', 'GiB'):
+		if size < 1024 or unit == 'GiB':
+			break
+		size /= 1024
+	return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+
+
+def _format_time(ns: int) -> str:
+	return time.strftime('%Y-%m-%d %H:%M', time.localtime(ns // 10**9))
 
 
 def action_info(argv):
@@ -71,10 +184,31 @@ def action_info(argv):
 		'profile', nargs='?', metavar='profile_name',
 		help='If provided, prints detailed information about the profile.'
 	)
+	parser.add_argument(
+		'--sort', '-s', choices=['name', 'size', 'date'], default='name',
+		help='How to sort the list of saved profiles (by name by default). When sorting by size or date, '
+		'the largest or most recently saved profiles are listed first.'
+	)
+	parser.add_argument(
+		'--reverse', '-r', action='store_true',
+		help='Reverse the order of saved profiles.'
+	)
+	parser.add_argument(
+		'--long', '-l', action='store_true',
+		help='Also print the size, number of files, and the time of the last save of every profile.'
+	)
+	parser.add_argument(
+		'--rebuild-index', action='store_true', dest='rebuild_index',
+		help='Read every saved profile to rebuild the index that this command uses. '
+		'This is only needed if profiles were modified without using Konfsave.'
+	)
 	args = parser.parse_args(argv)
+	index = profiles.rebuild_index() if args.rebuild_index else profiles.load_index()
 	if profile := args.profile:
 		profiles.validate_profile_name(profile)
-		info = profiles.profile_info(profile)
+		info = index.get(profile)
+		if info is None and (info := profiles.index_entry(profile)) is not None:
+			profiles.update_index(profile, info)  # The profile was added without using Konfsave
 		if info is None:
 			print(f'The profile {profile} doesn\'t exist.')
 		else:
@@ -82,6 +216,8 @@ def action_info(argv):
 			print(f'Stored at: {config.profile_home / profile}')
 			print(f'Author: {info["author"] or "Unknown"}')
 			print(f'Supported groups: {info["groups"] or "(unspecified)"}')
+			print(f'Files: {info["files"]} ({_format_size(info["bytes"])})')
+			print(f'Last saved: {_format_time(info["saved_ns"])}')
 			if description := info['description']:
 				print(description)
 			else:
@@ -91,21 +227,26 @@ def action_info(argv):
 			print(f'Current profile: {current_profile}')
 		else:
 			print(f'No profile is currently active.')
-		# Choose directories which are valid profile names and contain an info file;
-		# then, convert paths to names, and sort the final list of profiles.
-		if saved_profiles := sorted(filter(
-			lambda n: profiles.validate_profile_name(n, False),
-			map(
-				lambda q: q.name,
-				filter(
-					lambda p: (p / config.profile_info_filename).exists(),
-					config.profile_home.glob('*')
-				)
-			)
-		), key=str.lower):
-			print(f'Saved profiles:\n  {_N_T.join(saved_profiles)}')
+		if args.sort == 'size':
+			entries = sorted(index.values(), key=lambda e: (-e['bytes'], e['name'].lower()))
+		elif args.sort == 'date':
+			entries = sorted(index.values(), key=lambda e: (-e['saved_ns'], e['name'].lower()))
 		else:
+			entries = sorted(index.values(), key=lambda e: e['name'].lower())
+		if args.reverse:
+			entries.reverse()
+		if not entries:
 			print('No profiles are saved.')
+		elif args.long:
+			width = max(len(e['name']) for e in entries)
+			print('Saved profiles:')
+			for e in entries:
+				print(
+					f'  {e["name"]:<{width}}  {_format_size(e["bytes"]):>10}  {e["files"]:>6} files  '
+					f'{_format_time(e["saved_ns"])}'
+				)
+		else:
+			print(f'Saved profiles:\n  {_N_T.join(e["name"] for e in entries)}')
 
 
 def action_list_files(argv):
@@ -186,18 +327,64 @@ def action_list_groups(argv):
 			print(', '.join(groups))
 
 
+def action_which(argv):
+	parser = argparse.ArgumentParser(
+		prog='konfsave which',
+		description='Print the groups which contain a file, either directly or by containing '
+		'one of its parent directories, and whether the file is saved by default.'
+	)
+	parser.add_argument(
+		'path', nargs='+', type=Path,
+		help='Paths must be either absolute or relative to the home directory.'
+	)
+	parser.add_argument(
+		'--json', '-j', action='store_true',
+		help='Print the output as a JSON string.'
+	)
+	args = parser.parse_args(argv)
+	selected = profiles.path_selector()
+	exceptions = set(config.exceptions)
+	results = {}
+	for path in args.path:
+		path = (Path.home() / path).resolve()  # Absolute paths are kept as they are
+		results[str(path)] = {
+			'groups': {
+				str(k): sorted(v, key=str.lower) for k, v in config.groups.groups_containing(path).items()
+			},
+			'default': selected(path),
+			'exception': any(p in exceptions for p in (path, *path.parents))
+		}
+	if args.json:
+		print(json.dumps(results))
+		return
+	for path, result in results.items():
+		print(path)
+		if result['groups']:
+			for via, groups in result['groups'].items():
+				print(f'  {", ".join(groups)}' + ('' if via == path else f' (via {via})'))
+		else:
+			print('  Not in any group')
+		if result['exception']:
+			print('  Listed in exceptions, so it\'s only saved or loaded if --included')
+		print(f'  Saved by default: {"yes" if result["default"] else "no"}')
+
+
 def action_save(argv):
 	parser = argparse.ArgumentParser(
 		prog='konfsave save',
 		# The default usage string puts "[name]" at the end, for some reason.
-		usage='konfsave save [-h] [name] [--destination DEST] [--follow-symlinks] '
+		usage='konfsave save [-h] [name | --as NAME [NAME ...]] [--destination DEST] [--follow-symlinks] '
 		'[--include [FILE ...]] [--exclude [FILE ...]]'
 	)
 	parser.add_argument(
-		'profile', metavar='name', nargs='?', default=profiles.current_profile(),
+		'profile', metavar='name', nargs='?',
 		help='Save as the specified profile instead of using the currently loaded name. '
 		'This is required if no profile is active.'
 	)
+	parser.add_argument(
+		'--as', '-a', metavar='NAME', nargs='+', dest='names',
+		help='Save as each of these profiles, in parallel. The last one becomes the current profile.'
+	)
 	parser.add_argument(
 		'--destination', '-d', metavar='DEST', type=Path,
 		help='Instead of saving to Konfsave\'s profile storage, save to a specified destination. '
@@ -220,6 +407,10 @@ def action_save(argv):
 		'The format is the same as for --include. '
 	)
 	args = parser.parse_args(argv)
+	if args.names:
+		_save_batch(args)
+		return
+	args.profile = args.profile or profiles.current_profile()
 	if args.profile:
 		profiles.validate_profile_name(args.profile)
 	if args.profile \
@@ -231,41 +422,73 @@ def action_save(argv):
 			'Are you sure you want to overwrite it? [y/N]: '
 		) != 'y':
 			return
-	include = set()
-	exclude = set()
-	for path in map(Path, args.exclude):
-		if not path.is_absolute():
-			path = Path.home() / path
-		exclude.add(path)
-	for path in map(Path, args.include):
-		if not path.is_absolute():
-			path = Path.home() / path
-		include.add(path)
-	profiles.save(
-		name=args.profile,
-		destination=args.destination,
+	include = _selection_arguments(args.include)
+	exclude = _selection_arguments(args.exclude)
+	try:
+		result = profiles.save(
+			name=args.profile,
+			destination=args.destination,
+			follow_symlinks=args.follow_symlinks,
+			include=include,
+			exclude=exclude
+		)
+	except profiles.CopyError:
+		logger.critical(f'Saving "{args.profile}" failed; the profile was not updated.')
+		return
+	print(f'Success ({result["added"]} added, {result["changed"]} changed, {result["unchanged"]} unchanged)')
+
+
+def _save_batch(args):
+	if args.profile or args.destination:
+		logger.critical('--as can\'t be used together with a profile name or --destination.')
+		sys.exit(1)
+	names = list(dict.fromkeys(args.names))
+	for name in names:
+		profiles.validate_profile_name(name)
+	current = profiles.current_profile()
+	if (existing := [n for n in names if n != current and (config.profile_home / n).exists()]) and input(
+		f'Warning: the profiles {", ".join(existing)} already exist.\n'
+		'Are you sure you want to overwrite them? [y/N]: '
+	) != 'y':
+		return
+	results = profiles.save_profiles(
+		names,
 		follow_symlinks=args.follow_symlinks,
-		include=include,
-		exclude=exclude
+		include=_selection_arguments(args.include),
+		exclude=_selection_arguments(args.exclude)
+	)
+	_report_batch(
+		names, results,
+		lambda r: f'Success ({r["added"]} added, {r["changed"]} changed, {r["unchanged"]} unchanged)'
 	)
-	print('Success')
 
 
 def action_load(argv):
 	parser = argparse.ArgumentParser(prog='konfsave load')
 	parser.add_argument(
 		'profile',
-		help='The name of the profile to load.'
+		help='The name of the profile to load. To load an earlier snapshot of the profile, '
+		'use "name@snapshot", where snapshot is the ID of a snapshot, "latest", or a date '
+		'(YYYY-MM-DD or YYYY-MM-DDTHH:MM) to load the last snapshot saved by then. '
+		'Available snapshots can be checked using `konfsave history`. '
+		'This can also be the path to an archive (ending with .zip), which is loaded '
+		'without being unarchived.'
 	)
 	parser.add_argument(
-		'--overwrite',
+		'--overwrite', action='store_true',
 		help='By default, loading will fail if no profile is active (i.e. the current configuration '
 		'is not saved). Otherwise, the user will be asked for confirmation. '
 		'Using --overwrite will bypass both of these checks.'
 	)
 	parser.add_argument(
 		'--no-restart', '-n', action='store_false', dest='restart',
-		help='After loading a profile, the Plasma shell is restarted unless this flag is specified.'
+		help='After loading a profile, running KDE components whose files have changed (e.g. the Plasma shell) '
+		'are restarted unless this flag is specified.'
+	)
+	parser.add_argument(
+		'--dry-run', action='store_true', dest='dry_run',
+		help='Print the files that would be written, without changing anything. Files that are '
+		'already identical to the ones in the profile are never written.'
 	)
 	parser.add_argument(
 		'--include', '-i', action='extend', nargs='*', metavar='FILE', default=[],
@@ -282,28 +505,115 @@ def action_load(argv):
 		'The format is the same as for --include.'
 	)
 	args = parser.parse_args(argv)
-	profiles.validate_profile_name(args.profile)
-	include = set()
-	exclude = set()
-	for path in map(Path, args.exclude):
-		if not path.is_absolute():
-			path = Path.home() / path
-		exclude.add(path)
-	for path in map(Path, args.include):
-		if not path.is_absolute():
-			path = Path.home() / path
-		include.add(path)
-	success = not profiles.load(
-		args.profile,
-		include,
-		exclude,
-		overwrite_unsaved_configuration=args.overwrite,
-		restart=args.restart
-	)
+	include = _selection_arguments(args.include)
+	exclude = _selection_arguments(args.exclude)
+	if args.profile.endswith('.zip'):
+		_load_archive(Path(args.profile), include, exclude, args)
+		return
+	name, _, snapshot = args.profile.partition('@')
+	snapshot = snapshot or None
+	profiles.validate_profile_name(name)
+	try:
+		if args.dry_run:
+			if not (config.profile_home / name / config.profile_info_filename).is_file():
+				print(f'The profile {name} doesn\'t exist.')
+			elif plan := profiles.load_plan(name, include, exclude, snapshot=snapshot):
+				print('\n'.join(str(Path.home() / relpath) for relpath, _ in plan))
+			else:
+				print('All files are already up-to-date.')
+			return
+		success = not profiles.load(
+			name,
+			include,
+			exclude,
+			overwrite_unsaved_configuration=args.overwrite,
+			restart=args.restart,
+			snapshot=snapshot
+		)
+	except profiles.SnapshotNotFoundError as e:
+		logger.error(f'{str(e)}\nTry \'konfsave history {name}\' to see the available snapshots.\n')
+		return
+	except profiles.CopyError:
+		logger.critical(f'Some files from "{args.profile}" could not be loaded.')
+		return
+	if success:
+		print('Success')
+
+
+def _load_archive(source: Path, include: set, exclude: set, args):
+	import zipfile
+	try:
+		if args.dry_run:
+			with zipfile.ZipFile(source) as zipf:
+				if plan := profiles.archive_load_plan(zipf, include, exclude):
+					print('\n'.join(str(Path.home() / member.filename) for member in plan))
+				else:
+					print('All files are already up-to-date.')
+			return
+		success = not profiles.load_archive(
+			source,
+			include,
+			exclude,
+			overwrite_unsaved_configuration=args.overwrite,
+			restart=args.restart
+		)
+	except (OSError, zipfile.BadZipFile, ValueError) as e:
+		logger.error(f'Couldn\'t load {source}: {e}\n')
+		return
+	except profiles.CopyError:
+		logger.critical(f'Some files from {source} could not be loaded.')
+		return
 	if success:
 		print('Success')
 
 
+def action_history(argv):
+	parser = argparse.ArgumentParser(
+		prog='konfsave history',
+		description='List the snapshots of a profile, which are created whenever it\'s saved. '
+		'Any of them can be loaded using `konfsave load profile@snapshot`.'
+	)
+	parser.add_argument(
+		'profile', nargs='?', default=profiles.current_profile(),
+		help='The profile whose snapshots to list. If not specified, the current profile will be used.'
+	)
+	parser.add_argument(
+		'--compact', action='store_true',
+		help='Delete snapshots which aren\'t kept by the retention policy in the config, '
+		'and free the space used by files which are no longer referenced by any profile or snapshot.'
+	)
+	parser.add_argument(
+		'--json', '-j', action='store_true',
+		help='Print the list of snapshots as a JSON string.'
+	)
+	args = parser.parse_args(argv)
+	if not args.profile:
+		logger.error('No profile is active, so a profile has to be specified.\n')
+		return
+	profiles.validate_profile_name(args.profile)
+	profile_dir = config.profile_home / args.profile
+	if not (profile_dir / config.profile_info_filename).is_file():
+		print(f'The profile {args.profile} doesn\'t exist.')
+		return
+	if args.compact:
+		pruned = profiles.prune_history(profile_dir)
+		removed = profiles.collect_garbage()
+		print(f'Deleted {pruned} snapshots and {removed} unreferenced files')
+	snapshots = profiles.list_snapshots(profile_dir)
+	if args.json:
+		print(json.dumps(snapshots))
+	elif snapshots:
+		print(f'Snapshots of {args.profile}:')
+		width = len(str(snapshots[-1]['id']))
+		for record in reversed(snapshots):
+			print(
+				f'  {record["id"]:>{width}}  {_format_time(record["saved_ns"])}  '
+				f'{record["files"]:>6} files  {_format_size(record["bytes"]):>10}'
+			)
+	else:
+		print(f'The profile {args.profile} has no snapshots.')
+
+
 def action_change(argv):
 	parser = argparse.ArgumentParser(
 		prog='konfsave change'
@@ -360,68 +670,127 @@ def action_delete(argv):
 
 
 def action_archive(argv):
+	import zipfile
 	parser = argparse.ArgumentParser(
 		prog='konfsave archive', description='Export/archive a profile to share or import later.',
 		# The default usage puts "profile" at the end
-		usage='konfsave archive [-h] [profile] [--destination PATH] [--overwrite] '
-		'[--compresslevel LEVEL] [--compression {store,lzma,deflate,bzip2}]'
+		usage='konfsave archive [-h] [profile ...] [--all] [--destination PATH] [--overwrite] '
+		'[--format {zip,tar,tar.gz,tar.xz}] [--compresslevel LEVEL] [--compression {auto,store,lzma,deflate,bzip2}] '
+		'[--dictionary]'
+	)
+	parser.add_argument(
+		'profile', nargs='*',
+		help='The profiles to archive (the current profile by default). Several profiles are archived in parallel.'
 	)
 	parser.add_argument(
-		'profile', nargs='?', help='The profile to archive.', default=profiles.current_profile()
+		'--all', action='store_true',
+		help='Archive every saved profile.'
 	)
 	parser.add_argument(
 		'--destination', '-d', metavar='PATH', type=Path,
 		help='The full path (including the filename) of the resulting archive. '
-		f'By default, archives are saved as "[profile name].konfsave.zip" under the home directory.'
+		f'By default, archives are saved as "[profile name].konfsave.zip" under the home directory. '
+		'If this is "-" and --format is a tar format, the archive is written to stdout, '
+		'e.g. to pipe it to `konfsave unarchive -` on another machine. '
+		'When archiving several profiles, this is the directory to save the archives in.'
 	)
 	parser.add_argument(
 		'--overwrite', '-o', action='store_true',
 		help='Unless this option is specified, if the resulting file '
 		'already exists, archiving will fail.'
 	)
+	parser.add_argument(
+		'--format', '-f', choices=['zip', 'tar', 'tar.gz', 'tar.xz'], default='zip',
+		help='The archive format. Tar archives are written as a stream, so they can be written to stdout. '
+		'--compression and --compresslevel only apply to zip archives.'
+	)
 	parser.add_argument(
 		'--compresslevel', type=int, default='9', metavar='LEVEL',
 		help='How much to compress the archive, from 1 to 9 (9 by default).'
 		'This has no effect if --compression is "store" or "lzma".'
 	)
 	parser.add_argument(
-		'--compression', choices=['store', 'lzma', 'deflate', 'bzip2'], default='bzip2',
-		help='Compression method (bzip2 by default). "store" means no compression.'
+		'--compression', choices=['auto', 'store', 'lzma', 'deflate', 'bzip2'], default='auto',
+		help='Compression method. "auto" (the default) uses Deflate for small files and LZMA for large ones. '
+		'"store" means no compression. Files which are already compressed (e.g. images) are always stored.'
+	)
+	parser.add_argument(
+		'--dictionary', action='store_true',
+		help='Compress small files using a dictionary built from the profile\'s own files, '
+		'which makes archives of many small configs much smaller. '
+		'Such archives can only be extracted by Konfsave, not by other zip programs.'
 	)
 	args = parser.parse_args(argv)
 	compression = {
+		'auto': None,
 		'store': zipfile.ZIP_STORED,
 		'lzma': zipfile.ZIP_LZMA,
 		'deflate': zipfile.ZIP_DEFLATED,
 		'bzip2': zipfile.ZIP_BZIP2
 	}[args.compression]
+	names = sorted(profiles.load_index()) if args.all else args.profile or [profiles.current_profile()]
+	if not names:
+		print('No profiles are saved.')
+		return
+	if len(names) > 1:
+		if args.destination and not args.destination.is_dir():
+			logger.critical('When archiving several profiles, --destination must be an existing directory.')
+			sys.exit(1)
+		options = {'overwrite': args.overwrite}
+		if args.format == 'zip':
+			options.update(compression=compression, compresslevel=args.compresslevel, dictionary=args.dictionary)
+		_report_batch(names, profiles.archive_profiles(names, args.destination, args.format, **options))
+		return
+	args.profile = names[0]
 	try:
+		if args.format != 'zip':
+			stdout = str(args.destination) == '-'
+			profiles.archive_profile_tar(
+				profile=args.profile,
+				overwrite=args.overwrite,
+				destination=sys.stdout.buffer if stdout else args.destination,
+				compression=args.format.partition('.')[2]
+			)
+			if stdout:
+				sys.stdout.flush()
+			return
+		if str(args.destination) == '-':
+			logger.critical('Only tar archives can be written to stdout; use e.g. --format tar.gz.')
+			sys.exit(1)
 		profiles.archive_profile(
 			profile=args.profile,
 			overwrite=args.overwrite,
 			destination=args.destination,
 			compresslevel=args.compresslevel,
-			compression=compression
+			compression=compression,
+			dictionary=args.dictionary
 		)
 	except FileExistsError as e:
 		logger.error(f'The file {e.filename} already exists.\n')
 	except RuntimeError as e:
 		logger.error(f'Error: {str(e)}\n')
+	except BrokenPipeError:
+		logger.error('The archive couldn\'t be written, since the output was closed.\n')
 	else:
 		return
 	logger.critical(f'Archiving "{args.profile}" failed.')
 
 
 def action_unarchive(argv):
+	import tarfile
+	import zipfile
 	parser = argparse.ArgumentParser(
 		prog='konfsave unarchive',
 		description='Unpack and save a profile that was previously archived.',
 		# The default usage puts "file" at the end
-		usage='konfsave unarchive [-h] file [--name NAME] [--overwrite]'
+		usage='konfsave unarchive [-h] file [file ...] [--name NAME] [--overwrite] [--list [--json]] '
+		'[--include [FILE ...]] [--exclude [FILE ...]]'
 	)
 	parser.add_argument(
-		'file', type=Path,
-		help='Path to the archive to extract from.'
+		'file', type=Path, nargs='+',
+		help='Path to the archive to extract from (a zip or tar archive). If this is "-", a tar archive '
+		'is read from stdin; since stdin can\'t be used for confirmation, an existing profile '
+		'is then only replaced if --overwrite is specified. Several archives are extracted in parallel.'
 	)
 	parser.add_argument(
 		'--name', '-n', help='Extract to a specified profile name '
@@ -433,12 +802,221 @@ def action_unarchive(argv):
 		'the user will be asked for confirmation. '
 		'Using this option will silently overwrite such profiles instead.'
 	)
+	parser.add_argument(
+		'--list', '-l', action='store_true',
+		help='List the files in the archive and the groups they belong to, without extracting anything.'
+	)
+	parser.add_argument(
+		'--json', '-j', action='store_true',
+		help='With --list, print the archive\'s manifest as a JSON string.'
+	)
+	parser.add_argument(
+		'--include', '-i', action='extend', nargs='*', metavar='FILE', default=[],
+		help='Only extract these files or groups. Paths must point to where the files would be loaded, '
+		'and be either absolute or relative to the home directory. Group names must start with a colon (:); '
+		'groups which aren\'t defined in your config can be used if they were defined when the archive was created. '
+		'If this isn\'t specified, all files are extracted.'
+	)
+	parser.add_argument(
+		'--exclude', '-e', action='extend', nargs='*', metavar='FILE', default=[],
+		help='Files or groups to not extract. The format is the same as for --include.'
+	)
 	args = parser.parse_args(argv)
+	if len(args.file) > 1:
+		_unarchive_batch(args)
+		return
+	args.file = args.file[0]
+	stdin = str(args.file) == '-'
+	source = sys.stdin.buffer if stdin else args.file
+	if args.list:
+		manifest = profiles.read_archive_manifest(source)
+		selected = profiles.archive_selector(
+			_selection_arguments(args.include, undefined_groups=True),
+			_selection_arguments(args.exclude, undefined_groups=True)
+		)
+		manifest['files'] = {k: v for k, v in manifest['files'].items() if selected(k, v)}
+		if args.json:
+			print(json.dumps(manifest))
+			return
+		if manifest['name']:
+			print(f'Profile: {manifest["name"]}')
+		for relpath, entry in sorted(manifest['files'].items()):
+			target = f' -> {entry["link"]}' if 'link' in entry else ''
+			groups = f'  ({", ".join(entry["groups"])})' if entry['groups'] else ''
+			print(f'{_format_size(entry["size"]):>10}  {relpath}{target}{groups}')
+		return
 	if args.name:
 		profiles.validate_profile_name(args.name)
-	if not profiles.unarchive_profile(
-		source=args.file,
-		new_name=args.name,
-		overwrite=args.overwrite
-	):
+	try:
+		if profiles.unarchive_profile(
+			source=source,
+			new_name=args.name,
+			overwrite=args.overwrite,
+			confirm=not stdin,
+			include=_selection_arguments(args.include, undefined_groups=True),
+			exclude=_selection_arguments(args.exclude, undefined_groups=True)
+		):
+			return
+	except FileExistsError as e:
+		logger.critical(f'The profile at {e.filename} already exists. Use --overwrite to replace it.')
+	except (OSError, zipfile.BadZipFile, tarfile.TarError, ValueError) as e:
+		logger.critical(f'Couldn\'t unarchive {args.file}: {e}')
+	else:
 		print('Success')
+		return
+	sys.exit(1)
+
+
+def _unarchive_batch(args):
+	import tarfile
+	import zipfile
+	if args.list or args.name or any(str(f) == '-' for f in args.file):
+		logger.critical('--list, --name, and reading from stdin can only be used with a single archive.')
+		sys.exit(1)
+	names = {}
+	for source in args.file:
+		try:
+			info = profiles.read_archive_info(source)
+		except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+			logger.critical(f'Couldn\'t read {source}: {e}')
+			sys.exit(1)
+		if info is None or not profiles.validate_profile_name(info['name'], exit_if_invalid=False):
+			logger.critical(f'{source} doesn\'t contain a valid profile; use --name to unarchive it separately.')
+			sys.exit(1)
+		if info['name'] in names.values():
+			logger.critical(f'Several archives contain the profile "{info["name"]}".')
+			sys.exit(1)
+		names[source] = info['name']
+	if not profiles.confirm_unarchive(len(names)):
+		print('Unarchiving aborted.')
+		return
+	existing = [n for n in names.values() if (config.profile_home / n).exists()]
+	if existing and not args.overwrite and input(
+		f'Warning: the profiles {", ".join(existing)} are already saved.\n'
+		'Are you sure you want to overwrite them? [y/N]: '
+	) != 'y':
+		print('Unarchiving aborted.')
+		return
+	results = profiles.unarchive_profiles(
+		args.file,
+		overwrite=True,
+		include=_selection_arguments(args.include, undefined_groups=True),
+		exclude=_selection_arguments(args.exclude, undefined_groups=True)
+	)
+	_report_batch([f'{source} ({name})' for source, name in names.items()], results)
+
+
+def action_deploy(argv):
+	parser = argparse.ArgumentParser(
+		prog='konfsave deploy',
+		description='Load a profile into other users\' home directories, e.g. to provision several accounts. '
+		'Nothing is restarted, and your own configuration isn\'t changed. If Konfsave runs as root, '
+		'the written files are given to the owner of each home directory.',
+		usage='konfsave deploy [-h] profile --homes DIR [DIR ...] [--overwrite] '
+		'[--include [FILE ...]] [--exclude [FILE ...]]'
+	)
+	parser.add_argument(
+		'profile',
+		help='The name of the profile to deploy. Snapshots can be specified the same way as for `konfsave load`.'
+	)
+	parser.add_argument(
+		'--homes', metavar='DIR', nargs='+', type=Path, required=True,
+		help='The home directories to load the profile into. They are written in parallel.'
+	)
+	parser.add_argument(
+		'--overwrite', action='store_true',
+		help='Don\'t ask for confirmation before overwriting the configuration in the home directories.'
+	)
+	parser.add_argument(
+		'--include', '-i', action='extend', nargs='*', metavar='FILE', default=[],
+		help='Same as in `load`. Paths are relative to your home directory, and are written to the same '
+		'location within every home directory.'
+	)
+	parser.add_argument(
+		'--exclude', '-e', action='extend', nargs='*', metavar='FILE', default=[],
+		help='Same as in `load`.'
+	)
+	args = parser.parse_args(argv)
+	name, _, snapshot = args.profile.partition('@')
+	profiles.validate_profile_name(name)
+	homes = list(dict.fromkeys(home.resolve() for home in args.homes))
+	if missing := [str(home) for home in homes if not home.is_dir()]:
+		logger.critical(f'These home directories don\'t exist: {", ".join(missing)}')
+		sys.exit(1)
+	if not args.overwrite and input(
+		f'Warning: the configuration in {len(homes)} home directories will be overwritten with "{args.profile}".\n'
+		'Are you sure you want to continue? [y/N]: '
+	).lower() != 'y':
+		print('Deploying aborted.')
+		return
+	try:
+		results = profiles.deploy(
+			name,
+			homes,
+			include=_selection_arguments(args.include),
+			exclude=_selection_arguments(args.exclude),
+			snapshot=snapshot or None
+		)
+	except profiles.SnapshotNotFoundError as e:
+		logger.critical(f'{str(e)}\nTry \'konfsave history {name}\' to see the available snapshots.')
+		sys.exit(1)
+	except RuntimeError as e:
+		logger.critical(str(e))
+		sys.exit(1)
+	_report_batch(homes, results, lambda r: f'Success ({r["written"]} written, {r["unchanged"]} unchanged)')
+
+
+def action_sync(argv):
+	parser = argparse.ArgumentParser(
+		prog='konfsave sync',
+		description='Push profiles which are stored in Git (see "storage" in the config) '
+		'to another Git repository, or pull them from it.'
+	)
+	parser.add_argument('direction', choices=['push', 'pull'])
+	parser.add_argument(
+		'profile', nargs='*',
+		help='The profiles to synchronize. By default, all profiles stored in Git are synchronized.'
+	)
+	parser.add_argument(
+		'--remote', '-r', metavar='URL',
+		help='Path or URL of the other repository (git-remote in the config by default). '
+		'If it\'s a path that doesn\'t exist, a bare repository is created there.'
+	)
+	args = parser.parse_args(argv)
+	sync = profiles.push_profiles if args.direction == 'push' else profiles.pull_profiles
+	try:
+		results = sync(args.profile, args.remote)
+	except RuntimeError as e:
+		logger.error(f'Error: {str(e)}\n')
+		return
+	if results is None:
+		return  # The GIT feature is missing, which has already been reported
+	if results:
+		for name, status in sorted(results.items(), key=lambda item: item[0].lower()):
+			print(f'{name}: {status}')
+	else:
+		print('No profiles to synchronize.')
+
+
+def action_watch(argv):
+	parser = argparse.ArgumentParser(
+		prog='konfsave watch',
+		description='Watch the files that `konfsave save` copies by default, and record which of them change, '
+		'so that saving only has to check those files. Runs in the foreground until interrupted. '
+		'If the watcher isn\'t running or misses some changes, saving checks every file as usual.'
+	)
+	parser.add_argument(
+		'--autosave', type=float, metavar='SECONDS',
+		help='Save the current profile when no files have changed for this many seconds.'
+	)
+	args = parser.parse_args(argv)
+	if args.autosave is not None and args.autosave <= 0:
+		logger.error('The autosave delay must be positive.\n')
+		return
+	try:
+		profiles.watch(autosave=args.autosave)
+	except KeyboardInterrupt:
+		pass
+	except (RuntimeError, OSError) as e:
+		logger.critical(f'Couldn\'t watch files: {e}')
+		sys.exit(1)
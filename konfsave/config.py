@@ -1,67 +1,231 @@
-import sys
 import configparser
+import contextvars
 import itertools
+import json
 import logging
-import sys
+import os
+import threading
 from pathlib import Path
-from typing import Set, Dict, List, Tuple
+from typing import Callable, Set, Dict, List, Optional, Tuple, Union
 
 from . import constants
+from . import tracing
+from .groups import GroupCycleError, GroupGraph
 
 # The values referred to as "group names" include the preceding colon.
 
-# Mapping of group names to what they contain, exactly as specified in the config
-definitions: Dict[str, Set[str]] = {}
-# Same as ``definitions``, but only contains metagroups (including redefined groups)
-metagroups: Dict[str, Set[str]] = {}
-# Mapping of group names to the paths they contain, with sub-groups recursively broken down
-# Paths are absolute and resolved
-paths: Dict[str, Set[Path]] = {}
-# Set of files that should never be copied unless --included in the command line
-exceptions = set()
-# Default list of group names to save, as stored in [Defaults] -> save-list
-save_list = []
-profile_home: Path = None
-profile_info_filename: str = None
-current_profile_path: Path = None
-archive_directory: Path = None
+
+class ConfigError(ValueError):
+	"""
+	Raised by ``load_config()`` if the config file is invalid. The message explains how to fix it.
+	"""
+
+
+class Config:
+	"""
+	The values of one parsed config file, and the caches which depend on them.
+
+	The variables of this module (e.g. ``config.profile_home``) are those of the active ``Config``,
+	which is the same for the whole process unless a ``konfsave.Konfsave`` session is used.
+	Sessions have their own ``Config``, so several configurations can be used at the same time.
+	"""
+	def __init__(self):
+		# Mapping of group names to what they contain, exactly as specified in the config
+		self.definitions: Dict[str, Set[str]] = {}
+		# Same as ``definitions``, but only contains metagroups (including redefined groups)
+		self.metagroups: Dict[str, Set[str]] = {}
+		# Mapping of group names to the paths they contain, with sub-groups recursively broken down
+		# Paths are absolute and resolved
+		self.paths: Dict[str, Set[Path]] = {}
+		# Graph of ``definitions``, which can also tell which groups contain a path
+		self.groups: GroupGraph = None
+		# Set of files that should never be copied unless --included in the command line
+		self.exceptions = set()
+		# Default list of group names to save, as stored in [Defaults] -> save-list
+		self.save_list = []
+		self.profile_home: Path = None
+		self.profile_info_filename: str = None
+		self.current_profile_path: Path = None
+		self.archive_directory: Path = None
+		# Storage backend used for newly saved profiles, as stored in [Defaults] -> storage
+		self.storage: str = None
+		# Directory that holds file contents of profiles saved with the "objects" storage backend
+		self.object_store: Path = None
+		# Whether to record a digest of every saved file even when the storage backend doesn't need it
+		self.hash_files = False
+		# Number of threads used to copy files; 0 means that it's chosen automatically
+		self.copy_workers = 0
+		# How file contents are copied; see ``profiles.copy_file()``
+		self.copy_strategy: str = None
+		# Bare Git repository which holds the contents of profiles saved with the "git" storage backend
+		self.git_repository: Path = None
+		# URL or path of the repository that ``konfsave sync`` pushes to and pulls from, if any
+		self.git_remote: Optional[str] = None
+		# Whether every save creates a snapshot of the profile
+		self.history = False
+		# How many snapshots are kept: the newest ones, and the newest one of each of the last days and weeks
+		self.history_keep_recent = 10
+		self.history_keep_daily = 7
+		self.history_keep_weekly = 4
+		# Parsed profile info files, see ``profiles.profile_info()``
+		self.profile_info_cache: Dict[Optional[str], dict] = {}
+
+
+_active: contextvars.ContextVar = contextvars.ContextVar('konfsave_config', default=Config())
+
+
+def __getattr__(name):
+	try:
+		return getattr(_active.get(), name)
+	except AttributeError:
+		raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
+
+
+def active() -> Config:
+	"""
+	Return the ``Config`` which this module's variables currently refer to.
+	"""
+	return _active.get()
+
+
+def activate(state: Config) -> contextvars.Token:
+	"""
+	Make ``state`` the active config in the current thread (or ``contextvars`` context)
+	and return a token which can be passed to ``deactivate()`` to restore the previous one.
+	"""
+	return _active.set(state)
+
+
+def deactivate(token: contextvars.Token):
+	_active.reset(token)
+
+
+def bind(fn: Callable) -> Callable:
+	"""
+	Return a function which calls ``fn`` with the config that is active now.
+	New threads always start with the process-wide config, so functions which are
+	run by thread pools must be bound in the thread that submits them.
+	"""
+	state = _active.get()
+
+	def bound(*args, **kwargs):
+		token = _active.set(state)
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			_active.reset(token)
+	return bound
+
+
+# Increase this whenever the format of the config cache changes
+_CACHE_FORMAT = 1
 
 
 def default_paths() -> Tuple[Path]:
 	"""
 	Convert and return ``defaults['save-list']`` as a tuple of absolute and resolved ``Path``s.
 	"""
-	return tuple(itertools.chain.from_iterable(map(lambda g: paths[g], save_list)))
+	state = _active.get()
+	return tuple(itertools.chain.from_iterable(map(lambda g: state.paths[g], state.save_list)))
+
+
+def load_config(config_path: Path = None):
+	"""
+	Load a config file (the user's one by default) into the active ``Config``,
+	i.e. into this module's variables. ``ConfigError`` is raised if the config file is invalid,
+	in which case the active ``Config`` is left unchanged.
+	
+	Parsing the config resolves every path in it, so the result is cached next to the
+	config file (as e.g. "konfsave.ini.cache") and reused until the config file (its modification time or size),
+	the home directory, ``$XDG_CONFIG_HOME``, or Konfsave itself changes.
+	"""
+	with tracing.span('load_config'):
+		config_path = config_path or constants.DATA_PATH / constants.CONFIG_FILENAME
+		cache_path = config_path.with_name(f'{config_path.name}.cache')
+		# Create the config file if missing
+		if not config_path.exists():
+			logging.getLogger('konfsave').warning('Config file missing, copying from default')
+			config_path.parent.mkdir(parents=True, exist_ok=True)
+			with open(config_path, 'w') as f, open(constants.DEFAULT_CONFIG_PATH) as d:
+				f.write(d.read())
+		key = _cache_key(config_path)
+		if (state := _read_cache(cache_path, key)) is None:
+			try:
+				with tracing.span('parse_config'):
+					state = _parse_config(config_path)
+			except GroupCycleError as e:
+				raise ConfigError(f'{e}\nPlease fix the metagroup definitions in {config_path}.') from e
+			except configparser.Error as e:
+				raise ConfigError(f'The config file {config_path} is malformed.\n{e}') from e
+			except KeyError as e:
+				raise ConfigError(
+					f'The section {e} is missing from the config file {config_path}.\n'
+					f'See {constants.DEFAULT_CONFIG_PATH} for example configuration.'
+				) from e
+			_write_cache(cache_path, key, state)
+		_apply(state, config_path)
+
+
+def _cache_key(config_path: Path) -> dict:
+	st = config_path.stat()
+	return {
+		'format': _CACHE_FORMAT,
+		'config': [st.st_mtime_ns, st.st_size],
+		# Changes whenever Konfsave is updated or reinstalled
+		'konfsave': Path(__file__).stat().st_mtime_ns,
+		'home': str(Path.home()),
+		'config_home': str(constants.CONFIG_HOME)
+	}
+
 
+def _read_cache(cache_path: Path, key: dict) -> Optional[dict]:
+	try:
+		with open(cache_path) as f:
+			cache = json.load(f)
+		if cache['key'] == key:
+			return cache['state']
+		logging.getLogger('konfsave').debug('The config cache is outdated')
+	except FileNotFoundError:
+		pass
+	except (OSError, ValueError, KeyError, TypeError) as e:
+		logging.getLogger('konfsave').debug(f'Ignoring malformed config cache: {e}')
+	return None
+
+
+def _write_cache(cache_path: Path, key: dict, state: dict):
+	# Sessions in several threads may load the same config at the same time
+	tmp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+	try:
+		data = json.dumps({'key': key, 'state': state})
+		with open(tmp_path, 'w') as f:
+			f.write(data)
+		os.replace(tmp_path, cache_path)  # Other processes may be reading the cache at the same time
+	except OSError as e:
+		logging.getLogger('konfsave').debug(f'Couldn\'t write the config cache: {e}')
+
+
+def _encode_group(definition) -> List[str]:
+	# Paths are absolute, so they can't be confused with group names, which start with a colon
+	return sorted(map(str, definition))
 
-def load_config():
-	global definitions, metagroups, paths, exceptions, save_list, profile_home
-	global profile_info_filename, current_profile_path, archive_directory
-	# Create the config file if missing
-	if not (constants.DATA_PATH / 'konfsave.ini').exists():
-		logging.getLogger('konfsave').warning('Config file missing, copying from default')
-		constants.DATA_PATH.mkdir(parents=True, exist_ok=True)
-		with open(constants.DATA_PATH / 'konfsave.ini', 'w') as f, open(constants.DEFAULT_CONFIG_PATH) as d:
-			f.write(d.read())
 
-	# Load the config file
+def _decode_group(definition: List[str]) -> Set[Union[str, Path]]:
+	return {v if v.startswith(':') else Path(v) for v in definition}
+
+
+def _parse_config(config_path: Path) -> dict:
+	"""
+	Parse the config file and return its contents in a form that can be stored as JSON.
+	"""
 	config = configparser.ConfigParser(allow_no_value=True, interpolation=_SpecialExtendedInterpolation())
 	config.optionxform = str
-	with open(constants.DATA_PATH / 'konfsave.ini') as f:
+	with open(config_path) as f:
 		config.read_file(f)
-	
-	# Set the logging level
-	loglevel = {
-		'DEBUG': logging.DEBUG,
-		'INFO': logging.INFO,
-		'WARNING': logging.WARNING,
-		'ERROR': logging.ERROR,
-		'CRITICAL': logging.CRITICAL
-	}[config['Defaults']['log-level'].upper()]
-	logging.basicConfig(level=loglevel)
+	definitions = {}
+	metagroups = {}
 	
 	# Load exceptions
-	for path in itertools.chain(
+	exceptions = set(itertools.chain(
 		map(
 			lambda v: (Path.home() / Path(v)).resolve(),
 			config['Home Directory Exceptions'].keys()
@@ -70,8 +234,7 @@ def load_config():
 			lambda v: (constants.CONFIG_HOME / Path(v)).resolve(),
 			config['XDG_CONFIG_HOME Exceptions'].keys()
 		)
-	):
-		exceptions.add(path)
+	))
 
 	# Load path definitions
 	for path, groups in itertools.chain(
@@ -94,7 +257,7 @@ def load_config():
 			try:
 				metagroups[f':{metagroup}'] = definitions[f':{metagroup}']
 			except KeyError as e:
-				raise ValueError(
+				raise ConfigError(
 					f'Attempted to redefine "{metagroup}" as a metagroup, but that group doesn\'t exist. '
 					'Perhaps you forgot to include some files into it?'
 				) from e
@@ -104,46 +267,122 @@ def load_config():
 			definitions[f':{metagroup}'] = subgroups
 			metagroups[f':{metagroup}'] = subgroups
 	
-	# Recursively convert groups into paths
-	undefined_groups = set()
-	for group, definition in definitions.items():
-		paths[group] = set()
-		if isinstance(definition, Path):
-			paths[group].add(definition)
-			continue
-		subvalues = list(definitions[group])
-		while subvalues:
-			subvalue = subvalues.pop()
-			if isinstance(subvalue, Path):
-				paths[group].add(subvalue)
-			else:
-				try:
-					subvalues += list(definitions[subvalue])
-				except KeyError:
-					undefined_groups.add(subvalue)
+	# Recursively convert groups into paths; raises GroupCycleError if metagroups contain each other
+	graph = GroupGraph(definitions)
+	paths = graph.closure()
 	
-	if undefined_groups:
+	return {
+		'definitions': {k: _encode_group(v) for k, v in definitions.items()},
+		'metagroups': {k: _encode_group(v) for k, v in metagroups.items()},
+		'paths': {k: _encode_group(v) for k, v in paths.items()},
+		'exceptions': _encode_group(exceptions),
+		'undefined_groups': sorted(graph.undefined),
+		'defaults': dict(config['Defaults'].items())
+	}
+
+
+def _apply(state: dict, config_path: Path):
+	"""
+	Set the variables of the active ``Config`` from the result of ``_parse_config()``.
+	The logging level is shared by the whole process, so the last loaded config sets it.
+	"""
+	target = _active.get()
+	defaults = state['defaults']
+	
+	# Set the logging level
+	loglevels = {
+		'DEBUG': logging.DEBUG,
+		'INFO': logging.INFO,
+		'WARNING': logging.WARNING,
+		'ERROR': logging.ERROR,
+		'CRITICAL': logging.CRITICAL
+	}
+	if (loglevel := loglevels.get(defaults.get('log-level', 'INFO').upper())) is None:
+		raise ConfigError(
+			f'Unsupported value of log-level: "{defaults["log-level"]}". Supported values are: {", ".join(loglevels)}'
+		)
+	
+	definitions = {k: _decode_group(v) for k, v in state['definitions'].items()}
+	metagroups = {k: definitions.get(k, _decode_group(v)) for k, v in state['metagroups'].items()}
+	paths = {k: _decode_group(v) for k, v in state['paths'].items()}
+	groups = GroupGraph(definitions, paths)
+	exceptions = _decode_group(state['exceptions'])
+	
+	if state['undefined_groups']:
 		logging.getLogger('konfsave').info(
 			f'The following groups are referenced in metagroup definitions, but are not defined: '
-			+ ', '.join(sorted(undefined_groups))
+			+ ', '.join(state['undefined_groups'])
 		)
 	
 	# Load defaults
-	save_list = list(map(lambda s: f':{s}', config['Defaults']['save-list'].split(',')))
+	save_list = list(map(lambda s: f':{s}', defaults['save-list'].split(',')))
 	try:
-		profile_home = Path(config['Defaults']['profile-home'])
-		profile_info_filename = config['Defaults']['profile-info-filename']
-		current_profile_path = Path(config['Defaults']['current-profile-path'])
-		archive_directory = Path(config['Defaults']['archive-directory'])
+		profile_home = Path(defaults['profile-home'])
+		profile_info_filename = defaults['profile-info-filename']
+		current_profile_path = Path(defaults['current-profile-path'])
+		archive_directory = Path(defaults['archive-directory'])
 	except KeyError:
-		logging.getLogger('konfsave').critical(
+		raise ConfigError(
 			'Important values are missing from the config file. Did you recently update Konfsave?\n'
 			'The following keys are expected in the Defaults section:\n'
 			'profile-home, profile-info-filename, current-profile-path, archive-directory\n'
 			f'See {str(constants.DEFAULT_CONFIG_PATH)} for example configuration,\nor simply delete '
-			f'{str(constants.DATA_PATH / constants.CONFIG_FILENAME)} to reset the configuration completely.'
+			f'{str(config_path)} to reset the configuration completely.'
+		)
+	# These keys were added later, so older config files may not have them
+	storage = defaults.get('storage', 'directory')
+	object_store = Path(defaults.get('object-store', str(constants.DATA_PATH / 'objects')))
+	hash_files = _getboolean(defaults, 'hash-files', 'no')
+	copy_workers = _getint(defaults, 'copy-workers', 0)
+	copy_strategy = defaults.get('copy-strategy', 'auto')
+	git_repository = Path(defaults.get('git-repository', str(constants.DATA_PATH / 'profiles.git')))
+	git_remote = defaults.get('git-remote') or None
+	history = _getboolean(defaults, 'history', 'no')
+	history_keep_recent = _getint(defaults, 'history-keep-recent', 10)
+	history_keep_daily = _getint(defaults, 'history-keep-daily', 7)
+	history_keep_weekly = _getint(defaults, 'history-keep-weekly', 4)
+	for key, value, supported in (
+		('storage', storage, constants.STORAGE_BACKENDS),
+		('copy-strategy', copy_strategy, constants.COPY_STRATEGIES)
+	):
+		if value not in supported:
+			raise ConfigError(
+				f'Unsupported value of {key}: "{value}". Supported values are: {", ".join(supported)}'
+			)
+	if storage == 'git' and not constants.has_feature('GIT'):
+		raise ConfigError(
+			'The feature "GIT" is required to use Git storage. '
+			'Try installing it with pip: "pip install konfsave[GIT]"'
 		)
-		sys.exit(1)
+	# Set the variables only once the whole config is valid; the caches depend on the old values
+	logging.getLogger('konfsave').setLevel(loglevel)
+	vars(target).update(
+		definitions=definitions, metagroups=metagroups, paths=paths, groups=groups, exceptions=exceptions,
+		save_list=save_list, profile_home=profile_home, profile_info_filename=profile_info_filename,
+		current_profile_path=current_profile_path, archive_directory=archive_directory,
+		storage=storage, object_store=object_store, hash_files=hash_files, copy_workers=copy_workers,
+		copy_strategy=copy_strategy, git_repository=git_repository, git_remote=git_remote, history=history,
+		history_keep_recent=history_keep_recent, history_keep_daily=history_keep_daily,
+		history_keep_weekly=history_keep_weekly, profile_info_cache={}
+	)
+
+
+def _getboolean(defaults: dict, key: str, default: str) -> bool:
+	value = defaults.get(key, default)
+	try:
+		return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+	except KeyError:
+		raise ConfigError(f'The value of {key} must be "yes" or "no", not "{value}".') from None
+
+
+def _getint(defaults: dict, key: str, default: int) -> int:
+	value = defaults.get(key, default)
+	try:
+		if (number := int(value)) >= 0:
+			return number
+	except ValueError:
+		pass
+	raise ConfigError(f'The value of {key} must be a number which is at least 0, not "{value}".')
 
 
 class _SpecialExtendedInterpolation(configparser.ExtendedInterpolation):
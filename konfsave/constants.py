@@ -1,5 +1,6 @@
-import os
+import functools
 import importlib.util
+import os
 import logging
 from pathlib import Path
 
@@ -9,30 +10,52 @@ else:
 	CONFIG_HOME = Path.home() / '.config'
 
 DATA_PATH = CONFIG_HOME / 'konfsave'
+LOG_FORMAT = '[%(levelname)s] %(message)s'
 CONFIG_FILENAME = 'konfsave.ini'
 DEFAULT_CONFIG_PATH = Path(__file__).parent / 'default_config.ini'
+MANIFEST_FILENAME = '.konfsave_manifest'
+ARCHIVE_MANIFEST_FILENAME = '.konfsave_archive_manifest'
+ARCHIVE_DICTIONARY_FILENAME = '.konfsave_archive_dictionary'
+INDEX_FILENAME = '.konfsave_index'
+# Maps the files of a Git commit to their permissions, which Git doesn't keep
+GIT_MODES_FILENAME = '.konfsave_modes'
+HISTORY_DIRNAME = '.konfsave_history'
+JOURNAL_FILENAME = 'konfsave.journal'
+STORAGE_BACKENDS = ('directory', 'objects', 'git')
+COPY_STRATEGIES = ('auto', 'reflink', 'copy_file_range', 'hardlink', 'copy')
+# Optional features, mapped to whether they're available. None means that it hasn't been checked yet;
+# use ``has_feature()`` instead of reading the values directly.
 FEATURES = {
-	'GIT': True
+	'GIT': None
 }
 FEATURE_REQUIREMENTS = {
 	'GIT': ('pygit2',)
 }
 
 
+def has_feature(feature) -> bool:
+	"""
+	Check whether the packages required by ``feature`` are installed.
+	This is only done when a feature is first needed, since it's relatively slow.
+	"""
+	if FEATURES.get(feature, False) is None:
+		FEATURES[feature] = all(
+			importlib.util.find_spec(package) is not None for package in FEATURE_REQUIREMENTS[feature]
+		)
+	return bool(FEATURES.get(feature, False))
+
+
 def feature_required(feature):
 	def decorator(fn):
-		if FEATURES.get(feature, None):
-			return fn
 		description = getattr(fn, '__name__', str(fn))
-		return lambda *_, **__: logging.getLogger('konfsave').error(
-			f'The feature "{feature}" is required to use this functionality ({description}). '
-			f'Try installing it with pip: "pip install konfsave[{feature}]"'
-		)
-	return decorator
 
-
-for k, v in FEATURE_REQUIREMENTS.items():
-	for package in v:
-		if importlib.util.find_spec(package) is None:
-			FEATURES[k] = False
-			break
+		@functools.wraps(fn)
+		def wrapper(*args, **kwargs):
+			if has_feature(feature):
+				return fn(*args, **kwargs)
+			logging.getLogger('konfsave').error(
+				f'The feature "{feature}" is required to use this functionality ({description}). '
+				f'Try installing it with pip: "pip install konfsave[{feature}]"'
+			)
+		return wrapper
+	return decorator
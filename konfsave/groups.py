@@ -0,0 +1,107 @@
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterable, List, Mapping, Optional, Set, Union
+
+# The values referred to as "group names" include the preceding colon.
+
+
+class GroupCycleError(ValueError):
+	"""
+	Raised when metagroups contain each other. ``cycle`` is the list of group names
+	that form the cycle, starting and ending with the same group.
+	"""
+	def __init__(self, cycle: List[str]):
+		self.cycle = cycle
+		super().__init__(
+			'Metagroup definitions can\'t contain each other, but the following groups form a cycle: '
+			+ ' -> '.join(cycle)
+		)
+
+
+class GroupGraph:
+	"""
+	The graph of groups, as defined in the config. Every group is a node whose edges lead
+	to the sub-groups and paths listed in its definition.
+
+	The paths of each group (with sub-groups recursively broken down) are calculated once
+	and shared between all groups that contain it. Groups which are referenced,
+	but not defined, are treated as empty and collected in ``undefined``.
+	"""
+	def __init__(
+		self,
+		definitions: Mapping[str, Iterable[Union[str, Path]]],
+		paths: Optional[Mapping[str, Iterable[Path]]] = None
+	):
+		"""
+		``paths`` may contain the result of a previous ``closure()`` of the same definitions,
+		in which case it's used instead of resolving the groups again.
+		"""
+		self.definitions = definitions
+		self.undefined: Set[str] = set()
+		self._paths: Dict[str, FrozenSet[Path]] = {k: frozenset(v) for k, v in (paths or {}).items()}
+		# Mapping of paths to the groups that contain them; see ``groups_containing()``
+		self._index: Optional[Dict[Path, Set[str]]] = None
+
+	def paths(self, group: str) -> FrozenSet[Path]:
+		"""
+		Return the paths which ``group`` contains, directly or through its sub-groups.
+		If the group isn't defined, KeyError is raised.
+		If the group contains itself, GroupCycleError is raised.
+		"""
+		if group in self._paths:
+			return self._paths[group]
+		if group not in self.definitions:
+			raise KeyError(group)
+		# Depth-first traversal; ``stack`` holds the groups which are currently being resolved
+		# along with the sub-groups that are left to visit, so its keys are the current chain of groups.
+		stack = {group: self._split(group)}
+		while stack:
+			current, (paths, subgroups) = next(reversed(stack.items()))
+			while subgroups:
+				subgroup = subgroups.pop()
+				if subgroup in self._paths:
+					paths.update(self._paths[subgroup])
+				elif subgroup in stack:
+					chain = list(stack)
+					raise GroupCycleError(chain[chain.index(subgroup):] + [subgroup])
+				elif subgroup not in self.definitions:
+					self.undefined.add(subgroup)
+				else:
+					stack[subgroup] = self._split(subgroup)
+					break
+			else:
+				del stack[current]
+				self._paths[current] = frozenset(paths)
+				if stack:
+					next(reversed(stack.values()))[0].update(paths)
+		return self._paths[group]
+
+	def _split(self, group: str):
+		paths = set()
+		subgroups = []
+		for value in self.definitions[group]:
+			if isinstance(value, Path):
+				paths.add(value)
+			else:
+				subgroups.append(value)
+		# Sub-groups are popped from the end; sort them so that errors are reproducible
+		subgroups.sort(reverse=True)
+		return paths, subgroups
+
+	def closure(self) -> Dict[str, Set[Path]]:
+		"""
+		Return a mapping of every defined group to its paths, as returned by ``paths()``.
+		"""
+		return {group: set(self.paths(group)) for group in self.definitions}
+
+	def groups_containing(self, path: Path) -> Dict[Path, Set[str]]:
+		"""
+		Return the groups which contain ``path``, either directly or by containing one of its parents.
+		The result maps each of these paths (``path`` itself or its parent) to the groups containing it.
+		``path`` must be absolute and resolved.
+		"""
+		if self._index is None:
+			self._index = {}
+			for group in self.definitions:
+				for group_path in self.paths(group):
+					self._index.setdefault(group_path, set()).add(group)
+		return {p: self._index[p] for p in (path, *path.parents) if p in self._index}
@@ -1,8 +1,34 @@
+import importlib
 import logging
-from .utils import *
-from .archive import *
-from .load import *
-from .save import *
-from .manage import *
 
 logger = logging.getLogger('konfsave')
+
+# The public names of every submodule are available from this package, as if they were star-imported,
+# but each submodule is only imported the first time a name is looked up in it, so that e.g.
+# ``konfsave info`` doesn't import the archive, Git, restart and watch code.
+# Names are looked up in this order, so the modules which most actions need come first.
+_SUBMODULES = (
+	'utils', 'engine', 'storage', 'index', 'history', 'manage', 'load', 'save',
+	'batch', 'deploy', 'restart', 'watch', 'git', 'archive'
+)
+_exported = set()
+
+
+def _import(submodule: str):
+	module = importlib.import_module(f'.{submodule}', __name__)
+	if submodule not in _exported:
+		# Importing the module set its name here, but a function with the same name (e.g. save()) takes precedence
+		globals().update((k, v) for k, v in vars(module).items() if not k.startswith('_'))
+		_exported.add(submodule)
+	return module
+
+
+def __getattr__(name):
+	if name in _SUBMODULES:
+		_import(name)
+		return globals()[name]
+	if not name.startswith('_'):
+		for submodule in _SUBMODULES:
+			if name in vars(module := _import(submodule)):
+				return vars(module)[name]
+	raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,15 +1,317 @@
-import sys
+import bz2
+import collections
+import copy
+import errno
+import hashlib
+import io
+import itertools
+import json
 import logging
-import zipfile
+import lzma
+import os
 import shutil
-import json
+import stat
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
 from pathlib import Path
+from typing import BinaryIO, Callable, Iterable, List, Optional
 
 from konfsave import config
+from konfsave import constants
 from konfsave import profiles
+from konfsave import tracing
+
+
+# Archives contain a manifest which describes the archived files, so that they can be listed and selected
+# without extracting them. It contains the profile's "name" and "files", which maps the paths of files
+# (relative to the home directory, in POSIX format) to their "mode", "size", "mtime_ns", "groups"
+# (the groups which contained the file when it was archived), and either "digest" (the SHA-256 hex digest
+# of their contents) or "link" (the target of a symlink).
+# Archives created by older versions don't have a manifest; see ``read_archive_manifest()``.
+ARCHIVE_MANIFEST_VERSION = 1
+
+# Files with these suffixes are already compressed, so they're stored in archives as they are
+INCOMPRESSIBLE_SUFFIXES = frozenset((
+	'.png', '.jpg', '.jpeg', '.gif', '.webp', '.avif', '.jxl', '.svgz', '.woff', '.woff2',
+	'.gz', '.tgz', '.bz2', '.xz', '.txz', '.lz', '.lzma', '.zst', '.zip', '.7z', '.rar', '.jar', '.kwinscript',
+	'.mp3', '.ogg', '.oga', '.opus', '.flac', '.m4a', '.mp4', '.mkv', '.webm'
+))
+# How much of a file is compressed to tell whether compressing all of it is worth it
+_SAMPLE_SIZE = 1 << 16
+# Compressible files at least this large are compressed with LZMA instead of Deflate by default.
+# They're also compressed while they're written into the archive rather than in memory, so that
+# the memory used doesn't depend on the size of the files.
+_LZMA_THRESHOLD = 1 << 20
+# LZMA members are compressed the same way as zipfile does it: raw LZMA1 with the default properties
+# (lc=3, lp=0, pb=2, 8 MiB dictionary), preceded by the LZMA SDK version and the encoded properties.
+# The data ends with an end-of-stream marker, which is declared by bit 1 of the member's flags.
+_LZMA_FILTER = {'id': lzma.FILTER_LZMA1, 'preset': 6, 'dict_size': 1 << 23, 'lc': 3, 'lp': 0, 'pb': 2}
+_LZMA_HEADER = bytes((9, 4, 5, 0, 3 + 0 * 9 + 2 * 45)) + (1 << 23).to_bytes(4, 'little')
+_LZMA_EOS_FLAG = 0x2
+
+# Small text files are similar to each other (e.g. KDE's INI files), but compressing each of them separately
+# can't take advantage of that. Archives created with ``dictionary=True`` contain a preset dictionary
+# (see ``build_dictionary()``), and compressible files up to ``_DICTIONARY_MAX_SIZE`` bytes are compressed
+# with raw Deflate using that dictionary. The zip format has no way to declare a preset dictionary,
+# so these members use the private method number below; other programs can't extract them.
+ZIP_DEFLATED_DICTIONARY = 0x4B53
+_DICTIONARY_MAX_SIZE = 1 << 14
+# Deflate can only refer to the last 32 KiB, so a larger dictionary wouldn't be used
+_DICTIONARY_SIZE = 1 << 15
+
+# Tar archives can be compressed with these methods ('' means no compression), which are the ones that
+# tarfile supports without additional dependencies
+TAR_COMPRESSIONS = ('', 'gz', 'xz')
+# How much of a tar archive is buffered at once while it's written or read
+_TAR_BUFSIZE = 1 << 16
+
+
+def _mtime_ns(member: 'zipfile.ZipInfo') -> int:
+	return int(time.mktime(member.date_time + (0, 0, -1))) * 10**9
+
+
+def _metadata_members():
+	return (
+		config.profile_info_filename, constants.MANIFEST_FILENAME,
+		constants.ARCHIVE_MANIFEST_FILENAME, constants.ARCHIVE_DICTIONARY_FILENAME
+	)
+
+
+def _archive_entry(relpath: str, entry: dict) -> dict:
+	groups = config.groups.groups_containing(Path.home() / relpath).values()
+	return {
+		'mode': entry['mode'],
+		'size': entry['size'],
+		'mtime_ns': entry['mtime_ns'],
+		'groups': sorted(set().union(*groups)),
+		**({'link': entry['link']} if 'link' in entry else {})
+	}
+
+
+def read_archive_manifest(source: Path, zipf: 'zipfile.ZipFile' = None) -> dict:
+	"""
+	Return the manifest of the archive at ``source`` (see ``ARCHIVE_MANIFEST_VERSION``),
+	reading only the archive's central directory and the manifest itself.
+	For archives without a manifest, one is made from the central directory;
+	it has no digests, and the groups are those which contain each file according to the current config.
+	``zipf`` may be the already opened archive. ``source`` may also be a tar archive; see ``_read_tar_manifest()``.
+	"""
+	if zipf is None:
+		if hasattr(source, 'read') or not zipfile.is_zipfile(source):
+			return _read_tar_manifest(source)
+		with zipfile.ZipFile(source) as zipf:
+			return read_archive_manifest(source, zipf)
+	try:
+		manifest = json.loads(zipf.read(constants.ARCHIVE_MANIFEST_FILENAME))
+		assert manifest['version'] == ARCHIVE_MANIFEST_VERSION
+		assert isinstance(manifest['files'], dict)
+		return manifest
+	except KeyError as e:
+		if constants.ARCHIVE_MANIFEST_FILENAME in zipf.NameToInfo:
+			profiles.logger.warning(f'Malformed manifest in {source}\n{str(e)}\n')
+	except (json.JSONDecodeError, AssertionError) as e:
+		profiles.logger.warning(f'Malformed manifest in {source}\n{str(e)}\n')
+	files = {}
+	for member in zipf.infolist():
+		if member.is_dir() or member.filename in _metadata_members():
+			continue
+		entry = {
+			'mode': member.external_attr >> 16,
+			'size': member.file_size,
+			'mtime_ns': _mtime_ns(member)
+		}
+		if _is_symlink(member):
+			entry['link'] = zipf.read(member).decode()
+		files[member.filename] = _archive_entry(member.filename, entry)
+	return {'version': ARCHIVE_MANIFEST_VERSION, 'name': None, 'files': files}
+
+
+def archive_selector(include=None, exclude=None) -> Callable[[str, dict], bool]:
+	"""
+	Return a function which checks whether a file in an archive is selected by ``include``
+	and ``exclude``, given its path and its entry in the archive's manifest.
+	``include`` and ``exclude`` have the same format as for ``paths_to_save()``, but
+	if ``include`` is empty, every file is included. A group selects the files which
+	are in it according to either the current config or the archive's manifest,
+	so groups which aren't defined locally can be used as well.
+	"""
+	def resolve(values):
+		groups = set()
+		paths = set()
+		for value in values or ():
+			if isinstance(value, str) and value.startswith(':'):
+				groups.add(value)
+				paths.update(config.paths.get(value, ()))
+			else:
+				paths.update(profiles.resolve_group(value))
+		return groups, paths
+	include_groups, include_paths = resolve(include)
+	exclude_groups, exclude_paths = resolve(exclude)
+
+	def selector(relpath: str, entry: dict) -> bool:
+		path = Path.home() / relpath
+		groups = entry.get('groups', ())
+		if include and not (include_groups.intersection(groups) or profiles.is_within(path, include_paths)):
+			return False
+		return not (exclude_groups.intersection(groups) or profiles.is_within(path, exclude_paths))
+	return selector
+
+
+def compression_method(path: Path, size: int, compression: int = None) -> int:
+	"""
+	Choose how to compress the file at ``path`` in an archive. Files with one of
+	``INCOMPRESSIBLE_SUFFIXES`` and files whose first 64 KiB can't be compressed by at least 10%
+	(i.e. that are already compressed or random) are stored. Other files are compressed
+	with ``compression`` if it's specified, or otherwise with Deflate, or LZMA if they're large.
+	"""
+	if not size or path.suffix.lower() in INCOMPRESSIBLE_SUFFIXES:
+		return zipfile.ZIP_STORED
+	with open(path, 'rb') as f:
+		sample = f.read(_SAMPLE_SIZE)
+	if len(zlib.compress(sample, 1)) > len(sample) * 0.9:
+		return zipfile.ZIP_STORED
+	if compression is not None:
+		return compression
+	return zipfile.ZIP_LZMA if size >= _LZMA_THRESHOLD else zipfile.ZIP_DEFLATED
+
+
+def build_dictionary(paths: Iterable[Path], size: int = _DICTIONARY_SIZE) -> bytes:
+	"""
+	Return a preset dictionary of at most ``size`` bytes for compressing the files at ``paths``.
+	It consists of the lines which occur in more than one of the files, with the most common
+	lines at the end, since Deflate encodes references to recent data more efficiently.
+	"""
+
+	def lines(path):
+		with open(path, 'rb') as f:
+			return {line for line in f.read(_DICTIONARY_MAX_SIZE).splitlines(keepends=True) if len(line) <= 256}
+	counts = collections.Counter()
+	for found in profiles.run_parallel(lines, paths):
+		counts.update(found)
+	selected = []
+	remaining = size
+	for line, count in counts.most_common():
+		if count < 2 or remaining <= 0:
+			break
+		if len(line) <= remaining:
+			selected.append(line)
+			remaining -= len(line)
+	return b''.join(reversed(selected))
+
+
+def read_dictionary(zipf: 'zipfile.ZipFile') -> Optional[bytes]:
+	"""
+	Return the preset dictionary of an archive, or None if it doesn't have one.
+	"""
+	if constants.ARCHIVE_DICTIONARY_FILENAME not in zipf.NameToInfo:
+		return None
+	return zipf.read(constants.ARCHIVE_DICTIONARY_FILENAME)
+
+
+def _open_member(zipf: 'zipfile.ZipFile', member: 'zipfile.ZipInfo', zdict: Optional[bytes]) -> BinaryIO:
+	"""
+	Open an archive member for reading, like ``ZipFile.open()``, except that members
+	compressed with ``ZIP_DEFLATED_DICTIONARY`` are decompressed using ``zdict``.
+	"""
+	if member.compress_type != ZIP_DEFLATED_DICTIONARY:
+		return zipf.open(member)
+	if zdict is None:
+		raise zipfile.BadZipFile(f'{member.filename} was compressed with a dictionary, but the archive has none')
+	# Let zipfile read the compressed data as if it was stored, which it can do safely from several threads
+	raw = copy.copy(member)
+	raw.compress_type = zipfile.ZIP_STORED
+	raw.file_size = member.compress_size
+	del raw.CRC
+	with zipf.open(raw) as f:
+		decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=zdict)
+		data = decompressor.decompress(f.read()) + decompressor.flush()
+	if len(data) != member.file_size or zlib.crc32(data) != member.CRC:
+		raise zipfile.BadZipFile(f'Bad CRC-32 for file {member.filename!r}')
+	return io.BytesIO(data)
 
 
-def archive_profile(profile, destination: Path = None, overwrite=False, compression=zipfile.ZIP_BZIP2, compresslevel=9):
+def _compress_member(
+	path: Path, relpath: str, entry: dict, compression: int, compresslevel: int, zdict: bytes = None
+):
+	"""
+	Return the ZipInfo of the archive member for ``path``, its compressed contents,
+	and the SHA-256 digest of its contents. The contents are None if the file should be written
+	by ``ZipFile.write()`` with the ZipInfo's ``compress_type``, which is the case for stored files
+	and files of at least ``_LZMA_THRESHOLD`` bytes, so that large files are never read into memory.
+	If ``zdict`` is specified, small compressible files are compressed using it as a preset dictionary.
+	"""
+	zinfo = zipfile.ZipInfo(relpath, time.localtime(entry['mtime_ns'] // 10**9)[:6])
+	# Stored objects don't keep the original permissions, so they're taken from the manifest
+	zinfo.external_attr = (entry['mode'] & 0xFFFF) << 16
+	if zdict and 0 < entry['size'] <= _DICTIONARY_MAX_SIZE and path.suffix.lower() not in INCOMPRESSIBLE_SUFFIXES:
+		# Small files can rarely be compressed on their own, so the sample isn't checked for them
+		zinfo.compress_type = ZIP_DEFLATED_DICTIONARY
+	else:
+		zinfo.compress_type = compression_method(path, entry['size'], compression)
+	if zinfo.compress_type == zipfile.ZIP_STORED or entry['size'] >= _LZMA_THRESHOLD:
+		return zinfo, None, entry.get('digest') or profiles.file_digest(path)
+	with tracing.span('archive.compress', path=relpath) as span, open(path, 'rb') as f:
+		data = f.read()
+		digest = entry.get('digest') or hashlib.sha256(data).hexdigest()
+		zinfo.file_size = len(data)
+		zinfo.CRC = zlib.crc32(data)
+		header = b''
+		if zinfo.compress_type == zipfile.ZIP_LZMA:
+			header = _LZMA_HEADER
+			compressor = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[_LZMA_FILTER])
+		elif zinfo.compress_type == zipfile.ZIP_BZIP2:
+			compressor = bz2.BZ2Compressor(9 if compresslevel is None else compresslevel)
+		else:
+			level = zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel
+			compressor = zlib.compressobj(
+				level, zlib.DEFLATED, -zlib.MAX_WBITS,
+				**({'zdict': zdict} if zinfo.compress_type == ZIP_DEFLATED_DICTIONARY else {})
+			)
+		compressed = header + compressor.compress(data) + compressor.flush()
+		if len(compressed) >= len(data):
+			zinfo.compress_type = zipfile.ZIP_STORED
+		else:
+			data = compressed
+			zinfo.flag_bits = _LZMA_EOS_FLAG if zinfo.compress_type == zipfile.ZIP_LZMA else 0
+		zinfo.compress_size = len(data)
+		span.add(files=1, bytes=zinfo.file_size)
+	return zinfo, data, digest
+
+
+def _write_compressed(zipf: 'zipfile.ZipFile', zinfo: 'zipfile.ZipInfo', data: bytes):
+	"""
+	Add a member whose contents were already compressed by ``_compress_member()``.
+	zipfile can only write members by compressing them itself, so this does the same
+	as ``ZipFile.open(zinfo, 'w')``, except that the sizes and CRC are known beforehand.
+
+	This is the only function which uses zipfile's private API (``_writecheck()``, ``_didModify``,
+	``fp``, ``start_dir``, ``filelist`` and ``NameToInfo``), which hasn't changed since Python 3.8.
+	tests/test_archive.py checks that archives written this way can be read back by zipfile.
+	"""
+	if zinfo.compress_type == ZIP_DEFLATED_DICTIONARY:
+		# zipfile rejects methods it doesn't know, but the other checks are the same as for Deflate
+		checked = copy.copy(zinfo)
+		checked.compress_type = zipfile.ZIP_DEFLATED
+		zipf._writecheck(checked)
+	else:
+		zipf._writecheck(zinfo)
+	zipf._didModify = True
+	zipf.fp.seek(zipf.start_dir)
+	zinfo.header_offset = zipf.fp.tell()
+	zipf.fp.write(zinfo.FileHeader())
+	zipf.fp.write(data)
+	zipf.filelist.append(zinfo)
+	zipf.NameToInfo[zinfo.filename] = zinfo
+	zipf.start_dir = zipf.fp.tell()
+
+
+def archive_profile(
+	profile, destination: Path = None, overwrite=False, compression=None, compresslevel=9, dictionary=False
+):
 	"""
 	Archive a profile.
 	
@@ -18,96 +320,626 @@ def archive_profile(profile, destination: Path = None, overwrite=False, compress
 	If ``overwrite`` is False and the destination exists, ``FileExistsError`` will be raised.
 	``compression`` and ``compresslevel`` are the same as in ``zipfile.ZipFile`` -
 	see https://docs.python.org/3/library/zipfile.html#zipfile.ZipFile for available values.
+	Files which are already compressed are stored regardless of ``compression``;
+	if ``compression`` is None, the method is chosen for each file. See ``compression_method()``.
+	
+	Files are compressed in parallel (using ``copy_workers()`` threads),
+	and written into the archive in the order of the profile's manifest.
+	The archive also contains a manifest of its own, which is read by ``read_archive_manifest()``.
+	If ``dictionary`` is True, small files are compressed with a dictionary built from the profile
+	(see ``ZIP_DEFLATED_DICTIONARY``); such archives can only be extracted by Konfsave.
 	"""
+	import concurrent.futures
 	open_mode = 'w' if overwrite else 'x'
 	info = profiles.profile_info(profile)
 	if info is None:
 		raise RuntimeError(f'The directory {profile} is not a valid Konfsave profile.')
 	profile_dir = config.profile_home / profile
 	destination = destination or (config.archive_directory / (info['name'] + '.konfsave.zip'))
-	with zipfile.ZipFile(destination, mode=open_mode, compression=compression, compresslevel=compresslevel) as zipf:
-		print(f'Archiving "{profile}" into {destination}')
-		for source in profile_dir.glob('**/*'):
-			zipf.write(source, arcname=source.relative_to(profile_dir))
+	manifest = profiles.load_manifest(profile_dir)
+	backend = profiles.get_backend(manifest['storage'])
+	files = [(relpath, entry) for relpath, entry in manifest['files'].items() if 'link' not in entry]
+	archive_manifest = {
+		'version': ARCHIVE_MANIFEST_VERSION,
+		'name': info['name'],
+		'files': {relpath: _archive_entry(relpath, entry) for relpath, entry in manifest['files'].items()}
+	}
+	workers = profiles.copy_workers()
+	print(f'Archiving "{profile}" into {destination}')
+	with tracing.span('archive', files=len(manifest['files'])) as span, \
+		zipfile.ZipFile(destination, mode=open_mode, compresslevel=compresslevel) as zipf, \
+		concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		zipf.write(profile_dir / config.profile_info_filename, arcname=config.profile_info_filename)
+		zdict = None
+		if dictionary:
+			with tracing.span('archive.dictionary'):
+				zdict = build_dictionary(
+					backend.path(profile_dir, relpath, entry) for relpath, entry in files
+					if 0 < entry['size'] <= _DICTIONARY_MAX_SIZE and Path(relpath).suffix.lower() not in INCOMPRESSIBLE_SUFFIXES
+				)
+			zipf.writestr(constants.ARCHIVE_DICTIONARY_FILENAME, zdict, compress_type=zipfile.ZIP_DEFLATED)
+		for relpath, entry in manifest['files'].items():
+			if 'link' in entry:
+				# Store symlinks the same way as Info-ZIP does, i.e. the target is the member's contents
+				zinfo = zipfile.ZipInfo(relpath, time.localtime(entry['mtime_ns'] // 10**9)[:6])
+				zinfo.external_attr = entry['mode'] << 16
+				zipf.writestr(zinfo, entry['link'])
+		# Only a limited number of compressed files are kept in memory while they wait to be written
+		pending = []
+		paths = iter(files)
+		while True:
+			while len(pending) < 2 * workers and (item := next(paths, None)) is not None:
+				relpath, entry = item
+				path = backend.path(profile_dir, relpath, entry)
+				future = executor.submit(
+					config.bind(_compress_member), path, relpath, entry, compression, compresslevel, zdict
+				)
+				pending.append((path, entry, future))
+			if not pending:
+				break
+			path, entry, future = pending.pop(0)
+			zinfo, data, archive_manifest['files'][zinfo.filename]['digest'] = future.result()
+			if data is None:
+				zipf.write(path, arcname=zinfo.filename, compress_type=zinfo.compress_type, compresslevel=compresslevel)
+				# The central directory is only written when the archive is closed, so it's safe to update it here
+				zipf.getinfo(zinfo.filename).external_attr = zinfo.external_attr
+			else:
+				_write_compressed(zipf, zinfo, data)
+			span.add(bytes=entry['size'])
+		zipf.writestr(
+			constants.ARCHIVE_MANIFEST_FILENAME, json.dumps(archive_manifest), compress_type=zipfile.ZIP_DEFLATED
+		)
 	print('Archiving finished')
 
 
-def unarchive_profile(source: Path, new_name=None, overwrite=False, confirm=True) -> bool:
+def archive_profile_tar(profile, destination=None, overwrite=False, compression='gz'):
+	"""
+	Archive a profile as a tar file, which is written sequentially, so that ``destination``
+	can be a pipe. ``destination`` is either a path (by default, "[profile name].konfsave.tar[.gz|.xz]"
+	in the archive directory) or a binary file object, e.g. ``sys.stdout.buffer``;
+	in the latter case, status messages are printed to stderr instead of stdout.
+	``compression`` is one of ``TAR_COMPRESSIONS``.
+	
+	Files are copied into the archive in blocks of ``_TAR_BUFSIZE`` bytes,
+	so the memory used doesn't depend on the size of the profile.
+	The members are in the same order as in zip archives, except that the archive's manifest
+	comes right after the profile's info, so that it can be read before any files are extracted.
+	Since the manifest is written first, it only contains digests which the profile's storage keeps.
+	"""
+	info = profiles.profile_info(profile)
+	if info is None:
+		raise RuntimeError(f'The directory {profile} is not a valid Konfsave profile.')
+	profile_dir = config.profile_home / profile
+	suffix = f'.{compression}' if compression else ''
+	destination = destination or (config.archive_directory / f'{info["name"]}.konfsave.tar{suffix}')
+	manifest = profiles.load_manifest(profile_dir)
+	backend = profiles.get_backend(manifest['storage'])
+	archive_manifest = {
+		'version': ARCHIVE_MANIFEST_VERSION,
+		'name': info['name'],
+		'files': {
+			relpath: {**_archive_entry(relpath, entry), **({'digest': entry['digest']} if 'digest' in entry else {})}
+			for relpath, entry in manifest['files'].items()
+		}
+	}
+	streaming = hasattr(destination, 'write')
+	status = sys.stderr if streaming else sys.stdout
+	print(f'Archiving "{profile}" into {"a stream" if streaming else destination}', file=status)
+	if streaming:
+		opened = tarfile.open(fileobj=destination, mode=f'w|{compression}', bufsize=_TAR_BUFSIZE)
+	else:
+		fileobj = open(destination, 'wb' if overwrite else 'xb')
+		opened = tarfile.open(fileobj=fileobj, mode=f'w|{compression}', bufsize=_TAR_BUFSIZE)
+	try:
+		with tracing.span('archive', files=len(manifest['files'])) as span, opened as tar:
+			tar.add(profile_dir / config.profile_info_filename, arcname=config.profile_info_filename)
+			data = json.dumps(archive_manifest).encode()
+			tarinfo = tarfile.TarInfo(constants.ARCHIVE_MANIFEST_FILENAME)
+			tarinfo.size = len(data)
+			tarinfo.mtime = time.time()
+			tar.addfile(tarinfo, io.BytesIO(data))
+			for relpath, entry in manifest['files'].items():
+				tarinfo = tarfile.TarInfo(relpath)
+				tarinfo.mode = stat.S_IMODE(entry['mode'])
+				tarinfo.mtime = entry['mtime_ns'] / 10**9
+				if 'link' in entry:
+					tarinfo.type = tarfile.SYMTYPE
+					tarinfo.linkname = entry['link']
+					tar.addfile(tarinfo)
+					continue
+				tarinfo.size = entry['size']
+				with open(backend.path(profile_dir, relpath, entry), 'rb') as f:
+					tar.addfile(tarinfo, f)
+				span.add(bytes=entry['size'])
+	finally:
+		if not streaming:
+			fileobj.close()
+	print('Archiving finished', file=status)
+
+
+def _open_tar(source):
+	if hasattr(source, 'read'):
+		return tarfile.open(fileobj=source, mode='r|*', bufsize=_TAR_BUFSIZE)
+	return tarfile.open(source, mode='r|*', bufsize=_TAR_BUFSIZE)
+
+
+def _tar_entry(member: 'tarfile.TarInfo') -> dict:
+	file_type = stat.S_IFLNK if member.issym() else stat.S_IFREG
+	return _archive_entry(member.name, {
+		'mode': file_type | member.mode,
+		'size': member.size,
+		'mtime_ns': int(member.mtime * 10**9),
+		**({'link': member.linkname} if member.type == tarfile.SYMTYPE else {})
+	})
+
+
+def _read_tar_manifest(source) -> dict:
+	"""
+	Return the manifest of a tar archive; see ``read_archive_manifest()``.
+	The manifest is normally the second member, so only the beginning of the archive is read,
+	unless it has no manifest, in which case one is made from the headers of all members.
+	"""
+	with _open_tar(source) as tar:
+		files = {}
+		for member in tar:
+			if member.name == constants.ARCHIVE_MANIFEST_FILENAME:
+				try:
+					manifest = json.load(tar.extractfile(member))
+					assert manifest['version'] == ARCHIVE_MANIFEST_VERSION
+					assert isinstance(manifest['files'], dict)
+					return manifest
+				except (json.JSONDecodeError, KeyError, AssertionError) as e:
+					profiles.logger.warning(f'Malformed manifest in {source}\n{str(e)}\n')
+			elif (member.isfile() or member.issym()) and member.name not in _metadata_members():
+				files[member.name] = _tar_entry(member)
+	return {'version': ARCHIVE_MANIFEST_VERSION, 'name': None, 'files': files}
+
+
+def _unarchive_tar(source, new_name, overwrite, confirm, include, exclude) -> bool:
+	"""
+	Unarchive a tar archive as a stream, reading it only once; see ``unarchive_profile()``.
+	"""
+	with _open_tar(source) as tar:
+		members = iter(tar)
+		first = next(members, None)
+		info = None
+		if first is not None and first.name == config.profile_info_filename:
+			info = profiles.parse_profile_info(tar.extractfile(first), convert_values=False)
+		elif first is not None:
+			members = itertools.chain((first,), members)
+		info = _archived_info(source, info, new_name)
+
+		def extract(destination: Path):
+			files = {}
+			links = []
+			selected = archive_selector(include, exclude) if include or exclude else None
+			with tracing.span('unarchive') as span:
+				for member in members:
+					if member.name == constants.ARCHIVE_MANIFEST_FILENAME:
+						files = json.load(tar.extractfile(member)).get('files', {})
+						continue
+					if member.isdir() or member.name in _metadata_members():
+						continue
+					entry = files.get(member.name) or _tar_entry(member)
+					if selected and not selected(member.name, entry):
+						continue
+					if member.issym():
+						# Created after every file, so that no file is written through them
+						links.append(member)
+						continue
+					_extract_tar_member(tar, member, destination, entry['mtime_ns'])
+					span.add(files=1, bytes=member.size)
+				for member in links:
+					_extract_tar_member(tar, member, destination, None)
+					span.add(files=1)
+		return _unarchive(info, overwrite, confirm, extract)
+
+
+def _extract_tar_member(tar: 'tarfile.TarFile', member: 'tarfile.TarInfo', destination: Path, mtime_ns: int):
+	relpath = Path(member.name)
+	if relpath.is_absolute() or '..' in relpath.parts:
+		profiles.logger.warning(f'Refusing to extract {member.name} outside of the profile')
+		return
+	if not (member.isfile() or member.issym()):
+		profiles.logger.warning(f'Skipping {member.name}, which is neither a file nor a symlink')
+		return
+	if not _within_destination(destination, relpath):
+		return
+	path = destination / relpath
+	path.parent.mkdir(parents=True, exist_ok=True)
+	if member.issym():
+		_replace_with_symlink(path, member.linkname)
+		return
+	with tar.extractfile(member) as src, _create_file(path) as dst:
+		shutil.copyfileobj(src, dst, _TAR_BUFSIZE)
+		os.fchmod(dst.fileno(), member.mode)
+	os.utime(path, ns=(mtime_ns, mtime_ns), follow_symlinks=False)
+
+
+def _within_destination(destination: Path, relpath: Path) -> bool:
+	"""
+	Check that none of the parent directories of ``relpath`` within ``destination`` is a symlink,
+	so that extracting or loading it can't write outside of ``destination``.
+	Archives can contain a symlink followed by a file "beneath" it, and a profile which is
+	extracted over (or a home directory which is loaded into) may already contain symlinks.
+	"""
+	path = destination
+	for part in relpath.parts[:-1]:
+		path = path / part
+		if path.is_symlink():
+			profiles.logger.warning(f'Skipping {relpath}, because {path} is a symlink')
+			return False
+	return True
+
+
+def _create_file(path: Path):
+	"""
+	Open a new file at ``path`` for writing in binary mode, replacing the file or symlink there
+	instead of following it.
+	"""
+	if path.is_symlink() or path.exists():
+		path.unlink()
+	return open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600), 'wb')
+
+
+def _replace_with_symlink(path: Path, target: str):
+	if path.is_dir() and not path.is_symlink():
+		profiles.logger.warning(f'Refusing to replace the directory {path} with a symlink')
+		return
+	if path.is_symlink() or path.exists():
+		path.unlink()
+	os.symlink(target, path)
+
+
+def unarchive_profile(source, new_name=None, overwrite=False, confirm=True, include=None, exclude=None) -> bool:
 	"""
 	Extract and import an archived profile without loading it.
 	Returns True if unarchiving wasn't successful.
 	If ``new_name`` is unspecified, the original archive's profile name is validated.
 	``new_name`` is not validated in this function.
 	
+	``source`` is the path to either a zip archive or a tar archive (see ``archive_profile_tar()``),
+	or a binary file object from which a tar archive is read as a stream, e.g. ``sys.stdin.buffer``.
 	If ``confirm`` is True, the user will be warned about the safety implications of unarchiving,
 	and the function will exit if they cancel. Additionally, if ``confirm`` is True,
 	``overwrite`` is False, and the destination exists, the user will be asked whether they want
 	to overwrite the existing profile; if yes, the profile will be overwritten.
 	If ``confirm`` and ``overwrite`` are False and the destination exists, FileExistsError will be raised.
+	An overwritten profile is replaced as a whole, and kept if unarchiving fails.
 	If ``new_name`` is specified, the profile will be loaded into the matching directory and
 	its info will be updated.
 	If the original archive has no information file and ``new_name`` is unspecified, ValueError will be raised.
+	If ``include`` or ``exclude`` are specified, only the selected files are extracted; see ``archive_selector()``.
 	"""
+	if hasattr(source, 'read') or not zipfile.is_zipfile(source):
+		return _unarchive_tar(source, new_name, overwrite, confirm, include, exclude)
 	with zipfile.ZipFile(source) as zipf:
-		with zipf.open(config.profile_info_filename) as infof:
-			info = profiles.parse_profile_info(infof, convert_values=False)
-			if info is None:
-				profiles.logger.warning(
-					f'The archive {source} has a malformed {config.profile_info_filename}.'
+		try:
+			with zipf.open(config.profile_info_filename) as infof:
+				info = profiles.parse_profile_info(infof, convert_values=False)
+		except KeyError:
+			info = None
+		info = _archived_info(source, info, new_name)
+
+		def extract(destination: Path):
+			members = [m for m in zipf.infolist() if not m.is_dir() and m.filename not in _metadata_members()]
+			files = read_archive_manifest(source, zipf)['files']
+			if include or exclude:
+				selected = archive_selector(include, exclude)
+				members = [m for m in members if m.filename in files and selected(m.filename, files[m.filename])]
+				profiles.logger.info(f'Extracting {len(members)} of {len(files)} files')
+			with tracing.span('unarchive', files=len(members)) as span:
+				zdict = read_dictionary(zipf)
+				members = [
+					m for m in members
+					if _within_archive(m, 'extract') and _within_destination(destination, Path(m.filename))
+				]
+				# Symlinks are created after every file, so that no file is written through them
+				links = [m for m in members if _is_symlink(m)]
+				members = [m for m in members if not _is_symlink(m)]
+				profiles.make_directories(destination / m.filename for m in members)
+				run_with_archive(
+					source, lambda z, m: _extract_member(z, m, destination, zdict, files.get(m.filename)), members
 				)
-				if new_name is None:
-					raise ValueError(
-						f'Could not infer the destination profile name for archive {source}. '
-						'The archive doesn\'t contain a valid info file, and no new name was '
-						'specified as a command line argument.'
-					)
-			if new_name:
-				info['name'] = new_name
-			else:
-				profiles.validate_profile_name(info['name'])
-		if confirm and input(
-			'Warning: you\'re about to extract a profile that may have been created by someone else.\n'
-			'Konfsave profiles can contain any file within the home directory, not just configurations.\n'
-			'Unarchiving a profile will not load it; however, loading profiles from untrusted sources\n'
-			'may have destructive consequences, including unintentionally overwriting personal data.\n'
-			'Have you manually gone through the archive and made sure that every file is expected? [y/N]: '
-		) != 'y':
-			print('Unarchiving aborted.')
-			return True
-		destination = config.profile_home / info['name']
-		backup = None
-		if destination.exists() and not overwrite:
-			if confirm:
-				if input(
-					f'Warning: the profile "{info["name"]}" is already saved.\n'
-					'Are you sure you want to overwrite it? [y/N]: '
-				) != 'y':
-					print('Unarchiving aborted.')
-					return True
-				else:
-					# Create a backup, which will be deleted if all of the next steps are successful.
-					backup = Path(str(destination) + '.bkp')
-					if backup.exists():
-						profiles.logger.warning(
-							f'Warning: the backup {backup} already exists. It will be overwritten.'
-						)
-						shutil.rmtree(backup)  # Path.rename() fails if the directory is not empty
-					destination.rename(str(destination) + '.bkp')
-			else:
-				raise FileExistsError(filename=str(destination))
+				for member in links:
+					_extract_symlink(zipf, member, destination)
+				if span:
+					span.add(bytes=sum(m.file_size for m in members))
+		return _unarchive(info, overwrite, confirm, extract)
+
+
+def read_archive_info(source) -> Optional[dict]:
+	"""
+	Return the info of the profile in a zip or tar archive, or None if it's missing or malformed.
+	Only the beginning of tar archives is read.
+	"""
+	if hasattr(source, 'read') or not zipfile.is_zipfile(source):
+		with _open_tar(source) as tar:
+			first = next(iter(tar), None)
+			if first is None or first.name != config.profile_info_filename:
+				return None
+			return profiles.parse_profile_info(tar.extractfile(first), convert_values=False)
+	with zipfile.ZipFile(source) as zipf:
 		try:
-			zipf.extractall(
-				destination,
-				members=(p for p in zipf.namelist() if p != config.profile_info_filename)
+			with zipf.open(config.profile_info_filename) as infof:
+				return profiles.parse_profile_info(infof, convert_values=False)
+		except KeyError:
+			return None
+
+
+def _archived_info(source, info: dict, new_name: str) -> dict:
+	if info is None:
+		profiles.logger.warning(
+			f'The archive {source} has a malformed {config.profile_info_filename}.'
+		)
+		if new_name is None:
+			raise ValueError(
+				f'Could not infer the destination profile name for archive {source}. '
+				'The archive doesn\'t contain a valid info file, and no new name was '
+				'specified as a command line argument.'
 			)
-			with open(destination / config.profile_info_filename, 'w') as f:
-				f.write(json.dumps(info))  # Write only after JSON serialization is successful
-		except Exception:
-			profiles.logger.exception(f'Unarchiving failed.\n')
-			if backup:
-				profiles.logger.warning(
-					f'The previous version of "{info["name"]}" was backed up to {destination}'
-				)
-		else:
-			if backup:
-				shutil.rmtree(backup) 
+	if info is None:
+		info = {'name': new_name, 'author': None, 'description': None, 'groups': []}
+	elif new_name:
+		info['name'] = new_name
+	else:
+		profiles.validate_profile_name(info['name'])
+	return info
+
+
+def confirm_unarchive(archives: int = 1) -> bool:
+	"""
+	Warn the user about unarchiving profiles from untrusted sources, and return whether they want to continue.
+	"""
+	profile = 'a profile' if archives == 1 else f'{archives} profiles'
+	archive = 'the archive' if archives == 1 else 'the archives'
+	return input(
+		f'Warning: you\'re about to extract {profile} that may have been created by someone else.\n'
+		'Konfsave profiles can contain any file within the home directory, not just configurations.\n'
+		'Unarchiving a profile will not load it; however, loading profiles from untrusted sources\n'
+		'may have destructive consequences, including unintentionally overwriting personal data.\n'
+		f'Have you manually gone through {archive} and made sure that every file is expected? [y/N]: '
+	) == 'y'
+
+
+def _unarchive(info: dict, overwrite: bool, confirm: bool, extract: Callable[[Path], None]) -> bool:
+	"""
+	Confirm unarchiving a profile, back up the profile it would overwrite, and call ``extract``
+	with the profile's directory. See ``unarchive_profile()``.
+	The overwritten profile is replaced rather than extracted over, so none of its files
+	(e.g. its history) are left behind; if unarchiving fails, it's restored from the backup.
+	"""
+	if confirm and not confirm_unarchive():
+		print('Unarchiving aborted.')
+		return True
+	destination = config.profile_home / info['name']
+	backup = None
+	if destination.exists():
+		if not overwrite:
+			if not confirm:
+				raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), str(destination))
+			if input(
+				f'Warning: the profile "{info["name"]}" is already saved.\n'
+				'Are you sure you want to overwrite it? [y/N]: '
+			) != 'y':
+				print('Unarchiving aborted.')
+				return True
+		# Create a backup, which will be deleted if all of the next steps are successful.
+		backup = Path(str(destination) + '.bkp')
+		if backup.exists():
+			profiles.logger.warning(
+				f'Warning: the backup {backup} already exists. It will be overwritten.'
+			)
+			shutil.rmtree(backup)  # Path.rename() fails if the directory is not empty
+		destination.rename(backup)
+	try:
+		extract(destination)
+		with open(destination / config.profile_info_filename, 'w') as f:
+			f.write(json.dumps(info))  # Write only after JSON serialization is successful
+		manifest = profiles.convert_profile(destination, profiles.load_manifest(destination), config.storage)
+		profiles.update_index(info['name'], profiles.index_entry(info['name'], info, manifest))
+	except Exception:
+		profiles.logger.exception(f'Unarchiving failed.\n')
+		if backup:
+			shutil.rmtree(destination, ignore_errors=True)
+			backup.rename(destination)
+			profiles.logger.warning(f'The previous version of "{info["name"]}" was restored.')
+		return True
+	else:
+		if backup:
+			shutil.rmtree(backup)
+
+
+def _member_matches(zipf: 'zipfile.ZipFile', member: 'zipfile.ZipInfo', destination: Path) -> bool:
+	"""
+	Check whether ``destination`` already has the same contents as an archive member,
+	using the size and CRC from the archive's central directory, so that the member isn't decompressed.
+	"""
+	try:
+		if _is_symlink(member):
+			return os.readlink(destination) == zipf.read(member).decode()
+		st = destination.lstat()
+	except OSError:
+		return False
+	mode = member.external_attr >> 16
+	if not stat.S_ISREG(st.st_mode) or st.st_size != member.file_size \
+		or (mode and stat.S_IMODE(st.st_mode) != stat.S_IMODE(mode)):
+		return False
+	crc = 0
+	with open(destination, 'rb') as f:
+		while chunk := f.read(1 << 20):
+			crc = zlib.crc32(chunk, crc)
+	return crc == member.CRC
+
+
+def archive_load_plan(zipf: 'zipfile.ZipFile', include=None, exclude=None) -> List['zipfile.ZipInfo']:
+	"""
+	Return the members of an archive that loading it would write; see ``load_archive()``.
+	``include`` and ``exclude`` are the same as for ``load()``.
+	Members in symlinked directories of the home directory are skipped.
+	"""
+	selected = profiles.path_selector(include, exclude)
+	members = []
+	for member in zipf.infolist():
+		relpath = Path(member.filename)
+		if member.is_dir() or member.filename in _metadata_members():
+			continue
+		if relpath.is_absolute() or '..' in relpath.parts:
+			profiles.logger.warning(f'Refusing to load {member.filename}, which is outside of the home directory')
+			continue
+		if selected(Path.home() / relpath) and _within_destination(Path.home(), relpath):
+			members.append(member)
+	matches = profiles.run_parallel(lambda m: _member_matches(zipf, m, Path.home() / m.filename), members)
+	plan = [member for member, match in zip(members, matches) if not match]
+	profiles.logger.info(f'{len(members) - len(plan)} files are already identical to the archived ones')
+	return plan
+
+
+def _load_member(zipf: 'zipfile.ZipFile', member: 'zipfile.ZipInfo', mtime_ns: int, zdict: Optional[bytes]):
+	destination = Path.home() / member.filename
+	profiles.logger.info(f'Copying {member.filename}')
+	if _is_symlink(member):
+		# Symlinks are loaded after every file, and an earlier one may be a parent of this one
+		if _within_destination(Path.home(), Path(member.filename)):
+			destination.parent.mkdir(parents=True, exist_ok=True)
+			_replace_with_symlink(destination, zipf.read(member).decode())
+		return
+	# Write to a temporary file first, so that a failed load doesn't leave a truncated file,
+	# and a symlink at the destination is replaced instead of written through
+	tmp = destination.with_name(f'{destination.name}.{os.getpid()}.tmp')
+	try:
+		with _open_member(zipf, member, zdict) as src, _create_file(tmp) as dst:
+			shutil.copyfileobj(src, dst, 1 << 20)
+			if mode := stat.S_IMODE(member.external_attr >> 16):
+				os.fchmod(dst.fileno(), mode)
+		os.utime(tmp, ns=(mtime_ns, mtime_ns), follow_symlinks=False)
+		os.replace(tmp, destination)
+	finally:
+		tmp.unlink(missing_ok=True)
+
+
+def load_archive(source: Path, include=None, exclude=None, overwrite_unsaved_configuration=False, restart=True) -> bool:
+	"""
+	Load a profile directly from an archive, without unarchiving it into the profile home first.
+	Files are selected the same way as by ``load()``, and members whose destinations already have
+	the same size, permissions and CRC are skipped. The archived profile becomes the current profile.
+	True is returned if the user canceled the action.
+	
+	Unless ``overwrite_unsaved_configuration`` is True, the user is warned about loading
+	files from untrusted archives, and has to confirm overwriting the current configuration.
+	"""
+	with zipfile.ZipFile(source) as zipf:
+		try:
+			with zipf.open(config.profile_info_filename) as infof:
+				info = profiles.parse_profile_info(infof, convert_values=False)
+		except KeyError:
+			info = None
+		if info is None:
+			raise ValueError(f'The archive {source} doesn\'t contain a valid {config.profile_info_filename}.')
+		if overwrite_unsaved_configuration is not True:
+			if input(
+				f'Warning: you\'re about to load the profile "{info["name"]}" directly from {source}.\n'
+				'Konfsave profiles can contain any file within the home directory, not just configurations.\n'
+				'Loading profiles from untrusted sources may have destructive consequences,\n'
+				'including unintentionally overwriting personal data. You can list the archived files\n'
+				'with `konfsave unarchive --list`. Files that aren\'t saved in a profile will be lost.\n'
+				'Are you sure you want to overwrite the current system configuration? [y/N]: '
+			).lower() != 'y':
+				print('Loading aborted.')
+				return True
+		with tracing.span('load.plan'):
+			plan = archive_load_plan(zipf, include, exclude)
+		components = []
+		if restart:
+			components = profiles.plan_restart(member.filename for member in plan)
+			profiles.stop_components(components)
+			# Stopped programs may have written their config while exiting
+			if any(c.stop for c in components):
+				plan = archive_load_plan(zipf, include, exclude)
+		files = read_archive_manifest(source, zipf)['files']
+		zdict = read_dictionary(zipf)
+		config.current_profile_path.unlink(missing_ok=True)
+
+		def load_member(z, m):
+			_load_member(z, m, files[m.filename]['mtime_ns'] if m.filename in files else _mtime_ns(m), zdict)
+		with tracing.span('load.restore', files=len(plan)) as span:
+			# Symlinks are created after every file, so that no file is written through them
+			links = [member for member in plan if _is_symlink(member)]
+			regular = [member for member in plan if not _is_symlink(member)]
+			profiles.make_directories(Path.home() / member.filename for member in regular)
+			run_with_archive(source, load_member, regular)
+			for member in links:
+				load_member(zipf, member)
+			if span:
+				span.add(bytes=sum(member.file_size for member in plan))
+		with open(config.current_profile_path, 'w') as f:
+			f.write(json.dumps(info))  # Write only after JSON serialization is successful
+	profiles.start_components(components)
+	return False
+
+
+def _within_archive(member: 'zipfile.ZipInfo', action: str) -> bool:
+	relpath = Path(member.filename)
+	if relpath.is_absolute() or '..' in relpath.parts:
+		profiles.logger.warning(f'Refusing to {action} {member.filename}, which is outside of the profile')
+		return False
+	return True
+
+
+def run_with_archive(source: Path, fn: Callable, members: List['zipfile.ZipInfo'], workers: int = None) -> List:
+	"""
+	Call ``fn(zipf, member)`` for every member of the archive at ``source`` using ``run_parallel()``.
+	Each thread opens the archive separately, so that members are read and decompressed
+	without waiting for each other. Decompression is limited by the CPU rather than by I/O,
+	so by default, there are no more threads than CPUs.
+	"""
+	workers = workers or min(profiles.copy_workers(), os.cpu_count() or 1)
+	local = threading.local()
+	opened = []
+
+	def call(member):
+		if (zipf := getattr(local, 'zipf', None)) is None:
+			zipf = local.zipf = zipfile.ZipFile(source)
+			opened.append(zipf)
+		return fn(zipf, member)
+	try:
+		return profiles.run_parallel(call, members, workers)
+	finally:
+		for zipf in opened:
+			zipf.close()
+
+
+def _extract_member(
+	zipf: 'zipfile.ZipFile', member: 'zipfile.ZipInfo', destination: Path, zdict: Optional[bytes], entry: dict = None
+):
+	"""
+	Extract a member into ``destination``, whose parent directories must already exist.
+	The permissions and modification time are those of ``entry`` in the archive's manifest,
+	or those in the central directory if the member isn't in the manifest.
+	"""
+	if _is_symlink(member):
+		_extract_symlink(zipf, member, destination)
+		return
+	path = destination / member.filename
+	with _open_member(zipf, member, zdict) as src, _create_file(path) as dst:
+		shutil.copyfileobj(src, dst, 1 << 20)
+		if mode := stat.S_IMODE(entry['mode'] if entry else member.external_attr >> 16):
+			os.fchmod(dst.fileno(), mode)
+	mtime_ns = entry['mtime_ns'] if entry else _mtime_ns(member)
+	os.utime(path, ns=(mtime_ns, mtime_ns), follow_symlinks=False)
+
+
+def _is_symlink(member: 'zipfile.ZipInfo') -> bool:
+	return stat.S_ISLNK(member.external_attr >> 16)
+
+
+def _extract_symlink(zipf: 'zipfile.ZipFile', member: 'zipfile.ZipInfo', destination: Path):
+	relpath = Path(member.filename)
+	if relpath.is_absolute() or '..' in relpath.parts:
+		profiles.logger.warning(f'Refusing to extract the symlink {member.filename} outside of the profile')
+		return
+	if not _within_destination(destination, relpath):
+		return
+	path = destination / relpath
+	path.parent.mkdir(parents=True, exist_ok=True)
+	_replace_with_symlink(path, zipf.read(member).decode())
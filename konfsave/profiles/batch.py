@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Callable, Iterable, List, Tuple
+
+from konfsave import config
+from konfsave import constants
+from konfsave import profiles
+
+
+def run_job(fn: Callable, args: tuple, kwargs: dict) -> Tuple[bool, Any]:
+	"""
+	Call ``fn(*args, **kwargs)`` and return ``(True, result)``, or ``(False, error message)`` if it fails,
+	including by calling ``sys.exit()``. This is how ``run_batch()`` reports each job.
+	"""
+	try:
+		return True, fn(*args, **kwargs)
+	except (Exception, SystemExit) as e:
+		profiles.logger.debug(f'{fn.__name__} failed', exc_info=True)
+		return False, str(e) or type(e).__name__
+
+
+def _initialize_worker(state: config.Config, level: int):
+	logging.basicConfig(format=constants.LOG_FORMAT)
+	profiles.logger.setLevel(level)
+	config.activate(state)
+
+
+def run_batch(fn: Callable, jobs: Iterable[Tuple[tuple, dict]], workers: int = None) -> List[Tuple[bool, Any]]:
+	"""
+	Call ``fn(*args, **kwargs)`` for every ``(args, kwargs)`` in ``jobs`` using a pool of ``workers``
+	processes (one per CPU by default), and return ``(True, result)`` or ``(False, error message)``
+	for every job, in the same order as ``jobs``. A failed job doesn't stop the others.
+
+	The processes are started afresh (not forked, since other threads of the caller may be
+	holding locks) and use a copy of the active config instead of loading it again.
+	``fn``, the arguments and the results must be picklable, so ``fn`` must be a module-level function.
+	It must not ask for input; confirmation should be asked for every job at once before calling this.
+	"""
+	jobs = list(jobs)
+	workers = min(workers or os.cpu_count() or 1, len(jobs))
+	if workers <= 1:
+		return [run_job(fn, args, kwargs) for args, kwargs in jobs]
+	import concurrent.futures
+	import multiprocessing
+	with concurrent.futures.ProcessPoolExecutor(
+		workers, mp_context=multiprocessing.get_context('spawn'),
+		initializer=_initialize_worker, initargs=(config.active(), profiles.logger.getEffectiveLevel())
+	) as executor:
+		futures = [executor.submit(run_job, fn, args, kwargs) for args, kwargs in jobs]
+		return [future.result() for future in futures]
+
+
+def save_profiles(names: List[str], workers: int = None, **kwargs) -> List[Tuple[bool, Any]]:
+	"""
+	Save the current configuration as every profile in ``names`` using ``run_batch()``.
+	``kwargs`` are passed to ``save()``, except for ``destination``, which isn't supported.
+	The names are not validated in this function.
+
+	Afterwards, the last successfully saved profile is the current one,
+	the same as if the profiles were saved one after another.
+	"""
+	results = run_batch(profiles.save, (((), {**kwargs, 'name': name}) for name in names), workers)
+	saved = [name for name, (ok, _) in zip(names, results) if ok]
+	# Every process switched the current profile, possibly at the same time
+	if saved and (info := profiles.profile_info(saved[-1], convert_values=False, use_cache=False)) is not None:
+		with open(config.current_profile_path, 'w') as f:
+			f.write(json.dumps(info))  # Write only after JSON serialization is successful
+	return results
+
+
+def archive_profiles(
+	names: List[str], directory: Path = None, archive_format='zip', workers: int = None, **kwargs
+) -> List[Tuple[bool, Any]]:
+	"""
+	Archive every profile in ``names`` into ``directory`` (the archive directory by default)
+	using ``run_batch()``. Each archive is named "[profile name].konfsave.[archive_format]", where
+	``archive_format`` is "zip" or one of "tar", "tar.gz", and "tar.xz" (see ``archive_profile_tar()``).
+	``kwargs`` are passed to ``archive_profile()`` or ``archive_profile_tar()``.
+	"""
+	directory = directory or config.archive_directory
+	if archive_format == 'zip':
+		fn = profiles.archive_profile
+	else:
+		fn = profiles.archive_profile_tar
+		kwargs['compression'] = archive_format.partition('.')[2]
+	return run_batch(fn, (
+		((), {**kwargs, 'profile': name, 'destination': directory / f'{name}.konfsave.{archive_format}'})
+		for name in names
+	), workers)
+
+
+def unarchive_profiles(sources: List[Path], overwrite=False, workers: int = None, **kwargs) -> List[Tuple[bool, Any]]:
+	"""
+	Unarchive every archive in ``sources`` using ``run_batch()``, without asking for confirmation.
+	``kwargs`` are passed to ``unarchive_profile()``. If ``overwrite`` is False,
+	existing profiles cause those archives to fail with FileExistsError; otherwise, they're replaced
+	the same way as by a single ``unarchive_profile()``, and kept if their archive fails.
+	Archives which contain the same profile must not be unarchived in the same batch.
+	"""
+	results = run_batch(profiles.unarchive_profile, (
+		((), {**kwargs, 'source': source, 'overwrite': overwrite, 'confirm': False}) for source in sources
+	), workers)
+	# unarchive_profile() returns True if unarchiving failed, and logs the reason
+	return [(ok and not failed, 'Unarchiving failed' if ok and failed else failed) for ok, failed in results]
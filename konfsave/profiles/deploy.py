@@ -0,0 +1,167 @@
+import errno
+import os
+import posixpath
+import shutil
+import stat
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from konfsave import config
+from konfsave import profiles
+from konfsave import tracing
+
+
+class _Home:
+	"""
+	A home directory that a profile is deployed into. Files are written as they would be loaded
+	by the user who owns it; if Konfsave runs as root, new files and directories are given to that user.
+
+	Directories within the home are opened one component at a time without following symlinks,
+	and files are written relative to the opened directories, so that replacing a directory
+	with a symlink while the profile is deployed can't make Konfsave write elsewhere.
+	Files in symlinked directories are skipped. Use as a context manager, which closes the directories.
+	"""
+	def __init__(self, path: Path):
+		self.path = path
+		st = path.stat()
+		self.owner = (st.st_uid, st.st_gid) if os.geteuid() == 0 and st.st_uid != 0 else None
+		self._directories: Dict[str, Optional[int]] = {}
+
+	def __enter__(self):
+		self._directories[''] = os.open(self.path, os.O_RDONLY | os.O_DIRECTORY)
+		return self
+
+	def __exit__(self, *exc_info):
+		for fd in self._directories.values():
+			if fd is not None:
+				os.close(fd)
+		self._directories.clear()
+
+	def directory(self, reldir: str) -> Optional[int]:
+		"""
+		Return a file descriptor of the directory ``reldir`` (relative to the home), creating it
+		and its parents if they're missing, or None if one of them is a symlink or not a directory.
+		"""
+		if reldir in self._directories:
+			return self._directories[reldir]
+		fd = parent = self.directory(posixpath.dirname(reldir))
+		if parent is not None:
+			name = posixpath.basename(reldir)
+			flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+			try:
+				try:
+					fd = os.open(name, flags, dir_fd=parent)
+				except FileNotFoundError:
+					try:
+						os.mkdir(name, dir_fd=parent)
+					except FileExistsError:
+						pass  # Created in the meantime
+					fd = os.open(name, flags, dir_fd=parent)
+					if self.owner is not None:
+						os.fchown(fd, *self.owner)
+			except OSError as error:
+				if error.errno not in (errno.ELOOP, errno.ENOTDIR):
+					raise
+				profiles.logger.warning(f'Skipping {self.path / reldir}, which is a symlink or not a directory')
+				fd = None
+		self._directories[reldir] = fd
+		return fd
+
+	def write(self, relpath: str, source: Optional[Path], entry: Optional[dict]) -> bool:
+		"""
+		Write ``source`` as ``relpath`` with the mode and modification time of its manifest ``entry``
+		(or create the symlink that ``entry`` describes), by writing a temporary file next to it
+		and moving it into place. If ``entry`` is None, the file is readable by everyone and writable by its owner.
+		Return False if the file was skipped because its directory couldn't be used.
+		"""
+		dir_fd = self.directory(posixpath.dirname(relpath))
+		if dir_fd is None:
+			return False
+		name = posixpath.basename(relpath)
+		tmp = f'.{name}.{os.getpid()}.konfsave.tmp'
+		self._unlink(tmp, dir_fd)  # Left over from an interrupted deployment
+		try:
+			if entry is not None and 'link' in entry:
+				os.symlink(entry['link'], tmp, dir_fd=dir_fd)
+				if self.owner is not None:
+					os.chown(tmp, *self.owner, dir_fd=dir_fd, follow_symlinks=False)
+			else:
+				fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600, dir_fd=dir_fd)
+				with open(source, 'rb') as src, open(fd, 'wb') as dst:
+					shutil.copyfileobj(src, dst, 1 << 20)
+					if self.owner is not None:
+						os.fchown(fd, *self.owner)
+					if entry is None:
+						os.fchmod(fd, 0o644)
+					else:
+						os.fchmod(fd, stat.S_IMODE(entry['mode']))
+						# Keep the saved modification time, so that ``matches()`` can avoid reading the file next time
+						os.utime(fd, ns=(entry['mtime_ns'], entry['mtime_ns']))
+			os.replace(tmp, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+		finally:
+			self._unlink(tmp, dir_fd)
+		return True
+
+	@staticmethod
+	def _unlink(name: str, dir_fd: int):
+		try:
+			os.unlink(name, dir_fd=dir_fd)
+		except FileNotFoundError:
+			pass
+
+
+def deploy(
+	name, homes: Iterable[Path], include=None, exclude=None, snapshot=None, workers: int = None
+) -> List[Tuple[bool, Any]]:
+	"""
+	Load a profile into each of ``homes`` instead of the current home directory, e.g. to provision
+	the accounts of several users. Nothing is restarted, and the current user's configuration isn't changed.
+	The name is not validated in this function.
+
+	The profile's manifest is read and the files are selected (see ``load_plan()``, with paths relative to
+	the current home directory) only once; the homes are then written in parallel, using ``copy_workers()``
+	threads by default. In each home, only the files that differ from the saved ones are written,
+	so each stored file is read again for every home that needs it, which is usually served from
+	the page cache. The profile becomes each user's current profile if ``config.current_profile_path``
+	is within the current home directory. For every home, ``(True, {"written": ..., "unchanged": ...})``
+	or ``(False, error message)`` is returned, in the same order as ``homes``.
+
+	Files are written through temporary files, so symlinks in the target homes are replaced
+	instead of written through, and files in symlinked directories are skipped; see ``_Home``.
+	"""
+	import concurrent.futures
+	homes = [Path(home) for home in homes]
+	profile_root = config.profile_home / name
+	if not (profile_root / config.profile_info_filename).is_file():
+		raise RuntimeError(f'The directory {profile_root} is not a valid Konfsave profile.')
+	manifest = profiles.load_manifest(profile_root) if snapshot is None \
+		else profiles.resolve_snapshot(profile_root, snapshot)
+	backend = profiles.get_backend(manifest['storage'])
+	selected = profiles.path_selector(include, exclude)
+	files = {relpath: entry for relpath, entry in manifest['files'].items() if selected(Path.home() / relpath)}
+	info_relpath = profiles.home_relative(config.current_profile_path)
+	if info_relpath is None:
+		profiles.logger.warning(
+			f'{config.current_profile_path} is outside of the home directory, so the current profile of the homes won\'t be set'
+		)
+
+	def deploy_home(home: Path) -> Dict[str, int]:
+		with tracing.span('deploy.home', home=str(home)) as span, _Home(home) as target:
+			plan = [
+				relpath for relpath, entry in files.items()
+				if not backend.matches(profile_root, relpath, entry, home / relpath)
+			]
+			written = 0
+			for relpath in plan:
+				entry = files[relpath]
+				source = None if 'link' in entry else backend.path(profile_root, relpath, entry)
+				written += target.write(relpath, source, entry)
+			if info_relpath is not None:
+				target.write(info_relpath, profile_root / config.profile_info_filename, None)
+			span.add(files=written)
+		profiles.logger.info(f'Deployed "{name}" into {home} ({written} files written)')
+		return {'written': written, 'unchanged': len(files) - len(plan)}
+	workers = min(workers or profiles.copy_workers(), len(homes)) or 1
+	with tracing.span('deploy', homes=len(homes), files=len(files)), \
+		concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		return list(executor.map(config.bind(lambda home: profiles.run_job(deploy_home, (home,), {})), homes))
@@ -0,0 +1,66 @@
+import os
+from pathlib import Path
+from typing import Callable, Iterable, List
+
+from konfsave import config
+from konfsave import profiles
+
+
+class CopyError(RuntimeError):
+	"""
+	Raised by ``run_parallel()`` when some of the items couldn't be processed.
+	``failures`` contains (item, exception) pairs in the same order as the original items.
+	"""
+	def __init__(self, failures):
+		self.failures = failures
+		super().__init__(
+			f'{len(failures)} file(s) could not be copied. The first error was: {failures[0][1]}'
+		)
+
+
+def copy_workers() -> int:
+	"""
+	Return the configured number of copy threads, or a default based on the number of CPUs.
+	Copying is mostly limited by I/O latency, so the default is higher than the number of CPUs.
+	"""
+	return config.copy_workers or min(32, (os.cpu_count() or 1) + 4)
+
+
+def make_directories(paths: Iterable[Path]):
+	"""
+	Create the parent directories of all ``paths``. Each directory is created only once,
+	so that copying threads don't have to check whether their destination's parent exists.
+	"""
+	for directory in sorted({path.parent for path in paths}):
+		directory.mkdir(parents=True, exist_ok=True)
+
+
+def _call(fn, item):
+	try:
+		return True, fn(item)
+	except Exception as e:
+		return False, e
+
+
+def run_parallel(fn: Callable, items: Iterable, workers: int = None) -> List:
+	"""
+	Call ``fn`` on every item using a pool of ``workers`` threads (``copy_workers()`` by default),
+	and return the results in the same order as ``items``.
+
+	If any of the calls raise an exception, the remaining items are still processed.
+	After that, every failure is logged in the order of ``items``, and CopyError is raised,
+	so the reported errors don't depend on how the work was scheduled.
+	"""
+	items = list(items)
+	workers = min(workers or copy_workers(), len(items))
+	if workers <= 1:
+		outcomes = [_call(fn, item) for item in items]
+	else:
+		import concurrent.futures
+		with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+			outcomes = list(executor.map(config.bind(lambda item: _call(fn, item)), items))
+	if failures := [(item, result) for item, (ok, result) in zip(items, outcomes) if not ok]:
+		for item, e in failures:
+			profiles.logger.error(f'Failed to copy {item}: {e}')
+		raise CopyError(failures)
+	return [result for _, result in outcomes]
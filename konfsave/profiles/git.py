@@ -0,0 +1,346 @@
+import atexit
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+from urllib.parse import quote, unquote
+
+from konfsave import config
+from konfsave import constants
+from konfsave import profiles
+from konfsave.profiles.storage import DirectoryStorage, register_backend, stat_entry, write_manifest
+
+# Name of the remote which ``push_profiles()`` and ``pull_profiles()`` use in ``config.git_repository``
+REMOTE_NAME = 'konfsave'
+
+
+def branch_name(profile: str) -> str:
+	# Some characters which are allowed in profile names (e.g. "[") aren't allowed in Git references
+	return quote(profile, safe='+&()]-_')
+
+
+def profile_name(branch: str) -> str:
+	return unquote(branch)
+
+
+class GitStorage(DirectoryStorage):
+	"""
+	Files are stored as blobs in ``config.git_repository``, a bare Git repository shared by
+	all profiles, so each unique file is stored only once. Every profile is a branch in it,
+	and every save is a commit which contains the profile's files and info, as well as the files'
+	permissions (Git only records whether a file is executable). The profile's directory
+	contains only its info and manifest.
+
+	Everything is written through pygit2 (the "GIT" feature), without running Git itself.
+	"""
+	name = 'git'
+
+	def __init__(self):
+		# pygit2 repositories must not be used by several threads at the same time
+		self._lock = threading.Lock()
+		# Repositories are opened once for every ``config.git_repository`` that is used
+		self._repositories: Dict[Path, Any] = {}
+		self._exported: Optional[Path] = None
+
+	def repository(self):
+		"""
+		Return the repository of the active config, which is created if it doesn't exist.
+		RuntimeError is raised if pygit2 isn't installed.
+		"""
+		with self._lock:
+			return self._open()
+
+	def _open(self):
+		path = config.git_repository
+		if (repository := self._repositories.get(path)) is None:
+			if not constants.has_feature('GIT'):
+				raise RuntimeError(
+					'The feature "GIT" is required to use Git storage. '
+					'Try installing it with pip: "pip install konfsave[GIT]"'
+				)
+			import pygit2
+			if (path / 'HEAD').exists():
+				repository = pygit2.Repository(str(path))
+			else:
+				profiles.logger.info(f'Creating a Git repository at {path}')
+				repository = pygit2.init_repository(str(path), bare=True)
+			self._repositories[path] = repository
+		return repository
+
+	def prepare(self, profile_dir: Path, relpaths: Iterable[str]):
+		self.repository()
+
+	def store(self, profile_dir: Path, relpath: str, source: Path, follow_symlinks=False) -> dict:
+		st = os.stat(source, follow_symlinks=follow_symlinks)
+		if stat.S_ISLNK(st.st_mode):
+			return stat_entry(st, link=os.readlink(source))
+		profiles.logger.info(f'Storing {source}')
+		with self._lock:
+			oid = self._open().create_blob_fromdisk(str(source))
+		return stat_entry(st, oid=str(oid))
+
+	def store_link(self, profile_dir: Path, relpath: str, entry: dict):
+		pass  # Symlinks are written into the tree when the profile is committed
+
+	def is_stored(self, profile_dir: Path, relpath: str, entry: dict) -> bool:
+		if 'link' in entry:
+			return True
+		with self._lock:
+			return entry['oid'] in self._open()
+
+	def _read(self, entry: dict) -> bytes:
+		with self._lock:
+			return self._open()[entry['oid']].data
+
+	def path(self, profile_dir: Path, relpath: str, entry: dict) -> Path:
+		"""
+		Blobs can't be read as files, so they're exported into a temporary directory,
+		which is removed when Konfsave exits.
+		"""
+		with self._lock:
+			if self._exported is None:
+				self._exported = Path(tempfile.mkdtemp(prefix='konfsave-git-'))
+				atexit.register(shutil.rmtree, self._exported, True)
+			destination = self._exported / entry['oid']
+			if not destination.exists():
+				destination.write_bytes(self._open()[entry['oid']].data)
+		return destination
+
+	def restore(self, profile_dir: Path, relpath: str, entry: dict, destination: Path):
+		if 'link' in entry:
+			return super().restore(profile_dir, relpath, entry, destination)
+		data = self._read(entry)
+		if destination.is_symlink():
+			destination.unlink()
+		with open(destination, 'wb') as f:
+			f.write(data)
+		os.chmod(destination, stat.S_IMODE(entry['mode']))
+		os.utime(destination, ns=(entry['mtime_ns'], entry['mtime_ns']))
+
+	def _same_contents(self, profile_dir: Path, relpath: str, entry: dict, destination: Path) -> bool:
+		import pygit2
+		# The ID of a blob is the hash of its contents, so there's no need to read the blob
+		return str(pygit2.hashfile(str(destination))) == entry['oid']
+
+	def clear(self, profile_dir: Path):
+		pass  # Blobs may be shared, and the profile's history is kept in the repository
+
+	def remove(self, profile_dir: Path):
+		shutil.rmtree(profile_dir)
+		with self._lock:
+			repository = self._open()
+			if (reference := repository.references.get(_reference(profile_dir.name))) is not None:
+				reference.delete()
+
+	def rename(self, profile_dir: Path, new_profile_dir: Path):
+		with self._lock:
+			repository = self._open()
+			if (reference := repository.references.get(_reference(profile_dir.name))) is not None:
+				repository.references.create(_reference(new_profile_dir.name), reference.target)
+				reference.delete()
+		super().rename(profile_dir, new_profile_dir)
+
+	def commit(self, profile_dir: Path, files: Dict[str, dict], message: str):
+		"""
+		Commit the profile's files and info to its branch, unless they're the same as in the last commit.
+		The tree is built in an in-memory index, so the repository doesn't need a working directory.
+		"""
+		import pygit2
+		with self._lock:
+			repository = self._open()
+			index = pygit2.Index()
+			modes = {}
+			for relpath, entry in files.items():
+				if 'link' in entry:
+					oid = repository.create_blob(os.fsencode(entry['link']))
+					mode = pygit2.GIT_FILEMODE_LINK
+				else:
+					oid = pygit2.Oid(hex=entry['oid'])
+					mode = pygit2.GIT_FILEMODE_BLOB_EXECUTABLE if entry['mode'] & 0o111 else pygit2.GIT_FILEMODE_BLOB
+					modes[relpath] = entry['mode']
+				index.add(pygit2.IndexEntry(relpath, oid, mode))
+			modes_oid = repository.create_blob(json.dumps(modes, sort_keys=True).encode())
+			index.add(pygit2.IndexEntry(constants.GIT_MODES_FILENAME, modes_oid, pygit2.GIT_FILEMODE_BLOB))
+			info_oid = repository.create_blob_fromdisk(str(profile_dir / config.profile_info_filename))
+			index.add(pygit2.IndexEntry(config.profile_info_filename, info_oid, pygit2.GIT_FILEMODE_BLOB))
+			tree = index.write_tree(repository)
+			reference = repository.references.get(_reference(profile_dir.name))
+			if reference is not None and repository[reference.target].tree_id == tree:
+				return
+			signature = pygit2.Signature('Konfsave', 'konfsave@localhost')
+			repository.create_commit(
+				_reference(profile_dir.name), signature, signature, message, tree,
+				[reference.target] if reference is not None else []
+			)
+
+
+def _reference(profile: str) -> str:
+	return f'refs/heads/{branch_name(profile)}'
+
+
+register_backend(GitStorage())
+
+
+def _remote(url: str = None):
+	"""
+	Return the remote used for synchronization, pointing to ``url`` (``config.git_remote`` by default).
+	If ``url`` is a path that doesn't exist yet, a bare repository is created there.
+	"""
+	import pygit2
+	url = url or config.git_remote
+	if not url:
+		raise RuntimeError(
+			'No remote repository is configured. Set git-remote in the config '
+			'or specify a remote in the command line.'
+		)
+	if url.startswith(('/', '~', '.')):
+		url = str(Path(url).expanduser().resolve())
+		if not Path(url).exists():
+			profiles.logger.info(f'Creating a bare Git repository at {url}')
+			pygit2.init_repository(url, bare=True)
+	repository = profiles.get_backend(GitStorage.name).repository()
+	try:
+		remote = repository.remotes[REMOTE_NAME]
+	except KeyError:
+		return repository, repository.remotes.create(REMOTE_NAME, url)
+	if remote.url != url:
+		repository.remotes.set_url(REMOTE_NAME, url)
+		remote = repository.remotes[REMOTE_NAME]
+	return repository, remote
+
+
+def _fetch(remote):
+	import pygit2
+	try:
+		remote.fetch()
+	except pygit2.GitError as e:
+		raise RuntimeError(f'Couldn\'t fetch from {remote.url}: {e}') from e
+
+
+def _profiles_to_sync(names, references) -> Dict[str, str]:
+	"""
+	Map profile names to the branch names in ``references`` (e.g. "refs/heads/").
+	If ``names`` is empty, all branches are used.
+	"""
+	prefix_length = len(references)
+	branches = {}
+	for reference in profiles.get_backend(GitStorage.name).repository().references:
+		if reference.startswith(references):
+			branches[profile_name(reference[prefix_length:])] = reference[prefix_length:]
+	if names:
+		return {name: branches[name] for name in names if name in branches}
+	return branches
+
+
+@constants.feature_required('GIT')
+def push_profiles(names: Iterable[str] = (), url: str = None) -> Dict[str, str]:
+	"""
+	Push the branches of Git-stored profiles (all of them by default) to the remote repository.
+	Returns a mapping of profile names to "pushed", "up-to-date", or "rejected"
+	(when the remote has commits which aren't present locally; pull the profile first).
+	"""
+	import pygit2
+	repository, remote = _remote(url)
+	_fetch(remote)
+	results = {}
+	for name, branch in _profiles_to_sync(list(names), 'refs/heads/').items():
+		local = repository.references[f'refs/heads/{branch}'].target
+		tracking = repository.references.get(f'refs/remotes/{REMOTE_NAME}/{branch}')
+		if tracking is not None and tracking.target == local:
+			results[name] = 'up-to-date'
+			continue
+		try:
+			remote.push([f'refs/heads/{branch}:refs/heads/{branch}'])
+			results[name] = 'pushed'
+		except pygit2.GitError as e:
+			profiles.logger.warning(f'Couldn\'t push "{name}": {e}')
+			results[name] = 'rejected'
+	return results
+
+
+@constants.feature_required('GIT')
+def pull_profiles(names: Iterable[str] = (), url: str = None) -> Dict[str, str]:
+	"""
+	Fetch profiles (all of them by default) from the remote repository and update the local ones.
+	Profiles are only updated if the local branch has no commits that the remote one doesn't have.
+	Returns a mapping of profile names to "created", "updated", "up-to-date", "ahead" (only the
+	local profile has new commits), "diverged" (both have new commits), or "conflict" (a profile
+	with the same name exists, but isn't stored in Git).
+	"""
+	repository, remote = _remote(url)
+	_fetch(remote)
+	results = {}
+	for name, branch in _profiles_to_sync(list(names), f'refs/remotes/{REMOTE_NAME}/').items():
+		if not profiles.validate_profile_name(name, exit_if_invalid=False):
+			profiles.logger.warning(f'Skipping the remote branch "{branch}", which isn\'t a valid profile name')
+			continue
+		incoming = repository.references[f'refs/remotes/{REMOTE_NAME}/{branch}'].target
+		local = repository.references.get(f'refs/heads/{branch}')
+		profile_dir = config.profile_home / name
+		if local is None:
+			if (profile_dir / config.profile_info_filename).exists():
+				results[name] = 'conflict'
+				continue
+			repository.references.create(f'refs/heads/{branch}', incoming)
+			results[name] = 'created'
+		elif local.target == incoming:
+			results[name] = 'up-to-date'
+			continue
+		elif repository.descendant_of(incoming, local.target):
+			local.set_target(incoming)
+			results[name] = 'updated'
+		elif repository.descendant_of(local.target, incoming):
+			results[name] = 'ahead'
+			continue
+		else:
+			results[name] = 'diverged'
+			continue
+		checkout_profile(name)
+	return results
+
+
+def checkout_profile(name: str):
+	"""
+	Write the info and manifest of a Git-stored profile from the last commit on its branch.
+	Since the commit doesn't record when the files were modified, they're assumed
+	to be as old as the commit. Commits made before permissions were recorded
+	only tell whether a file is executable.
+	"""
+	import pygit2
+	repository = profiles.get_backend(GitStorage.name).repository()
+	commit = repository[repository.references[_reference(name)].target]
+	saved_ns = commit.commit_time * 10**9
+	profile_dir = config.profile_home / name
+	profile_dir.mkdir(parents=True, exist_ok=True)
+	files = {}
+	modes = {}
+	trees = [('', commit.tree)]
+	while trees:
+		prefix, tree = trees.pop()
+		for item in tree:
+			relpath = prefix + item.name
+			if item.filemode == pygit2.GIT_FILEMODE_TREE:
+				trees.append((relpath + '/', repository[item.id]))
+			elif relpath == config.profile_info_filename:
+				(profile_dir / relpath).write_bytes(repository[item.id].data)
+			elif relpath == constants.GIT_MODES_FILENAME:
+				modes = json.loads(repository[item.id].data)
+			elif item.filemode == pygit2.GIT_FILEMODE_LINK:
+				files[relpath] = {
+					'mode': stat.S_IFLNK | 0o777, 'size': repository[item.id].size, 'mtime_ns': saved_ns, 'ino': 0,
+					'link': os.fsdecode(repository[item.id].data)
+				}
+			else:
+				files[relpath] = {
+					'mode': item.filemode, 'size': repository[item.id].size, 'mtime_ns': saved_ns, 'ino': 0,
+					'oid': str(item.id)
+				}
+	for relpath, mode in modes.items():
+		if relpath in files and 'oid' in files[relpath]:
+			files[relpath]['mode'] = mode
+	write_manifest(profile_dir, GitStorage.name, files, saved_ns=saved_ns)
+	profiles.update_index(name)
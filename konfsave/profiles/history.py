@@ -0,0 +1,252 @@
+import bisect
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from konfsave import config
+from konfsave import constants
+from konfsave import profiles
+
+# Every save creates a snapshot, which is stored in the profile's history directory as "<id>.json".
+# Snapshots have the same format as manifests, except that their storage is always "objects":
+# the contents of every file are stored in ``config.object_store``, so unchanged files
+# are shared between snapshots (and with profiles that use the "objects" storage).
+# Snapshots additionally contain "id" and "info" (the profile's info at the time of saving).
+#
+# The history directory also contains an index of all snapshots, ordered by their IDs
+# (which is also the order in which they were created), so that snapshots can be listed
+# and found without reading every one of them. Every record contains the snapshot's
+# "id", "saved_ns", "files" (the number of files) and "bytes" (their total size).
+HISTORY_VERSION = 1
+_HISTORY_INDEX_FILENAME = 'index.json'
+
+
+class SnapshotNotFoundError(LookupError):
+	pass
+
+
+def history_dir(profile_dir: Path) -> Path:
+	return profile_dir / constants.HISTORY_DIRNAME
+
+
+def _snapshot_path(profile_dir: Path, snapshot_id: int) -> Path:
+	return history_dir(profile_dir) / f'{snapshot_id}.json'
+
+
+def list_snapshots(profile_dir: Path) -> List[dict]:
+	"""
+	Return the records of all snapshots of a profile, from the oldest to the newest.
+	If the history index is malformed, it's rebuilt from the snapshots.
+	"""
+	try:
+		with open(history_dir(profile_dir) / _HISTORY_INDEX_FILENAME) as f:
+			index = json.load(f)
+		assert index['version'] == HISTORY_VERSION
+		assert isinstance(index['snapshots'], list)
+		return index['snapshots']
+	except FileNotFoundError:
+		return []
+	except (json.JSONDecodeError, KeyError, AssertionError) as e:
+		profiles.logger.warning(f'Malformed history index in {history_dir(profile_dir)}\n{str(e)}\n')
+	return rebuild_history(profile_dir)
+
+
+def _write_snapshots(profile_dir: Path, snapshots: List[dict]):
+	index_path = history_dir(profile_dir) / _HISTORY_INDEX_FILENAME
+	tmp_path = index_path.with_name(f'{index_path.name}.{os.getpid()}.tmp')
+	data = json.dumps({'version': HISTORY_VERSION, 'snapshots': snapshots})
+	with open(tmp_path, 'w') as f:
+		f.write(data)  # Write only after JSON serialization is successful
+	os.replace(tmp_path, index_path)
+
+
+def _record(snapshot: dict) -> dict:
+	return {
+		'id': snapshot['id'],
+		'saved_ns': snapshot['saved_ns'],
+		'files': len(snapshot['files']),
+		'bytes': sum(e['size'] for e in snapshot['files'].values() if 'link' not in e)
+	}
+
+
+def rebuild_history(profile_dir: Path) -> List[dict]:
+	"""
+	Recreate the history index by reading every snapshot, and return the records.
+	"""
+	snapshots = []
+	directory = history_dir(profile_dir)
+	if not directory.is_dir():
+		return snapshots
+	for path in directory.glob('*.json'):
+		if not path.stem.isdigit():
+			continue
+		if (snapshot := _read_snapshot(path)) is not None:
+			snapshots.append(_record(snapshot))
+	snapshots.sort(key=lambda r: r['id'])
+	_write_snapshots(profile_dir, snapshots)
+	return snapshots
+
+
+def _read_snapshot(path: Path) -> Optional[dict]:
+	try:
+		with open(path) as f:
+			snapshot = json.load(f)
+		assert isinstance(snapshot['files'], dict)
+		assert isinstance(snapshot['id'], int)
+		return snapshot
+	except FileNotFoundError:
+		return None
+	except (json.JSONDecodeError, KeyError, AssertionError) as e:
+		profiles.logger.warning(f'Malformed snapshot at {path}\n{str(e)}\n')
+		return None
+
+
+def read_snapshot(profile_dir: Path, snapshot_id: int) -> dict:
+	"""
+	Return the snapshot with the given ID. SnapshotNotFoundError is raised if it doesn't exist.
+	"""
+	if (snapshot := _read_snapshot(_snapshot_path(profile_dir, snapshot_id))) is None:
+		raise SnapshotNotFoundError(f'The snapshot {snapshot_id} of {profile_dir.name} doesn\'t exist.')
+	return snapshot
+
+
+def resolve_snapshot(profile_dir: Path, spec: str) -> dict:
+	"""
+	Find a snapshot by ``spec``, which is either a snapshot ID, "latest",
+	or a date and optionally time in ISO format (e.g. "2021-05-01" or "2021-05-01T18:30"),
+	in which case the last snapshot created before the end of that day or minute is chosen.
+	Only the history index and the chosen snapshot are read.
+	SnapshotNotFoundError is raised if no snapshot matches.
+	"""
+	snapshots = list_snapshots(profile_dir)
+	if spec == 'latest':
+		position = len(snapshots)
+	elif spec.isdigit():
+		position = bisect.bisect_right([r['id'] for r in snapshots], int(spec))
+		if not position or snapshots[position - 1]['id'] != int(spec):
+			position = 0
+	else:
+		try:
+			moment = datetime.fromisoformat(spec)
+		except ValueError:
+			raise SnapshotNotFoundError(
+				f'"{spec}" is not a snapshot ID, "latest", or a date in the YYYY-MM-DD[THH:MM] format.'
+			) from None
+		# A date without a time refers to the whole day, and a time without seconds to the whole minute
+		if len(spec) <= len('YYYY-MM-DD'):
+			end = moment.replace(hour=23, minute=59, second=59, microsecond=999999)
+		elif moment.second == 0 and moment.microsecond == 0:
+			end = moment.replace(second=59, microsecond=999999)
+		else:
+			end = moment
+		position = bisect.bisect_right([r['saved_ns'] for r in snapshots], int(end.timestamp() * 10**9))
+	if not position:
+		raise SnapshotNotFoundError(f'No snapshot of {profile_dir.name} matches "{spec}".')
+	return read_snapshot(profile_dir, snapshots[position - 1]['id'])
+
+
+def create_snapshot(profile_dir: Path, manifest: dict, info: dict) -> dict:
+	"""
+	Record the current state of a profile as a new snapshot and return the snapshot's record.
+	``manifest`` must describe the profile's current contents.
+
+	Files whose manifest entries are unchanged since the previous snapshot keep their digests;
+	other files are copied into the object store unless their contents are already there.
+	"""
+	backend = profiles.get_backend(manifest['storage'])
+	snapshots = list_snapshots(profile_dir)
+	previous = (snapshots and _read_snapshot(_snapshot_path(profile_dir, snapshots[-1]['id']))) or {'files': {}}
+	previous = previous['files']
+
+	def snapshot_file(relpath):
+		entry = manifest['files'][relpath]
+		if 'link' in entry:
+			return entry
+		old = previous.get(relpath)
+		if old and 'digest' in old and all(old[k] == entry.get(k) for k in ('mode', 'size', 'mtime_ns', 'ino')) \
+			and profiles.object_path(old['digest']).exists():
+			return {**entry, 'digest': old['digest']}
+		if 'digest' in entry and profiles.object_path(entry['digest']).exists():
+			return entry
+		# Stored copies may be hard links to the original files, which mustn't be shared with the object
+		digest = profiles.store_object(backend.path(profile_dir, relpath, entry))
+		return {**entry, 'digest': digest}
+	relpaths = list(manifest['files'])
+	files = dict(zip(relpaths, profiles.run_parallel(snapshot_file, relpaths)))
+	snapshot = {
+		'version': HISTORY_VERSION,
+		'storage': profiles.ObjectStorage.name,
+		'id': snapshots[-1]['id'] + 1 if snapshots else 1,
+		'saved_ns': manifest.get('saved_ns') or time.time_ns(),
+		'info': info,
+		'files': files
+	}
+	history_dir(profile_dir).mkdir(exist_ok=True)
+	data = json.dumps(snapshot)
+	with open(_snapshot_path(profile_dir, snapshot['id']), 'w') as f:
+		f.write(data)  # Write only after JSON serialization is successful
+	record = _record(snapshot)
+	_write_snapshots(profile_dir, [*snapshots, record])
+	return record
+
+
+def retained_snapshots(snapshots: List[dict], keep_recent: int, keep_daily: int, keep_weekly: int) -> List[dict]:
+	"""
+	Return which of ``snapshots`` are kept by the retention policy:
+	the ``keep_recent`` newest snapshots, the newest snapshot of each of the last ``keep_daily``
+	days which have snapshots, and the same for ``keep_weekly`` weeks. The newest snapshot is always kept.
+	"""
+	newest_first = sorted(snapshots, key=lambda r: r['id'], reverse=True)
+	kept = {r['id'] for r in newest_first[:max(keep_recent, 1)]}
+	for keep, period in (
+		(keep_daily, lambda t: (t.tm_year, t.tm_yday)),
+		(keep_weekly, lambda t: datetime(*t[:3]).isocalendar()[:2])
+	):
+		periods = set()
+		for record in newest_first:
+			if len(periods) >= keep:
+				break
+			if (key := period(time.localtime(record['saved_ns'] // 10**9))) not in periods:
+				periods.add(key)
+				kept.add(record['id'])
+	return [r for r in snapshots if r['id'] in kept]
+
+
+def prune_history(profile_dir: Path, keep_recent: int = None, keep_daily: int = None, keep_weekly: int = None) -> int:
+	"""
+	Delete the snapshots which aren't kept by the retention policy (see ``retained_snapshots()``)
+	and return how many were deleted. The policy defaults to the one in the config.
+	The contents of deleted snapshots stay in the object store until ``collect_garbage()`` is called.
+	"""
+	snapshots = list_snapshots(profile_dir)
+	kept = retained_snapshots(
+		snapshots,
+		config.history_keep_recent if keep_recent is None else keep_recent,
+		config.history_keep_daily if keep_daily is None else keep_daily,
+		config.history_keep_weekly if keep_weekly is None else keep_weekly
+	)
+	if len(kept) == len(snapshots):
+		return 0
+	# Update the index first, so that it never refers to deleted snapshots
+	_write_snapshots(profile_dir, kept)
+	kept_ids = {r['id'] for r in kept}
+	for record in snapshots:
+		if record['id'] not in kept_ids:
+			_snapshot_path(profile_dir, record['id']).unlink(missing_ok=True)
+	profiles.logger.info(f'Deleted {len(snapshots) - len(kept)} snapshots of {profile_dir.name}')
+	return len(snapshots) - len(kept)
+
+
+def snapshot_digests(profile_dir: Path) -> Tuple[set, bool]:
+	"""
+	Return the digests referenced by all snapshots of a profile, and whether all of them could be read.
+	"""
+	digests = set()
+	for record in list_snapshots(profile_dir):
+		if (snapshot := _read_snapshot(_snapshot_path(profile_dir, record['id']))) is None:
+			return digests, False
+		digests.update(e['digest'] for e in snapshot['files'].values() if 'digest' in e)
+	return digests, True
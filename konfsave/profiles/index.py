@@ -0,0 +1,142 @@
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, Optional
+
+from konfsave import config
+from konfsave import constants
+from konfsave import profiles
+
+# The index is stored in the profile home and maps profile names to their metadata:
+# "name", "author", "description", "groups" (same as in the profile's info),
+# "files" (number of saved files), "bytes" (their total size), and "saved_ns" (when the profile was last saved).
+# It's updated by every function that changes a profile, so that profiles can be listed
+# without reading every profile's directory. If it's missing or malformed, it's rebuilt.
+INDEX_VERSION = 1
+
+
+def _index_path() -> Path:
+	return config.profile_home / constants.INDEX_FILENAME
+
+
+def index_entry(name: str, info: dict = None, manifest: dict = None) -> Optional[dict]:
+	"""
+	Return the index entry of a saved profile, or None if it has no valid info file.
+	``info`` and ``manifest`` are read from the profile's directory unless specified.
+	"""
+	profile_dir = config.profile_home / name
+	if info is None and (info := profiles.profile_info(name, convert_values=False, use_cache=False)) is None:
+		return None
+	if manifest is None:
+		manifest = profiles.load_manifest(profile_dir)
+	if (saved_ns := manifest.get('saved_ns')) is None:
+		# The profile was saved by an older version or extracted from an archive
+		saved_ns = (profile_dir / config.profile_info_filename).stat().st_mtime_ns
+	return {
+		'name': info['name'],
+		'author': info.get('author'),
+		'description': info.get('description'),
+		'groups': info.get('groups'),
+		'files': len(manifest['files']),
+		'bytes': sum(e['size'] for e in manifest['files'].values() if 'link' not in e),
+		'saved_ns': saved_ns
+	}
+
+
+def read_index() -> Optional[Dict[str, dict]]:
+	"""
+	Return the index, or None if it's missing or malformed.
+	"""
+	try:
+		with open(_index_path()) as f:
+			index = json.load(f)
+		assert index['version'] == INDEX_VERSION
+		assert isinstance(index['profiles'], dict)
+		return index['profiles']
+	except FileNotFoundError:
+		return None
+	except (json.JSONDecodeError, KeyError, AssertionError) as e:
+		profiles.logger.warning(f'Malformed profile index at {_index_path()}\n{str(e)}\n')
+		return None
+
+
+def _write_index(entries: Dict[str, dict]):
+	config.profile_home.mkdir(parents=True, exist_ok=True)
+	data = json.dumps({'version': INDEX_VERSION, 'profiles': entries})
+	# Write only after JSON serialization is successful
+	fd, tmp_path = tempfile.mkstemp(prefix=f'{constants.INDEX_FILENAME}.', suffix='.tmp', dir=config.profile_home)
+	try:
+		with os.fdopen(fd, 'w') as f:
+			f.write(data)
+		os.replace(tmp_path, _index_path())  # Other processes may be reading the index at the same time
+	except BaseException:
+		os.unlink(tmp_path)
+		raise
+
+
+def rebuild_index() -> Dict[str, dict]:
+	"""
+	Create the index from scratch by reading every saved profile, and return it.
+	"""
+	with _index_lock():
+		return _rebuild_index()
+
+
+def _rebuild_index() -> Dict[str, dict]:
+	entries = {}
+	if config.profile_home.exists():
+		for profile_dir in sorted(config.profile_home.iterdir()):
+			name = profile_dir.name
+			if not profiles.validate_profile_name(name, exit_if_invalid=False) \
+				or not (profile_dir / config.profile_info_filename).is_file():
+				continue
+			if (entry := index_entry(name)) is not None:
+				entries[name] = entry
+	_write_index(entries)
+	return entries
+
+
+def load_index() -> Dict[str, dict]:
+	"""
+	Same as ``read_index()``, but the index is rebuilt if it's missing or malformed.
+	"""
+	if (entries := read_index()) is None:
+		profiles.logger.info('Building the profile index')
+		entries = rebuild_index()  # Holds the lock, like every other write
+	return entries
+
+
+@contextlib.contextmanager
+def _index_lock():
+	"""
+	Hold an exclusive lock on the index while it's written, so that updates made by
+	several processes at the same time (see ``run_batch()``) don't overwrite each other.
+	"""
+	config.profile_home.mkdir(parents=True, exist_ok=True)
+	with open(config.profile_home / f'{constants.INDEX_FILENAME}.lock', 'w') as f:
+		fcntl.flock(f, fcntl.LOCK_EX)
+		yield
+
+
+def update_index(name: str, entry: dict = None, remove: str = None):
+	"""
+	Set the index entry of the profile ``name`` to ``entry``, or to the result of ``index_entry()``.
+	If ``remove`` is specified, the entry of that profile is removed, e.g. after the profile was renamed.
+	If ``name`` is None, only ``remove`` is done.
+	"""
+	with _index_lock():
+		if (entries := read_index()) is None:
+			# The updated profile is included when the index is rebuilt
+			_rebuild_index()
+			return
+		if remove is not None:
+			entries.pop(remove, None)
+		if name is not None:
+			if (entry := entry or index_entry(name)) is None:
+				entries.pop(name, None)
+			else:
+				entries[name] = entry
+		_write_index(entries)
@@ -1,17 +1,54 @@
 import shutil
-import subprocess
-import time
 from pathlib import Path
+from typing import List, Tuple
 
 from konfsave import constants
 from konfsave import config
 from konfsave import profiles
+from konfsave import tracing
 
 
-def load(name, include=None, exclude=None, overwrite_unsaved_configuration=False, restart=True) -> bool:
+def load_plan(name, include=None, exclude=None, snapshot=None) -> List[Tuple[str, dict]]:
+	"""
+	Return the files that loading the profile would write, as (relative path, manifest entry) pairs.
+	Files in the home directory which are already identical to the saved ones are left out.
+	If ``snapshot`` is specified, the files are taken from that snapshot (see ``resolve_snapshot()``)
+	instead of the profile's latest state.
+	The name is not validated in this function.
+	"""
+	profile_root = config.profile_home / name
+	return _plan(profile_root, _manifest(profile_root, snapshot), include, exclude)
+
+
+def _manifest(profile_root, snapshot=None) -> dict:
+	if snapshot is None:
+		return profiles.load_manifest(profile_root)
+	return profiles.resolve_snapshot(profile_root, snapshot)
+
+
+def _plan(profile_root, manifest, include, exclude) -> List[Tuple[str, dict]]:
+	backend = profiles.get_backend(manifest['storage'])
+	selected = profiles.path_selector(include, exclude)
+	relpaths = [relpath for relpath in manifest['files'] if selected(Path.home() / relpath)]
+	matches = profiles.run_parallel(
+		lambda relpath: backend.matches(profile_root, relpath, manifest['files'][relpath], Path.home() / relpath),
+		relpaths
+	)
+	plan = [(relpath, manifest['files'][relpath]) for relpath, match in zip(relpaths, matches) if not match]
+	unchanged = len(relpaths) - len(plan)
+	profiles.logger.info(f'{unchanged} files are already identical to the saved ones')
+	return plan
+
+
+def load(name, include=None, exclude=None, overwrite_unsaved_configuration=False, restart=True, snapshot=None) -> bool:
 	"""
 	The name is not validated in this function.
 	True is returned if the user canceled the action.
+	Only files that differ from those in the home directory are written; see ``load_plan()``.
+	If ``snapshot`` is specified, that snapshot of the profile is loaded; SnapshotNotFoundError
+	is raised before anything is changed if it doesn't exist.
+	If ``restart`` is True, running programs which are affected by the written files
+	(e.g. the Plasma shell) are restarted; see ``plan_restart()``.
 	
 	The KDE configuration will be overwritten if:
 		* ``overwrite_unsaved_configuration`` is True
@@ -21,6 +58,8 @@ def load(name, include=None, exclude=None, overwrite_unsaved_configuration=False
 		* The user manually confirmed that they want to overwrite their configuration
 	"""
 	profile_root = config.profile_home / name
+	# Find the snapshot before anything is changed, since it might not exist
+	manifest = None if snapshot is None else profiles.resolve_snapshot(profile_root, snapshot)
 	if overwrite_unsaved_configuration is not True:  # Be really sure that overwriting is intentional
 		# If the checks below fail, exit the function.
 		try:
@@ -48,56 +87,28 @@ def load(name, include=None, exclude=None, overwrite_unsaved_configuration=False
 		except Exception as e:
 			profiles.logger.error('Refusing to overwrite unsaved configuration due to an error')
 			raise
+	if manifest is None:
+		manifest = profiles.load_manifest(profile_root)
+	backend = profiles.get_backend(manifest['storage'])
+	with tracing.span('load.plan', files=len(manifest['files'])):
+		plan = dict(_plan(profile_root, manifest, include, exclude))
+	components = []
 	if restart:
-		restart_list = []
-		subprocess.run(
-			['kquitapp5', 'plasmashell'],
-			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-		)
-		try:
-			# Check if Latte Dock is running
-			subprocess.run(
-				['ps', '-C', 'latte-dock'],
-				check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-			)
-		except subprocess.CalledProcessError:
-			profiles.logger.info('No running instance of Latte detected')
-		else:
-			subprocess.run(['kquitapp5', 'lattedock'])
-			restart_list.append('latte-dock')
+		components = profiles.plan_restart(plan)
+		profiles.logger.info(f'Restarting: {", ".join(c.name for c in components) or "nothing"}')
+		profiles.stop_components(components)
+		# Stopped programs may have written their config while exiting
+		if any(c.stop for c in components):
+			plan = dict(_plan(profile_root, manifest, include, exclude))
 	config.current_profile_path.unlink(missing_ok=True)
-	for path in map(
-		lambda p: Path(p).relative_to(Path.home()),
-		profiles.paths_to_save(include, exclude)
-	):
-		source = profile_root / path
-		if source.exists():
-			profiles.copy_path(source, Path.home() / path)
-		else:
-			profiles.logger.info(f'The file {source} doesn\'t exist. Skipping\n')
+
+	def restore(relpath):
+		profiles.logger.info(f'Copying {relpath}')
+		backend.restore(profile_root, relpath, plan[relpath], Path.home() / relpath)
+	with tracing.span('load.restore', files=len(plan)) as span:
+		profiles.make_directories(Path.home() / relpath for relpath in plan)
+		profiles.run_parallel(restore, plan)
+		if span:
+			span.add(bytes=sum(entry['size'] for entry in plan.values() if 'link' not in entry))
 	shutil.copyfile(profile_root / config.profile_info_filename, config.current_profile_path)
-	if restart:
-		subprocess.run(
-			['kstart5', 'plasmashell'],
-			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-		)
-		try:
-			# Check if Kwin is running
-			subprocess.run(
-				['ps', '-C', 'kwin_x11'],
-				check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-			)
-		except subprocess.CalledProcessError:
-			profiles.logger.info('No running instance of KWin detected')
-		else:
-			# If so, reload Kwin
-			subprocess.run(
-				['dbus-send', '--session', '--dest=org.kde.KWin', '/KWin', 'org.kde.KWin.reloadConfig'],
-				stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-			)
-		if 'latte-dock' in restart_list:
-			time.sleep(3)  # Allow KWin to completely restart
-			subprocess.run(
-				['kstart5', 'latte-dock'],
-				stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-			) 
+	profiles.start_components(components)
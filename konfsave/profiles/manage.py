@@ -1,5 +1,4 @@
 import json
-import shutil
 from pathlib import Path
 from typing import Union, Iterable
 
@@ -31,8 +30,12 @@ def change(results, profile=None):
 			f.write(json.dumps(new_info))
 	if 'name' in results:
 		rename(profile, results['name'], change_info=False)  # Avoid writing to the file twice
-	with open(config.profile_home / new_info['name'] / config.profile_info_filename, 'w') as f:
+	profile_dir = config.profile_home / new_info['name']
+	with open(profile_dir / config.profile_info_filename, 'w') as f:
 		f.write(json.dumps(new_info))  # Write only after JSON serialization is successful
+	manifest = profiles.load_manifest(profile_dir)
+	profiles.get_backend(manifest['storage']).commit(profile_dir, manifest['files'], 'Change attributes')
+	profiles.update_index(new_info['name'], remove=profile if 'name' in results else None)
 		
 		
 def rename(source, result, change_info=True):
@@ -46,11 +49,16 @@ def rename(source, result, change_info=True):
 	if not (config.profile_home / source).exists():
 		raise RuntimeError(f'The profile "{source}" doesn\'t exist.')
 	if change_info:
-		info = profiles.profile_info(source)
+		info = profiles.profile_info(source, use_cache=False)
 		info.update({'name': result})
 		with open(config.profile_home / source / config.profile_info_filename, 'w') as f:
-			f.write(json.dumps(new_info))  # Write only after JSON serialization is successful
-	(config.profile_home / source).rename(config.profile_home / result)
+			f.write(json.dumps(info))  # Write only after JSON serialization is successful
+	manifest = profiles.load_manifest(config.profile_home / source)
+	backend = profiles.get_backend(manifest['storage'])
+	backend.rename(config.profile_home / source, config.profile_home / result)
+	if change_info:
+		backend.commit(config.profile_home / result, manifest['files'], f'Rename from "{source}"')
+		profiles.update_index(result, remove=source)
 
 
 def delete(profile: Union[str, Iterable[str]], clear_active=True, confirm=True) -> bool:
@@ -89,5 +97,12 @@ def delete(profile: Union[str, Iterable[str]], clear_active=True, confirm=True)
 			return True
 	if clear_active and profile == profiles.current_profile():
 		config.current_profile_path.unlink(missing_ok=True)
-	shutil.rmtree(config.profile_home / profile)
+	profile_dir = config.profile_home / profile
+	backend = profiles.get_backend(profiles.load_manifest(profile_dir)['storage'])
+	# Snapshots are always stored as objects
+	uses_objects = backend.name == profiles.ObjectStorage.name or profiles.history_dir(profile_dir).exists()
+	backend.remove(profile_dir)
+	if uses_objects:
+		profiles.collect_garbage()
+	profiles.update_index(None, remove=profile)
 	print(f'Deleted profile "{profile}"')
@@ -0,0 +1,216 @@
+import os
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Set
+
+from konfsave import config
+from konfsave import profiles
+from konfsave import tracing
+
+# How long to wait for a restarted component to become ready, in seconds
+READY_TIMEOUT = 10
+# How often to check whether a component is ready, in seconds
+READY_INTERVAL = 0.05
+
+
+class Component:
+	"""
+	A running program which has to be restarted or reloaded to apply loaded files.
+
+	The component is affected by a load if any of the written files belongs to one of ``groups``
+	(see ``config.groups.groups_containing()``). It's only restarted if one of ``processes``
+	is running. ``stop`` is run before the files are written, and ``start`` after that;
+	either can be None, e.g. for programs which only need to reload their config.
+	If ``bus_name`` is specified, the component is ready once that name appears on the
+	session D-Bus; components listed in ``after`` are started only after this one is ready.
+	Commands are looked up in $PATH, so they can be replaced by stubs for testing.
+	"""
+	def __init__(
+		self, name: str, processes: Sequence[str], groups: Iterable[str],
+		stop: Sequence[str] = None, start: Sequence[str] = None,
+		bus_name: str = None, after: Iterable[str] = ()
+	):
+		self.name = name
+		self.processes = tuple(processes)
+		self.groups = frozenset(groups)
+		self.stop = stop
+		self.start = start
+		self.bus_name = bus_name
+		self.after = tuple(after)
+
+	def __repr__(self):
+		return f'<Component {self.name}>'
+
+
+_components: Dict[str, Component] = {}
+
+
+def register_component(component: Component):
+	"""
+	Make ``load()`` restart ``component`` when files in its groups are loaded.
+	A previously registered component with the same name is replaced.
+	"""
+	_components[component.name] = component
+
+
+def get_component(name: str) -> Component:
+	return _components[name]
+
+
+def running_processes(proc: str = '/proc') -> Set[str]:
+	"""
+	Return the names of all processes that the user can see, by reading ``proc``.
+	Both the kernel's name for the process (which is truncated to 15 characters)
+	and the name of its executable are included.
+	"""
+	names = set()
+	for pid in os.listdir(proc):
+		if not pid.isdigit():
+			continue
+		try:
+			with open(f'{proc}/{pid}/comm') as f:
+				names.add(f.read().rstrip('\n'))
+			with open(f'{proc}/{pid}/cmdline', 'rb') as f:
+				argv0 = f.read().split(b'\0', 1)[0]
+		except OSError:
+			continue  # The process has exited
+		if argv0:
+			names.add(os.path.basename(os.fsdecode(argv0)))
+	return names
+
+
+def plan_restart(relpaths: Iterable[str], processes: Set[str] = None) -> List[Component]:
+	"""
+	Return the running components which are affected by writing ``relpaths``
+	(paths relative to the home directory). Files which don't belong to any group
+	could affect anything, so they cause every running component to be restarted.
+	``processes`` is the result of ``running_processes()``, which is called if it's None.
+	"""
+	if processes is None:
+		processes = running_processes()
+	running = [c for c in _components.values() if processes.intersection(c.processes)]
+	affected = []
+	groups = set()
+	for relpath in relpaths:
+		containing = config.groups.groups_containing(Path.home() / relpath)
+		if not containing:
+			profiles.logger.info(f'{relpath} doesn\'t belong to any group, so every running component is restarted')
+			return running
+		groups.update(*containing.values())
+	for component in running:
+		if component.groups & groups:
+			affected.append(component)
+		else:
+			profiles.logger.info(f'Not restarting {component.name}, since none of its files have changed')
+	return affected
+
+
+def run_command(command: Sequence[str], **kwargs):
+	"""
+	Run ``command`` without showing its output, and return the finished process,
+	or None if the command couldn't be run. Failures are logged, but not raised.
+	"""
+	kwargs.setdefault('stdout', subprocess.DEVNULL)
+	kwargs.setdefault('stderr', subprocess.DEVNULL)
+	with tracing.span(f'restart: {command[0]}', command=' '.join(command)):
+		try:
+			process = subprocess.run(command, **kwargs)
+		except OSError as e:
+			profiles.logger.warning(f'Couldn\'t run {command[0]}: {e}')
+			return None
+	if process.returncode:
+		profiles.logger.info(f'{" ".join(command)} exited with status {process.returncode}')
+	return process
+
+
+def bus_name_has_owner(bus_name: str) -> Optional[bool]:
+	"""
+	Check whether a program has claimed ``bus_name`` on the session D-Bus.
+	None is returned if D-Bus can't be queried.
+	"""
+	process = run_command(
+		[
+			'dbus-send', '--session', '--print-reply', '--dest=org.freedesktop.DBus', '/org/freedesktop/DBus',
+			'org.freedesktop.DBus.NameHasOwner', f'string:{bus_name}'
+		],
+		stdout=subprocess.PIPE, text=True
+	)
+	if process is None or process.returncode:
+		return None
+	return 'boolean true' in process.stdout
+
+
+def wait_for_bus_name(bus_name: str, timeout: float = READY_TIMEOUT) -> bool:
+	"""
+	Wait until ``bus_name`` appears on the session D-Bus and return whether it did within ``timeout`` seconds.
+	If D-Bus can't be queried, True is returned immediately.
+	"""
+	deadline = time.monotonic() + timeout
+	with tracing.span(f'restart: wait for {bus_name}'):
+		while (owned := bus_name_has_owner(bus_name)) is False:
+			if time.monotonic() >= deadline:
+				profiles.logger.warning(f'{bus_name} didn\'t appear on D-Bus within {timeout} seconds')
+				return False
+			time.sleep(READY_INTERVAL)
+	if owned is None:
+		profiles.logger.info(f'Couldn\'t query D-Bus, so not waiting for {bus_name}')
+	return True
+
+
+def _run_concurrently(fn, components: List[Component]):
+	if not components:
+		return
+	import concurrent.futures
+	with concurrent.futures.ThreadPoolExecutor(max_workers=len(components)) as executor:
+		for future in [executor.submit(config.bind(fn), component) for component in components]:
+			future.result()
+
+
+def stop_components(components: List[Component]):
+	"""
+	Stop all ``components`` at the same time, and wait until their stop commands finish.
+	"""
+	_run_concurrently(lambda c: c.stop and run_command(c.stop), components)
+
+
+def start_components(components: List[Component], timeout: float = READY_TIMEOUT):
+	"""
+	Start or reload all ``components`` at the same time, except that a component waits
+	for the components listed in its ``after`` to become ready (for at most ``timeout`` seconds).
+	Returns once every component is ready or ``timeout`` has passed.
+	"""
+	ready = {component.name: threading.Event() for component in components}
+
+	def start(component):
+		try:
+			for name in component.after:
+				if name in ready and not ready[name].wait(timeout):
+					profiles.logger.warning(f'Starting {component.name} without waiting for {name}')
+			if component.start:
+				run_command(component.start)
+			if component.bus_name:
+				wait_for_bus_name(component.bus_name, timeout)
+		finally:
+			ready[component.name].set()
+	_run_concurrently(start, components)
+
+
+# The KDE components which the loaded files may affect
+register_component(Component(
+	'plasmashell', ('plasmashell',),
+	(':appearance', ':workspace', ':desktop-applets', ':personalization', ':kde-other'),
+	stop=['kquitapp5', 'plasmashell'], start=['kstart5', 'plasmashell'], bus_name='org.kde.plasmashell'
+))
+register_component(Component(
+	'kwin', ('kwin_x11', 'kwin_wayland'),
+	(':global-theme', ':application-style', ':desktop-behavior', ':window-management', ':aurorae'),
+	start=['dbus-send', '--session', '--dest=org.kde.KWin', '/KWin', 'org.kde.KWin.reloadConfig'],
+	bus_name='org.kde.KWin'
+))
+register_component(Component(
+	'latte-dock', ('latte-dock',), (':latte-dock', ':appearance'),
+	stop=['kquitapp5', 'lattedock'], start=['kstart5', 'latte-dock'], bus_name='org.kde.lattedock',
+	after=('kwin',)
+))
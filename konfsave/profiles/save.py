@@ -1,17 +1,29 @@
 import json
+import os
+import time
 from pathlib import Path
+from typing import Dict
 
 from konfsave import config
 from konfsave import profiles
+from konfsave import tracing
 
 
-def save(name=None, include=None, exclude=None, follow_symlinks=False, destination=None):
+def save(name=None, include=None, exclude=None, follow_symlinks=False, destination=None) -> Dict[str, int]:
 	"""
 	The name is not validated in this function.
 	
 	If ``name`` is unspecified, the current profile's name is used.
 	Otherwise, the current profile will be switched to the result.
 	``include`` and ``exclude`` must be given in the same format as to ``paths_to_save()``.
+	
+	Files that haven't changed since the profile was last saved (according to their size,
+	modification time, inode, and mode) are not copied again. The return value contains
+	the number of files that were "added", "changed", and "unchanged".
+	If ``watch()`` is running, only the files that it reported as changed are checked;
+	see ``journaled_paths()``. Otherwise, every selected file is checked.
+	Unless ``destination`` is specified, a snapshot of the result is also created if
+	``config.history`` is enabled; see ``create_snapshot()``.
 	"""
 	info = profiles.profile_info(name, convert_values=False)
 	if name is None:
@@ -24,13 +36,57 @@ def save(name=None, include=None, exclude=None, follow_symlinks=False, destinati
 			name = info['name']
 	profile_dir = (config.profile_home / name) if destination is None else destination
 	profile_dir.mkdir(parents=True, exist_ok=True)
-	for path in map(Path, profiles.paths_to_save(include, exclude)):
-		if not path.exists():
-			profiles.logger.info(f'The path {path} doesn\'t exist. Skipping')
-		elif not path.is_relative_to(Path.home()):
-			profiles.logger.warning(f'The path {path} is not within the user\'s home directory. Skipping')
-		else:
-			profiles.copy_path(path, profile_dir / path.relative_to(Path.home()), follow_symlinks=follow_symlinks)
+	# Profiles saved to a custom destination must be self-contained
+	backend = profiles.get_backend(None if destination is None else profiles.DirectoryStorage.name)
+	manifest = profiles.convert_profile(profile_dir, profiles.load_manifest(profile_dir), backend.name)
+	# Files which are already saved but aren't selected this time are kept, like in earlier versions
+	files = manifest['files']
+	# Files modified during the previous save may have changed without changing their signature
+	previous_save = manifest.get('saved_ns', 0)
+	started = time.time_ns()
+	result = {'added': 0, 'changed': 0, 'unchanged': 0}
+	# If a watcher has been running since the last full save, only the files it saw changing need to be checked
+	default_selection = not (include or exclude or follow_symlinks) and destination is None
+	journal = profiles.read_journal() if default_selection else None
+	changed_paths = profiles.journaled_paths(journal, manifest.get('journal_ns'))
+	# The next save can use the journal if it starts before the changes that this save doesn't see.
+	# Scanning sees every change made before ``started``, but the journal may not list changes made
+	# shortly before ``started`` yet, since it's written periodically.
+	journal_ns = started if default_selection else None
+	sources = {}
+	if changed_paths is not None:
+		journal_ns = journal['updated_ns']
+		profiles.logger.info(f'Checking {len(changed_paths)} files changed according to the watcher')
+		with tracing.span('save.journal', files=len(changed_paths)):
+			selected = profiles.path_selector()
+			for relpath in sorted(changed_paths):
+				path = Path.home() / relpath
+				if selected(path) and os.path.lexists(path) and not path.is_dir():
+					sources[relpath] = path
+	else:
+		for path in profiles.paths_to_save(include, exclude, follow_symlinks=follow_symlinks):
+			if (relpath := profiles.home_relative(path)) is None:
+				profiles.logger.warning(f'The path {path} is not within the user\'s home directory. Skipping')
+			else:
+				sources[relpath] = path
+
+	def save_file(relpath):
+		path = sources[relpath]
+		entry = files.get(relpath)
+		if entry and entry['mtime_ns'] < previous_save \
+			and profiles.same_signature(entry, os.stat(path, follow_symlinks=follow_symlinks)) \
+			and backend.is_stored(profile_dir, relpath, entry):
+			return entry, 'unchanged'
+		return backend.store(profile_dir, relpath, path, follow_symlinks=follow_symlinks), \
+			'changed' if entry else 'added'
+	with tracing.span('save.store', files=len(sources)) as span:
+		backend.prepare(profile_dir, sources)
+		for relpath, (entry, status) in zip(sources, profiles.run_parallel(save_file, sources)):
+			files[relpath] = entry
+			result[status] += 1
+			if span and status != 'unchanged' and 'link' not in entry:
+				span.add(bytes=entry['size'])
+	profiles.write_manifest(profile_dir, backend.name, files, saved_ns=started, journal_ns=journal_ns)
 	new_info = {
 		'name': name,
 		'author': info['author'] if info else None,
@@ -40,4 +96,17 @@ def save(name=None, include=None, exclude=None, follow_symlinks=False, destinati
 	with open(profile_dir / config.profile_info_filename, 'w') as f:
 		f.write(json.dumps(new_info))  # Write only after JSON serialization is successful
 	with open(config.current_profile_path, 'w') as f:
-		f.write(json.dumps(new_info))  # Write only after JSON serialization is successful 
+		f.write(json.dumps(new_info))  # Write only after JSON serialization is successful
+	backend.commit(profile_dir, files, f'Save "{name}"')
+	if destination is None:
+		manifest = {'storage': backend.name, 'files': files, 'saved_ns': started}
+		profiles.update_index(name, profiles.index_entry(name, new_info, manifest))
+		if config.history:
+			try:
+				with tracing.span('save.snapshot'):
+					profiles.create_snapshot(profile_dir, manifest, new_info)
+					profiles.prune_history(profile_dir)
+			except (profiles.CopyError, OSError) as e:
+				# The profile itself is already saved
+				profiles.logger.error(f'Couldn\'t create a snapshot of "{name}": {e}')
+	return result
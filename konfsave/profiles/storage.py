@@ -0,0 +1,367 @@
+import filecmp
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from konfsave import config
+from konfsave import constants
+from konfsave import profiles
+
+# Every profile directory contains a manifest, which maps the paths of saved files
+# (relative to the home directory, in POSIX format) to entries describing them.
+# Each entry contains the file's "mode", "size", "mtime_ns", and "ino" at the time of saving,
+# which together are used to detect whether the file has changed since then.
+# Symlinks additionally contain "link" (the link's target), and files stored by
+# content or saved with ``config.hash_files`` contain "digest" (the SHA-256 hex digest of their contents).
+# Files in Git storage contain "oid" (the ID of the Git blob that holds their contents) instead.
+# The manifest also records when the profile was last saved as "saved_ns".
+MANIFEST_VERSION = 1
+
+
+def file_digest(path) -> str:
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		while chunk := f.read(1 << 20):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+def object_path(digest: str) -> Path:
+	return config.object_store / digest[:2] / digest[2:]
+
+
+def stat_entry(st: os.stat_result, **extra) -> dict:
+	"""
+	Return the manifest entry of a file described by ``st``. Storage backends add
+	where its contents are stored (e.g. ``digest`` or ``link``) as ``extra``.
+	"""
+	return {'mode': st.st_mode, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'ino': st.st_ino, **extra}
+
+
+def same_signature(entry: dict, st: os.stat_result) -> bool:
+	"""
+	Check whether ``st`` describes the same file as the one that ``entry`` was made from.
+	"""
+	return (entry['mode'], entry['size'], entry['mtime_ns'], entry.get('ino')) \
+		== (st.st_mode, st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+class DirectoryStorage:
+	"""
+	Files are stored as plain copies within the profile's directory.
+	This is how all profiles were stored before other backends were introduced.
+	"""
+	name = 'directory'
+
+	def prepare(self, profile_dir: Path, relpaths: Iterable[str]):
+		"""
+		Create directories needed to store ``relpaths`` before they're stored in parallel.
+		"""
+		profiles.make_directories(profile_dir / relpath for relpath in relpaths)
+
+	def store(self, profile_dir: Path, relpath: str, source: Path, follow_symlinks=False) -> dict:
+		"""
+		Save ``source`` as ``relpath`` within the profile and return its manifest entry.
+		``prepare()`` must be called beforehand.
+		"""
+		destination = profile_dir / relpath
+		st = os.stat(source, follow_symlinks=follow_symlinks)
+		if stat.S_ISLNK(st.st_mode):
+			entry = stat_entry(st, link=os.readlink(source))
+			self.store_link(profile_dir, relpath, entry)
+			return entry
+		if destination.is_symlink():
+			destination.unlink()  # Don't write through a symlink that was saved previously
+		profiles.logger.info(f'Copying {source}')
+		profiles.copy_file(source, destination, hardlink=True)
+		os.utime(destination, ns=(st.st_atime_ns, st.st_mtime_ns))
+		if config.hash_files:
+			return stat_entry(st, digest=file_digest(destination))
+		return stat_entry(st)
+
+	def store_link(self, profile_dir: Path, relpath: str, entry: dict):
+		"""
+		Store the symlink described by ``entry``.
+		"""
+		destination = profile_dir / relpath
+		if destination.is_symlink() or destination.exists():
+			destination.unlink()
+		os.symlink(entry['link'], destination)
+
+	def is_stored(self, profile_dir: Path, relpath: str, entry: dict) -> bool:
+		"""
+		Check whether the contents described by ``entry`` are still present in the storage.
+		"""
+		if 'link' in entry:
+			return (profile_dir / relpath).is_symlink()
+		return (profile_dir / relpath).is_file()
+
+	def path(self, profile_dir: Path, relpath: str, entry: dict) -> Path:
+		"""
+		Return the path from which the contents of a stored file can be read.
+		"""
+		return profile_dir / relpath
+
+	def restore(self, profile_dir: Path, relpath: str, entry: dict, destination: Path):
+		"""
+		Write a stored file to ``destination``. Its parent directory must already exist.
+		"""
+		if 'link' in entry:
+			if destination.is_symlink() or destination.exists():
+				destination.unlink()
+			os.symlink(entry['link'], destination)
+		else:
+			profiles.copy_file(self.path(profile_dir, relpath, entry), destination)
+			os.chmod(destination, stat.S_IMODE(entry['mode']))
+			# Keep the saved modification time, so that ``matches()`` can avoid reading the file next time
+			os.utime(destination, ns=(entry['mtime_ns'], entry['mtime_ns']))
+
+	def matches(self, profile_dir: Path, relpath: str, entry: dict, destination: Path) -> bool:
+		"""
+		Check whether ``destination`` already has the same contents as the stored file.
+		Files with a different size or permissions never match; files with the same
+		modification time are assumed to match; otherwise, the contents are compared.
+		"""
+		try:
+			if 'link' in entry:
+				return os.readlink(destination) == entry['link']
+			st = destination.stat()
+		except OSError:
+			return False
+		if not stat.S_ISREG(st.st_mode) or st.st_size != entry['size'] \
+			or stat.S_IMODE(st.st_mode) != stat.S_IMODE(entry['mode']):
+			return False
+		if st.st_mtime_ns == entry['mtime_ns']:
+			return True
+		return self._same_contents(profile_dir, relpath, entry, destination)
+
+	def _same_contents(self, profile_dir: Path, relpath: str, entry: dict, destination: Path) -> bool:
+		if 'digest' in entry:
+			return file_digest(destination) == entry['digest']
+		return filecmp.cmp(self.path(profile_dir, relpath, entry), destination, shallow=False)
+
+	def commit(self, profile_dir: Path, files: Dict[str, dict], message: str):
+		"""
+		Called after the profile's manifest and info have been written, with the manifest's files.
+		Backends which keep their own record of the profile's state update it here.
+		"""
+		pass
+
+	def rename(self, profile_dir: Path, new_profile_dir: Path):
+		profile_dir.rename(new_profile_dir)
+
+	def clear(self, profile_dir: Path):
+		"""
+		Remove all stored files, but keep the profile's info and manifest.
+		"""
+		for child in profile_dir.iterdir():
+			if child.name in (config.profile_info_filename, constants.MANIFEST_FILENAME, constants.HISTORY_DIRNAME):
+				continue
+			if child.is_dir() and not child.is_symlink():
+				shutil.rmtree(child)
+			else:
+				child.unlink()
+
+	def remove(self, profile_dir: Path):
+		shutil.rmtree(profile_dir)
+
+
+class ObjectStorage(DirectoryStorage):
+	"""
+	Files are stored by content in ``config.object_store``, so each unique file is stored
+	only once regardless of how many profiles contain it. The profile's directory
+	contains only its info and manifest.
+	"""
+	name = 'objects'
+
+	def prepare(self, profile_dir: Path, relpaths: Iterable[str]):
+		config.object_store.mkdir(parents=True, exist_ok=True)
+
+	def store(self, profile_dir: Path, relpath: str, source: Path, follow_symlinks=False) -> dict:
+		st = os.stat(source, follow_symlinks=follow_symlinks)
+		if stat.S_ISLNK(st.st_mode):
+			return stat_entry(st, link=os.readlink(source))
+		digest = file_digest(source)
+		if not object_path(digest).exists():
+			profiles.logger.info(f'Storing {source}')
+			digest = store_object(source)
+		return stat_entry(st, digest=digest)
+
+	def store_link(self, profile_dir: Path, relpath: str, entry: dict):
+		pass  # The manifest entry is all that's needed
+
+	def is_stored(self, profile_dir: Path, relpath: str, entry: dict) -> bool:
+		return 'link' in entry or object_path(entry['digest']).exists()
+
+	def path(self, profile_dir: Path, relpath: str, entry: dict) -> Path:
+		return object_path(entry['digest'])
+
+	def clear(self, profile_dir: Path):
+		pass  # Objects may be shared, so they're only removed by ``collect_garbage()``
+
+	def remove(self, profile_dir: Path):
+		shutil.rmtree(profile_dir)  # Objects are removed by ``collect_garbage()`` afterwards
+
+
+_BACKENDS = {backend.name: backend for backend in (DirectoryStorage(), ObjectStorage())}
+
+
+def register_backend(backend):
+	"""
+	Make a storage backend available under its ``name``. Backends which depend on
+	optional features are registered by their own modules.
+	"""
+	_BACKENDS[backend.name] = backend
+
+
+def get_backend(name: str = None):
+	"""
+	Return the storage backend called ``name``, or the one configured for new profiles.
+	"""
+	name = name or config.storage
+	if name not in _BACKENDS and name in constants.STORAGE_BACKENDS:
+		# Backends which depend on optional features are registered when their modules are imported
+		getattr(profiles, name)
+	return _BACKENDS[name]
+
+
+def store_object(source) -> str:
+	"""
+	Copy a file into the object store and return its digest.
+	The digest is calculated from the stored copy, so the object is valid
+	even if the source changes in the meantime. Objects are never hard linked to their source,
+	since they're shared by every profile and snapshot which contains the same contents.
+	"""
+	config.object_store.mkdir(parents=True, exist_ok=True)
+	fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=config.object_store)
+	os.close(fd)
+	try:
+		profiles.copy_file(source, tmp)
+		digest = file_digest(tmp)
+		destination = object_path(digest)
+		destination.parent.mkdir(exist_ok=True)
+		os.replace(tmp, destination)
+	except BaseException:
+		os.unlink(tmp)
+		raise
+	return digest
+
+
+def read_manifest(profile_dir: Path) -> Optional[dict]:
+	"""
+	Return the profile's manifest, or None if it's missing or malformed.
+	"""
+	try:
+		with open(profile_dir / constants.MANIFEST_FILENAME) as f:
+			manifest = json.load(f)
+		assert manifest['storage'] in constants.STORAGE_BACKENDS
+		assert isinstance(manifest['files'], dict)
+		return manifest
+	except FileNotFoundError:
+		return None
+	except (json.JSONDecodeError, KeyError, AssertionError) as e:
+		profiles.logger.warning(f'Malformed manifest at {profile_dir / constants.MANIFEST_FILENAME}\n{str(e)}\n')
+		return None
+
+
+def load_manifest(profile_dir: Path) -> dict:
+	"""
+	Same as ``read_manifest()``, but if the profile has no valid manifest,
+	one is created on the fly by scanning the profile's directory.
+	This is the case for profiles saved by older versions, or extracted from archives.
+	"""
+	if (manifest := read_manifest(profile_dir)) is not None:
+		return manifest
+	files = {}
+	for path in profile_dir.glob('**/*'):
+		relpath = path.relative_to(profile_dir).as_posix()
+		if relpath in (config.profile_info_filename, constants.MANIFEST_FILENAME) \
+			or relpath.split('/', 1)[0] == constants.HISTORY_DIRNAME:
+			continue
+		st = path.lstat()
+		if stat.S_ISLNK(st.st_mode):
+			files[relpath] = stat_entry(st, link=os.readlink(path))
+		elif stat.S_ISREG(st.st_mode):
+			files[relpath] = stat_entry(st)
+	return {'version': MANIFEST_VERSION, 'storage': DirectoryStorage.name, 'files': files}
+
+
+def write_manifest(profile_dir: Path, storage: str, files: Dict[str, dict], **fields):
+	"""
+	``fields`` are stored at the top level of the manifest, in addition to the required ones.
+	"""
+	data = json.dumps({'version': MANIFEST_VERSION, 'storage': storage, 'files': files, **fields})
+	with open(profile_dir / constants.MANIFEST_FILENAME, 'w') as f:
+		f.write(data)  # Write only after JSON serialization is successful
+
+
+def convert_profile(profile_dir: Path, manifest: dict, storage: str) -> dict:
+	"""
+	Move the contents of a profile to another storage backend.
+	The new manifest is written and returned.
+	"""
+	source = get_backend(manifest['storage'])
+	target = get_backend(storage)
+	if source is target:
+		return manifest
+	if not manifest['files'] and not (profile_dir / config.profile_info_filename).exists():
+		return {**manifest, 'storage': target.name}  # A new profile, which has nothing to convert yet
+	profiles.logger.info(f'Converting {profile_dir} from "{source.name}" to "{target.name}" storage')
+
+	def convert(relpath):
+		entry = manifest['files'][relpath]
+		if 'link' in entry:
+			target.store_link(profile_dir, relpath, entry)
+			return entry
+		stored = target.store(profile_dir, relpath, source.path(profile_dir, relpath, entry))
+		# Keep the original metadata, since it describes the file that was saved
+		# (Git blob IDs are only meaningful in Git storage)
+		return {
+			**{k: v for k, v in entry.items() if k != 'oid'},
+			**{k: v for k, v in stored.items() if k in ('digest', 'oid')}
+		}
+	target.prepare(profile_dir, manifest['files'])
+	relpaths = list(manifest['files'])
+	files = dict(zip(relpaths, profiles.run_parallel(convert, relpaths)))
+	fields = {k: v for k, v in manifest.items() if k not in ('version', 'storage', 'files')}
+	write_manifest(profile_dir, target.name, files, **fields)
+	target.commit(profile_dir, files, f'Convert from "{source.name}" storage')
+	source.clear(profile_dir)
+	return {**fields, 'version': MANIFEST_VERSION, 'storage': target.name, 'files': files}
+
+
+def collect_garbage() -> int:
+	"""
+	Delete objects that aren't referenced by any profile or snapshot and return how many were deleted.
+	If any manifest or snapshot in the profile home can't be read, nothing is deleted.
+	"""
+	if not config.object_store.exists():
+		return 0
+	referenced = set()
+	for manifest_path in config.profile_home.glob(f'*/{constants.MANIFEST_FILENAME}'):
+		if (manifest := read_manifest(manifest_path.parent)) is None:
+			profiles.logger.warning(
+				f'Not collecting garbage in {config.object_store} because {manifest_path} is malformed'
+			)
+			return 0
+		referenced.update(e['digest'] for e in manifest['files'].values() if 'digest' in e)
+	for directory in config.profile_home.glob(f'*/{constants.HISTORY_DIRNAME}'):
+		digests, complete = profiles.snapshot_digests(directory.parent)
+		if not complete:
+			profiles.logger.warning(
+				f'Not collecting garbage in {config.object_store} because a snapshot in {directory} is malformed'
+			)
+			return 0
+		referenced.update(digests)
+	removed = 0
+	for path in config.object_store.glob('*/*'):
+		if not path.name.startswith('.') and path.parent.name + path.name not in referenced:
+			path.unlink()
+			removed += 1
+	profiles.logger.info(f'Removed {removed} unreferenced objects from {config.object_store}')
+	return removed
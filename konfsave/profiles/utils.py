@@ -1,14 +1,19 @@
+import errno
+import fcntl
 import itertools
 import json
 import logging
 import os
 import shutil
+import stat
+import sys
 from pathlib import Path
-from typing import Optional, Set, Union, TextIO, Iterable
+from typing import Callable, Iterator, Optional, Set, Tuple, Union, TextIO, Iterable
 
 from konfsave import config
 from konfsave import constants
 from konfsave import profiles
+from konfsave import tracing
 
 # in addition to valid identifiers
 ADDITIONAL_PROFILE_NAME_CHARS = r'0123456789-+&()[]'
@@ -36,20 +41,106 @@ def copy_allow_samefile(*args, **kwargs):
 		pass
 
 
+# ioctl request which makes a file share the data blocks of another file (Btrfs, XFS, etc.)
+_FICLONE = 0x40049409
+# Errors which mean that a copying method isn't supported for the given files
+_UNSUPPORTED = {errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP, errno.EXDEV, errno.EPERM}
+
+
+def _reflink(src, dst):
+	fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+
+
+def _copy_file_range(src, dst):
+	while os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30):
+		pass
+
+
+def _sendfile(src, dst):
+	while os.sendfile(dst.fileno(), src.fileno(), None, 1 << 30):
+		pass
+
+
+def copy_file(source, destination, strategy=None, hardlink=False):
+	"""
+	Copy the contents and permissions of a regular file. Symlinks are followed.
+	Nothing is done if ``source`` and ``destination`` are the same file.
+	
+	``strategy`` is one of ``constants.COPY_STRATEGIES`` (``config.copy_strategy`` by default):
+		auto - use reflinks if the filesystem supports them, otherwise copy in the kernel
+			using copy_file_range() or sendfile(), otherwise copy normally
+		reflink, copy_file_range - same as "auto", but start from the specified method
+		hardlink - if ``hardlink`` is True, create a hard link to ``source`` instead of copying;
+			otherwise, or if linking fails, same as "auto"
+		copy - read and write the file's contents in Python
+	The "hardlink" strategy should only be allowed when writing into a profile's own directory
+	(i.e. the "directory" storage backend), since the stored file will change whenever the original
+	is modified in place. It must never be used for the object store, whose files are shared by digest.
+	"""
+	with tracing.span('copy_file', path=str(source)) as span:
+		_copy_file(source, destination, strategy or config.copy_strategy, hardlink)
+		if span:
+			span.add(files=1, bytes=os.stat(destination).st_size)
+
+
+def _copy_file(source, destination, strategy, hardlink):
+	try:
+		if os.path.samefile(source, destination):
+			return
+	except FileNotFoundError:
+		pass
+	if strategy == 'hardlink':
+		if hardlink:
+			try:
+				os.unlink(destination)
+			except FileNotFoundError:
+				pass
+			try:
+				os.link(source, destination)
+				return
+			except OSError as e:
+				if e.errno not in _UNSUPPORTED | {errno.EMLINK}:
+					raise
+				profiles.logger.debug(f'Couldn\'t hard link {source}: {e}')
+		strategy = 'auto'
+	methods = {
+		'auto': (_reflink, _copy_file_range, _sendfile),
+		'reflink': (_reflink, _copy_file_range, _sendfile),
+		'copy_file_range': (_copy_file_range, _sendfile),
+		'copy': ()
+	}[strategy]
+	with open(source, 'rb') as src, open(destination, 'wb') as dst:
+		for method in methods:
+			try:
+				method(src, dst)
+				break
+			except (OSError, AttributeError) as e:  # AttributeError: not available on this platform
+				if isinstance(e, OSError) and e.errno not in _UNSUPPORTED:
+					raise
+				# Some methods can fail after writing a part of the file
+				src.seek(0)
+				dst.seek(0)
+				dst.truncate()
+		else:
+			shutil.copyfileobj(src, dst, 1 << 20)
+	shutil.copymode(source, destination)
+
+
 def copy_path(source, destination, overwrite=True, follow_symlinks=False):
 	profiles.logger.info(f'Copying {source}')
 	destination.parent.mkdir(parents=True, exist_ok=True)
-	if source.is_dir():
-		shutil.copytree(
-			src=source,
-			dst=destination,
-			symlinks=follow_symlinks,
-			copy_function=copy_allow_samefile,
-			dirs_exist_ok=overwrite
-		)
-	else:
-		if overwrite or not destination.exists():
-			copy_allow_samefile(source, destination, follow_symlinks=follow_symlinks)
+	with tracing.span('copy_path', path=str(source)):
+		if source.is_dir():
+			shutil.copytree(
+				src=source,
+				dst=destination,
+				symlinks=follow_symlinks,
+				copy_function=copy_allow_samefile,
+				dirs_exist_ok=overwrite
+			)
+		else:
+			if overwrite or not destination.exists():
+				copy_allow_samefile(source, destination, follow_symlinks=follow_symlinks)
 			
 			
 def current_profile():
@@ -75,23 +166,112 @@ def resolve_group(val) -> Set[Path]:
 		raise ValueError(f'The value "{val}" is not a path or a group name.')
 
 
-def expand_path(path) -> Set[Path]:
+def expand_path(path, follow_symlinks=False) -> Set[Path]:
 	"""
 	If ``path`` points to a directory, return all files within the directory (recursively).
-	Otherwise, return a set that contains ``path`` as its sole member.
+	Otherwise, return a set that contains ``path`` as its sole member if it exists.
+	"""
+	return set(_walk(Path(path), follow_symlinks=follow_symlinks))
+
+
+def home_relative(path: Path) -> Optional[str]:
+	"""
+	Return ``path`` relative to the home directory as a POSIX path, or None if it's not within it.
+	"""
+	try:
+		return Path(path).relative_to(Path.home()).as_posix()
+	except ValueError:
+		return None
+
+
+def is_within(path: Path, bases) -> bool:
+	"""
+	Check whether ``path`` is one of ``bases`` or within one of them, without resolving symlinks.
+	"""
+	return path in bases or any(parent in bases for parent in path.parents)
+
+
+def _resolve_selection(include, exclude, default_include) -> Tuple[Set[Path], Set[Path], Set[Path]]:
+	include = {*itertools.chain.from_iterable(map(resolve_group, include or ()))}
+	exclude = {*itertools.chain.from_iterable(map(resolve_group, exclude or ()))}
+	if default_include:
+		default_include = {*itertools.chain.from_iterable(map(resolve_group, default_include))}
+	else:
+		default_include = {*itertools.chain.from_iterable(map(resolve_group, config.default_paths()))}
+	return include, exclude, default_include
+
+
+def default_roots() -> Set[Path]:
 	"""
-	if path.is_dir():
-		return set(path.glob('**/*'))
-	return {path}
+	Return the paths (files or directories) which ``paths_to_save()`` selects by default,
+	i.e. those of the groups in ``config.save_list``.
+	"""
+	return _resolve_selection(None, None, None)[2]
 
 
-def paths_to_save(include=None, exclude=None, default_include=None) -> Set[Path]:
+def _walk(
+	root: Path, included=False, excepted=False, include=frozenset(), exclude=frozenset(),
+	exceptions=frozenset(), include_parents=frozenset(), follow_symlinks=False
+):
+	"""
+	Yield files within ``root``, or ``root`` itself if it's not a directory.
+	``include``, ``exclude``, and ``exceptions`` are sets of path strings, checked for every entry;
+	directories in ``exclude`` are skipped without being read. ``included`` and ``excepted``
+	describe ``root`` itself. An excepted directory is only read if something within it is
+	explicitly included, i.e. it's one of ``include_parents``.
 	"""
-	Calculate and return a set of files to save to or load from a profile.
+	try:
+		st = os.stat(root, follow_symlinks=follow_symlinks)
+	except FileNotFoundError:
+		profiles.logger.info(f'The path {root} doesn\'t exist. Skipping')
+		return
+	if not stat.S_ISDIR(st.st_mode):
+		if not excepted:
+			yield root
+		return
+	if excepted and str(root) not in include_parents:
+		return
+	stack = [(str(root), included, excepted)]
+	visited = set()  # Guards against symlink loops when following symlinks
+	while stack:
+		directory, included, excepted = stack.pop()
+		try:
+			entries = os.scandir(directory)
+		except OSError as e:
+			profiles.logger.warning(f'Couldn\'t read {directory}: {e}')
+			continue
+		with entries:
+			for entry in entries:
+				if entry.path in exclude:
+					continue
+				entry_included = included or entry.path in include
+				entry_excepted = (excepted or entry.path in exceptions) and not entry_included
+				try:
+					entry_is_dir = entry.is_dir(follow_symlinks=follow_symlinks)
+					if follow_symlinks and entry.is_symlink():
+						st = entry.stat()  # Raises FileNotFoundError if the symlink is broken
+						if entry_is_dir:
+							if (st.st_dev, st.st_ino) in visited:
+								continue
+							visited.add((st.st_dev, st.st_ino))
+				except FileNotFoundError:
+					profiles.logger.info(f'The symlink {entry.path} is broken. Skipping')
+					continue
+				if entry_is_dir:
+					if not entry_excepted or entry.path in include_parents:
+						stack.append((entry.path, entry_included, entry_excepted))
+				elif not entry_excepted:
+					yield Path(entry.path)
+
+
+def paths_to_save(include=None, exclude=None, default_include=None, follow_symlinks=False) -> Iterator[Path]:
+	"""
+	Calculate and yield the files to save to or load from a profile.
 	Paths are returned as absolute and resolved,
 	and point to the actual files in the home directory (never to directories).
-	Directories specified in ``include``, ``exclude``, and
-	``default_include`` are traversed recursively.
+	Directories specified in ``include`` and ``default_include`` are traversed recursively.
+	Each directory is only read once, and excluded directories aren't read at all.
+	If ``follow_symlinks`` is True, symlinked directories are traversed as well.
 	
 	The optional parameters ``include`` and ``exclude`` represent overrides, typically given by
 	the user as command line arguments. They will always take priority over other configuration.
@@ -102,22 +282,47 @@ def paths_to_save(include=None, exclude=None, default_include=None) -> Set[Path]
 	``include``, ``exclude``, and ``default_include`` must be given either as
 	absolute paths (os.PathLike) or groups (starting with a colon).
 	"""
-	include = {*itertools.chain.from_iterable(map(resolve_group, include or ()))}
-	include = {*itertools.chain.from_iterable(map(expand_path, include))}
-	exclude = {*itertools.chain.from_iterable(map(resolve_group, exclude or ()))}
-	exclude = {*itertools.chain.from_iterable(map(expand_path, exclude))}
-	for exception in itertools.chain.from_iterable(map(expand_path, config.exceptions)):
-		if exception not in include:
-			exclude.add(exception)
-	if default_include:
-		default_include = {*itertools.chain.from_iterable(map(resolve_group, default_include))}
-	else:
-		default_include = {*itertools.chain.from_iterable(map(resolve_group, config.default_paths()))}
-	default_include = {*itertools.chain.from_iterable(map(expand_path, default_include))}
-	return (default_include | include) - exclude
+	include, exclude, default_include = _resolve_selection(include, exclude, default_include)
+	include_strs = set(map(str, include))
+	exclude_strs = set(map(str, exclude))
+	exception_strs = set(map(str, config.exceptions))
+	include_parents = {str(parent) for path in include for parent in path.parents}
+	walked = set()
+	files = 0
+	# The span also includes the time that the caller spends between receiving paths
+	with tracing.span('paths_to_save') as span:
+		# Parents are sorted before their children, so nested roots are skipped
+		for root in sorted(default_include | include):
+			if is_within(root, walked) or is_within(root, exclude):
+				continue
+			walked.add(root)
+			included = is_within(root, include)
+			excepted = is_within(root, config.exceptions) and not included
+			for path in _walk(
+				root, included, excepted, include_strs, exclude_strs, exception_strs, include_parents, follow_symlinks
+			):
+				files += 1
+				yield path
+		span.add(files=files)
+
+
+def path_selector(include=None, exclude=None, default_include=None) -> Callable[[Path], bool]:
+	"""
+	Return a function which checks whether a path is selected by ``paths_to_save()``
+	given the same arguments. Unlike ``paths_to_save()``, this doesn't traverse any directories,
+	and the checked path doesn't have to exist. This is useful to filter files which are
+	already listed elsewhere, e.g. in a profile's manifest.
+	Checked paths must be absolute and resolved.
+	"""
+	include, exclude, default_include = _resolve_selection(include, exclude, default_include)
+	roots = default_include | include
+	exceptions = set(config.exceptions)
 
+	def selector(path: Path) -> bool:
+		return is_within(path, roots) and not is_within(path, exclude) \
+			and not (is_within(path, exceptions) and not is_within(path, include))
+	return selector
 
-_profile_info_cache = {}
 
 def profile_info(profile_name=None, convert_values=True, use_cache=True) -> Optional[dict]:
 	"""
@@ -125,9 +330,11 @@ def profile_info(profile_name=None, convert_values=True, use_cache=True) -> Opti
 	
 	When no argument is supplied, this will read ``config.current_profile_path``.
 	The return value is ``None`` if the JSON file is missing or malformed.
+	Parsed files are cached in the active config, see ``config.Config``.
 	"""
-	if use_cache and profile_name in _profile_info_cache:
-		return _profile_info_cache[profile_name]
+	cache = config.profile_info_cache
+	if use_cache and profile_name in cache:
+		return cache[profile_name]
 	if profile_name and not validate_profile_name(profile_name, exit_if_invalid=False):
 		profiles.logger.warning(f'"f{profile_info}" is an invalid profile name\n')
 	try:
@@ -136,7 +343,7 @@ def profile_info(profile_name=None, convert_values=True, use_cache=True) -> Opti
 				if profile_name else config.current_profile_path, convert_values=convert_values
 		)
 		if use_cache and info:
-			_profile_info_cache[profile_name] = info
+			cache[profile_name] = info
 			return info.copy()
 		return info
 	except FileNotFoundError:
@@ -154,7 +361,7 @@ def parse_profile_info(profile_info_file: Union[TextIO, os.PathLike], convert_va
 		info = json.load(f)
 		if close_later:
 			f.close()
-		assert info['name'].isidentifier()
+		assert validate_profile_name(info['name'], exit_if_invalid=False)
 		info['author'] = info.get('author', None)
 		info['description'] = info.get('description', None)
 		info['groups'] = info.get('groups', None)
@@ -0,0 +1,372 @@
+import errno
+import json
+import os
+import select
+import signal
+import struct
+import time
+from pathlib import Path
+from typing import Dict, Optional, Set
+
+from konfsave import config
+from konfsave import constants
+from konfsave import profiles
+
+# The journal lists the files which were changed while ``watch()`` was running,
+# so that ``save()`` only has to look at those files instead of every file that it saves.
+# It contains the watcher's "pid", "started_ns" (when it started watching), "updated_ns"
+# (when the journal was last written), "selection" (see ``_selection()``), "overflow_ns"
+# (when inotify last dropped events, or null), "incomplete" (whether some directories
+# couldn't be watched), and "paths", which maps paths relative to the home directory
+# to the time of their last change.
+JOURNAL_VERSION = 1
+
+# inotify(7) constants
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_EXCL_UNLINK = 0x4000000
+IN_ISDIR = 0x40000000
+_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+	| IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+_EVENT = struct.Struct('iIII')
+
+
+class _Inotify:
+	"""
+	Minimal wrapper around the inotify API of libc, so that no additional packages are required.
+	"""
+	def __init__(self):
+		# ctypes.util imports subprocess and tempfile, so only import it when it's needed
+		import ctypes
+		import ctypes.util
+		self._ctypes = ctypes
+		self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+		self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self.fd < 0:
+			error = self._ctypes.get_errno()
+			raise OSError(error, f'inotify_init1() failed: {os.strerror(error)}')
+
+	def add_watch(self, path: Path) -> int:
+		wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), _WATCH_MASK)
+		if wd < 0:
+			error = self._ctypes.get_errno()
+			raise OSError(error, os.strerror(error), str(path))
+		return wd
+
+	def read(self, timeout: Optional[float]):
+		"""
+		Wait up to ``timeout`` seconds (forever if None) and return the available events
+		as (watch descriptor, mask, name) tuples.
+		"""
+		poll = select.poll()
+		poll.register(self.fd, select.POLLIN)
+		if not poll.poll(None if timeout is None else int(timeout * 1000)):
+			return []
+		try:
+			data = os.read(self.fd, 1 << 16)
+		except BlockingIOError:
+			return []
+		events = []
+		offset = 0
+		while offset < len(data):
+			wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+			offset += _EVENT.size
+			events.append((wd, mask, os.fsdecode(data[offset:offset + length].rstrip(b'\0'))))
+			offset += length
+		return events
+
+	def remove_watch(self, wd: int):
+		# Fails if the watch was already removed because the directory was deleted, which is fine
+		self._libc.inotify_rm_watch(self.fd, wd)
+
+	def close(self):
+		os.close(self.fd)
+
+
+def _within(path: Path, base: Path) -> bool:
+	return path == base or base in path.parents
+
+
+def _journal_path() -> Path:
+	return constants.DATA_PATH / constants.JOURNAL_FILENAME
+
+
+def _selection() -> dict:
+	"""
+	Describe what ``save()`` selects by default, so that a journal can't be used
+	after the config changes.
+	"""
+	return {
+		'home': str(Path.home()),
+		'roots': sorted(map(str, profiles.default_roots())),
+		'exceptions': sorted(map(str, config.exceptions))
+	}
+
+
+def _is_running(pid: int) -> bool:
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
+
+
+def read_journal() -> Optional[dict]:
+	"""
+	Return the journal of a running watcher, or None if there's no usable journal.
+	"""
+	try:
+		with open(_journal_path()) as f:
+			journal = json.load(f)
+		assert journal['version'] == JOURNAL_VERSION
+		assert isinstance(journal['paths'], dict)
+	except FileNotFoundError:
+		return None
+	except (json.JSONDecodeError, KeyError, AssertionError) as e:
+		profiles.logger.warning(f'Malformed journal at {_journal_path()}\n{str(e)}\n')
+		return None
+	if not _is_running(journal['pid']):
+		profiles.logger.debug('The watcher which wrote the journal is no longer running')
+		return None
+	return journal
+
+
+def journaled_paths(journal: Optional[dict], since: Optional[int]) -> Optional[Set[str]]:
+	"""
+	Return the paths (relative to the home directory) which changed after ``since``,
+	as recorded by the watcher, or None if the journal can't tell, in which case
+	every file has to be checked. This happens if the journal is missing,
+	the watcher wasn't running continuously since ``since``, it missed some events,
+	or the config changed since the watcher was started.
+	"""
+	if journal is None or since is None:
+		return None
+	if journal['started_ns'] > since:
+		profiles.logger.info('The watcher was started after the last save; checking every file')
+		return None
+	if journal['incomplete'] or (journal['overflow_ns'] is not None and journal['overflow_ns'] >= since):
+		profiles.logger.info('The watcher missed some changes; checking every file')
+		return None
+	if journal['selection'] != _selection():
+		profiles.logger.info('The config changed since the watcher was started; checking every file')
+		return None
+	return {relpath for relpath, changed_ns in journal['paths'].items() if changed_ns > since}
+
+
+class _Watcher:
+	def __init__(self):
+		self.inotify = _Inotify()
+		self.directories: Dict[int, Path] = {}
+		self.watched: Set[Path] = set()
+		self.selected = profiles.path_selector()
+		self.roots = sorted(profiles.default_roots())
+		self.started_ns = time.time_ns()
+		self.overflow_ns = None
+		self.incomplete = False
+		self.paths: Dict[str, int] = {}
+
+	def _watch(self, directory: Path) -> bool:
+		if directory in self.watched:
+			return True
+		try:
+			wd = self.inotify.add_watch(directory)
+		except OSError as e:
+			if e.errno not in (errno.ENOENT, errno.ENOTDIR):  # The directory was removed in the meantime
+				profiles.logger.error(f'Couldn\'t watch {directory}: {e}')
+				self.incomplete = True
+			return False
+		self.directories[wd] = directory
+		self.watched.add(directory)
+		return True
+
+	def watch_tree(self, directory: Path, mark=False):
+		"""
+		Watch ``directory`` and its subdirectories. If ``mark`` is True, the files
+		within them are marked as changed, since they may have been created before
+		the directory was watched.
+		"""
+		now = time.time_ns()
+		stack = [directory]
+		while stack:
+			current = stack.pop()
+			if not self._watch(current):
+				continue
+			try:
+				with os.scandir(current) as entries:
+					for entry in entries:
+						path = Path(entry.path)
+						if entry.is_dir(follow_symlinks=False):
+							stack.append(path)
+						elif mark:
+							self._mark(path, now)
+			except OSError:
+				pass
+
+	def watch_roots(self, mark=False):
+		"""
+		Watch every directory which contains selected files. Roots which don't exist yet are
+		watched through their closest existing parent, so that they're noticed when they're created.
+		"""
+		now = time.time_ns()
+		for root in self.roots:
+			if root in self.watched:
+				continue
+			if root.is_dir():
+				self.watch_tree(root, mark)
+			else:
+				if mark and os.path.lexists(root):
+					self._mark(root, now)
+				parent = root.parent
+				while not parent.is_dir() and parent != parent.parent:
+					parent = parent.parent
+				self._watch(parent)
+
+	def unwatch_tree(self, directory: Path):
+		"""
+		Stop watching ``directory`` and its subdirectories, e.g. because it was moved elsewhere.
+		"""
+		for wd, path in list(self.directories.items()):
+			if _within(path, directory):
+				self.inotify.remove_watch(wd)
+				del self.directories[wd]
+				self.watched.discard(path)
+
+	def _mark(self, path: Path, now: int) -> bool:
+		if self.selected(path) and (relpath := profiles.home_relative(path)) is not None:
+			self.paths[relpath] = now
+			return True
+		return False
+
+	def handle(self, events) -> bool:
+		"""
+		Process events returned by ``_Inotify.read()`` and return whether any selected file changed.
+		"""
+		now = time.time_ns()
+		marked = False
+		for wd, mask, name in events:
+			if mask & IN_Q_OVERFLOW:
+				profiles.logger.warning('Some changes were missed because too many files changed at once')
+				self.overflow_ns = now
+				marked = True
+				continue
+			if mask & IN_IGNORED:
+				self.watched.discard(self.directories.pop(wd, None))
+				continue
+			if wd not in self.directories or not name:
+				continue
+			path = self.directories[wd] / name
+			if mask & IN_ISDIR:
+				if mask & IN_MOVED_FROM:
+					self.unwatch_tree(path)
+				if not mask & (IN_CREATE | IN_MOVED_TO):
+					continue
+				if any(_within(path, root) for root in self.roots):
+					self.watch_tree(path, mark=True)
+					marked = True
+				elif any(_within(root, path) for root in self.roots):
+					self.watch_roots(mark=True)  # A parent of a root was created
+					marked = True
+			elif any(_within(path, root) for root in self.roots):
+				marked = self._mark(path, now) or marked
+		return marked
+
+	def write_journal(self):
+		journal_path = _journal_path()
+		tmp_path = journal_path.with_name(f'{journal_path.name}.{os.getpid()}.tmp')
+		data = json.dumps({
+			'version': JOURNAL_VERSION,
+			'pid': os.getpid(),
+			'started_ns': self.started_ns,
+			'updated_ns': time.time_ns(),
+			'selection': _selection(),
+			'overflow_ns': self.overflow_ns,
+			'incomplete': self.incomplete,
+			'paths': self.paths
+		})
+		with open(tmp_path, 'w') as f:
+			f.write(data)  # Write only after JSON serialization is successful
+		os.replace(tmp_path, journal_path)  # ``save()`` may be reading the journal at the same time
+
+	def close(self):
+		self.inotify.close()
+		_journal_path().unlink(missing_ok=True)
+
+
+def watch(autosave: float = None, flush_interval: float = 0.5):
+	"""
+	Watch the files that ``save()`` selects by default using inotify, and keep a journal
+	of changed files which ``save()`` uses to skip unchanged files. Runs until interrupted.
+
+	If ``autosave`` is specified, the current profile is saved after no files
+	have changed for ``autosave`` seconds. The journal is written every ``flush_interval`` seconds
+	while files are changing (and before saving automatically), so it's never older than that
+	even if some file changes all the time.
+	"""
+	if (journal := read_journal()) is not None:
+		raise RuntimeError(f'Another watcher is already running (PID {journal["pid"]}).')
+	watcher = _Watcher()
+	# Stop cleanly when terminated, e.g. by systemd
+	signal.signal(signal.SIGTERM, _interrupt)
+	try:
+		watcher.watch_roots()
+		watcher.write_journal()
+		profiles.logger.info(f'Watching {len(watcher.watched)} directories')
+		dirty = False  # Whether the journal has to be written
+		unsaved = False  # Whether files changed since the last autosave
+		last_change = 0
+		last_flush = time.monotonic()
+		while True:
+			now = time.monotonic()
+			deadlines = []
+			if dirty:
+				deadlines.append(last_flush + flush_interval)
+			if unsaved:
+				deadlines.append(last_change + autosave)
+			events = watcher.inotify.read(max(0, min(deadlines) - now) if deadlines else None)
+			if events and watcher.handle(events):
+				dirty = True
+				unsaved = autosave is not None
+				last_change = time.monotonic()
+			now = time.monotonic()
+			save_now = unsaved and now - last_change >= autosave
+			# Flushing doesn't wait for files to stop changing, since ``save()`` trusts the journal
+			if dirty and (now - last_flush >= flush_interval or save_now):
+				watcher.write_journal()
+				dirty = False
+				last_flush = now
+			if save_now:
+				unsaved = False
+				_autosave()
+	finally:
+		watcher.close()
+
+
+def _interrupt(signum, frame):
+	raise KeyboardInterrupt
+
+
+def _autosave():
+	if (current := profiles.current_profile()) is None:
+		profiles.logger.warning('Not saving automatically because no profile is active')
+		return
+	try:
+		result = profiles.save()
+	except (profiles.CopyError, RuntimeError, OSError) as e:
+		profiles.logger.error(f'Saving "{current}" automatically failed: {e}')
+		return
+	profiles.logger.warning(
+		f'Saved "{current}" ({result["added"]} added, {result["changed"]} changed, {result["unchanged"]} unchanged)'
+	)
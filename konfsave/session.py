@@ -0,0 +1,117 @@
+import contextlib
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from . import config
+from . import constants
+from . import profiles
+
+
+class Konfsave:
+	"""
+	A loaded Konfsave configuration, for programs which use Konfsave as a library.
+
+	Each session has its own ``config.Config``, i.e. its own parsed config file and the caches which
+	depend on it, so a long-running program can keep several configurations loaded and use them from
+	several threads at the same time. Any function of ``konfsave.profiles`` can be called with ``run()``
+	or within ``with session.activated():``, and the most common ones also have methods here.
+	The threads that Konfsave starts itself use the session which started them, but threads that
+	the caller starts use the process-wide config until a session is activated in them.
+
+	The home directory and ``$XDG_CONFIG_HOME`` are those of the process, so sessions only differ
+	in what their config files specify (e.g. the profile home or the storage backend).
+	Functions which ask for confirmation still read from stdin unless told not to.
+	"""
+	def __init__(self, config_path: Path = None):
+		self.config_path = Path(config_path) if config_path else constants.DATA_PATH / constants.CONFIG_FILENAME
+		self.config: config.Config = None
+		self.reload()
+
+	def __repr__(self):
+		return f'<Konfsave {self.config_path}>'
+
+	def reload(self):
+		"""
+		Load the config file again, e.g. after it has changed. Cached profile info is discarded.
+		Operations which are already running keep using the previous config.
+		If the config file is invalid, ``config.ConfigError`` is raised and the previous config is kept.
+		"""
+		state = config.Config()
+		token = config.activate(state)
+		try:
+			config.load_config(self.config_path)
+		finally:
+			config.deactivate(token)
+		self.config = state
+
+	@contextlib.contextmanager
+	def activated(self):
+		"""
+		Return a context manager which makes this session's config active in the current thread.
+		"""
+		token = config.activate(self.config)
+		try:
+			yield self
+		finally:
+			config.deactivate(token)
+
+	def run(self, fn: Callable, *args, **kwargs) -> Any:
+		"""
+		Call ``fn(*args, **kwargs)`` with this session's config and return the result.
+		"""
+		token = config.activate(self.config)
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			config.deactivate(token)
+
+	def current_profile(self) -> Optional[str]:
+		return self.run(profiles.current_profile)
+
+	def profile_info(self, name: str = None, **kwargs) -> Optional[dict]:
+		"""
+		See ``profiles.profile_info()``.
+		"""
+		return self.run(profiles.profile_info, name, **kwargs)
+
+	def list_profiles(self) -> Dict[str, dict]:
+		"""
+		Return the index of saved profiles, see ``profiles.load_index()``.
+		"""
+		return self.run(profiles.load_index)
+
+	def save(self, name: str = None, **kwargs) -> Dict[str, int]:
+		"""
+		See ``profiles.save()``.
+		"""
+		return self.run(profiles.save, name, **kwargs)
+
+	def load(self, name: str, **kwargs) -> bool:
+		"""
+		See ``profiles.load()``.
+		"""
+		return self.run(profiles.load, name, **kwargs)
+
+	def delete(self, profile, **kwargs) -> bool:
+		"""
+		See ``profiles.delete()``.
+		"""
+		return self.run(profiles.delete, profile, **kwargs)
+
+	def archive(self, profile: str, **kwargs):
+		"""
+		See ``profiles.archive_profile()``.
+		"""
+		return self.run(profiles.archive_profile, profile, **kwargs)
+
+	def unarchive(self, source, **kwargs) -> bool:
+		"""
+		See ``profiles.unarchive_profile()``.
+		"""
+		return self.run(profiles.unarchive_profile, source, **kwargs)
+
+	def deploy(self, name: str, homes, **kwargs):
+		"""
+		See ``profiles.deploy()``.
+		"""
+		return self.run(profiles.deploy, name, homes, **kwargs)
@@ -0,0 +1,136 @@
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, List
+
+# Spans measure how long parts of Konfsave take. They're only recorded after ``enable()``
+# is called (by the --timings and --trace flags); until then, ``span()`` returns a shared
+# object which does nothing, so instrumented code doesn't become slower.
+# Recorded spans are kept in the Trace Event Format used by chrome://tracing and Perfetto:
+# https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I1nSsKchNAySU
+
+_enabled = False
+_origin = 0
+_events: List[dict] = []
+
+
+class _Span:
+	__slots__ = ('name', 'args', 'started')
+
+	def __init__(self, name: str, args: dict):
+		self.name = name
+		self.args = args
+
+	def __enter__(self):
+		self.started = time.perf_counter_ns()
+		return self
+
+	def __exit__(self, *exc_info):
+		finished = time.perf_counter_ns()
+		_events.append({
+			'name': self.name,
+			'cat': 'konfsave',
+			'ph': 'X',
+			'ts': (self.started - _origin) / 1000,
+			'dur': (finished - self.started) / 1000,
+			'pid': os.getpid(),
+			'tid': threading.get_ident(),
+			'args': self.args
+		})
+
+	def add(self, **counters):
+		"""
+		Add ``counters`` (e.g. files=1 or bytes=...) to the span's arguments.
+		"""
+		for key, value in counters.items():
+			self.args[key] = self.args.get(key, 0) + value
+
+	def __bool__(self):
+		return True
+
+
+class _DisabledSpan:
+	"""
+	Returned by ``span()`` when tracing is disabled. It's falsy, so that values which
+	are only needed for the trace can be skipped with ``if span: ...``.
+	"""
+	__slots__ = ()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		pass
+
+	def add(self, **counters):
+		pass
+
+	def __bool__(self):
+		return False
+
+
+_DISABLED_SPAN = _DisabledSpan()
+
+
+def enable():
+	global _enabled, _origin
+	if not _enabled:
+		_enabled = True
+		_origin = time.perf_counter_ns()
+
+
+def enabled() -> bool:
+	return _enabled
+
+
+def span(name: str, **args):
+	"""
+	Return a context manager which records how long its block takes as ``name``.
+	``args`` are included in the trace; "files" and "bytes" are also summed up by ``summary()``.
+	"""
+	if not _enabled:
+		return _DISABLED_SPAN
+	return _Span(name, args)
+
+
+def summary() -> Dict[str, dict]:
+	"""
+	Group the recorded spans by name, in the order in which they first finished.
+	Each value contains the number of spans ("count"), their total duration ("ms"),
+	and the sums of their "files" and "bytes" counters, if any.
+	Spans which ran at the same time in different threads are summed up as well.
+	"""
+	phases = {}
+	for event in _events:
+		phase = phases.setdefault(event['name'], {'count': 0, 'ms': 0.0})
+		phase['count'] += 1
+		phase['ms'] += event['dur'] / 1000
+		for key in ('files', 'bytes'):
+			if key in event['args']:
+				phase[key] = phase.get(key, 0) + event['args'][key]
+	return phases
+
+
+def print_timings(file=sys.stderr):
+	phases = summary()
+	if not phases:
+		return
+	width = max(map(len, phases))
+	print('Timings:', file=file)
+	for name, phase in phases.items():
+		counters = ''.join(
+			f'  {phase[key]} {key}' for key in ('files', 'bytes') if key in phase
+		)
+		count = f'  ({phase["count"]}x)' if phase['count'] > 1 else ''
+		print(f'  {name:<{width}}  {phase["ms"]:>10.2f} ms{count}{counters}', file=file)
+
+
+def write_trace(path):
+	"""
+	Write the recorded spans to ``path`` as JSON, which can be opened in chrome://tracing or Perfetto.
+	"""
+	data = json.dumps({'traceEvents': _events, 'displayTimeUnit': 'ms'})
+	with open(path, 'w') as f:
+		f.write(data)  # Write only after JSON serialization is successful
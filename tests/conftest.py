@@ -0,0 +1,66 @@
+import os
+import re
+from pathlib import Path
+
+import pytest
+
+from konfsave import constants
+from konfsave import Konfsave
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch) -> Path:
+	"""
+	An empty home directory, which is used instead of the real one.
+	"""
+	home = tmp_path / 'home'
+	(home / '.config').mkdir(parents=True)
+	monkeypatch.setenv('HOME', str(home))
+	monkeypatch.setattr(constants, 'CONFIG_HOME', home / '.config')
+	monkeypatch.setattr(constants, 'DATA_PATH', home / '.config' / 'konfsave')
+	return home
+
+
+@pytest.fixture
+def make_session(home):
+	"""
+	Return a function which creates a session from the default config,
+	with the [Defaults] given as keyword arguments (e.g. ``storage='git'``) replaced.
+	"""
+	def make(**defaults) -> Konfsave:
+		defaults = {'save-list': 'kde,shells', **{k.replace('_', '-'): v for k, v in defaults.items()}}
+		text = constants.DEFAULT_CONFIG_PATH.read_text()
+		for key, value in defaults.items():
+			text = re.sub(rf'^{key}=.*$', f'{key}={value}', text, count=1, flags=re.MULTILINE)
+		config_path = constants.DATA_PATH / constants.CONFIG_FILENAME
+		config_path.parent.mkdir(parents=True, exist_ok=True)
+		config_path.write_text(text)
+		return Konfsave(config_path)
+	return make
+
+
+@pytest.fixture
+def sample_files(home):
+	"""
+	Create files in every group of the test sessions' save-list, and return a mapping
+	of their paths (relative to the home directory) to their contents, or the targets of symlinks.
+	"""
+	files = {
+		'.bashrc': b'export EDITOR=kate\n',
+		'.config/kwinrc': b'[Compositing]\nBackend=OpenGL\n' * 20,
+		'.config/kdeglobals': b'[General]\nColorScheme=BreezeDark\n' * 10,
+		'.oh-my-zsh/themes/konfsave.zsh-theme': b'PROMPT="%~ "\n' * 50,
+		# Large and compressible, so it's compressed with LZMA in archives
+		'.oh-my-zsh/cache/history.txt': b''.join(b'line %d of the history\n' % i for i in range(80000)),
+		# Incompressible, so it's stored without compression
+		'.oh-my-zsh/wallpaper.png': os.urandom(20000),
+	}
+	for relpath, data in files.items():
+		(home / relpath).parent.mkdir(parents=True, exist_ok=True)
+		(home / relpath).write_bytes(data)
+	(home / '.bashrc').chmod(0o600)
+	(home / '.config/kwinrc').chmod(0o600)
+	(home / '.oh-my-zsh/themes/current').symlink_to('konfsave.zsh-theme')
+	files['.oh-my-zsh/themes/current'] = 'konfsave.zsh-theme'
+	return files
+
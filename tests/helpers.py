@@ -0,0 +1,25 @@
+import os
+from pathlib import Path
+
+
+def remove_files(home: Path, files: dict):
+	"""
+	Remove ``files`` (see the ``sample_files`` fixture) from ``home``.
+	"""
+	for relpath in files:
+		(home / relpath).unlink(missing_ok=True)
+
+
+def assert_restored(home: Path, files: dict, modes: dict = None):
+	"""
+	Check that ``files`` (see ``sample_files``) exist in ``home`` with the same contents
+	and, if specified, the permissions in ``modes``.
+	"""
+	for relpath, data in files.items():
+		path = home / relpath
+		if isinstance(data, str):
+			assert os.readlink(path) == data, relpath
+		else:
+			assert path.read_bytes() == data, relpath
+	for relpath, mode in (modes or {}).items():
+		assert (home / relpath).stat().st_mode & 0o777 == mode, relpath
@@ -0,0 +1,242 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from konfsave import actions
+from konfsave import constants
+from konfsave import profiles
+from konfsave.profiles import archive as archive_module
+from helpers import assert_restored, remove_files
+
+# Sample files which are large enough to be compressed (.bashrc is smaller when it's stored)
+COMPRESSED = ('.config/kwinrc', '.config/kdeglobals', '.oh-my-zsh/themes/konfsave.zsh-theme')
+MODES = {'.bashrc': 0o600, '.config/kwinrc': 0o600, '.config/kdeglobals': 0o644}
+
+
+@pytest.fixture
+def saved(make_session, sample_files):
+	session = make_session(copy_workers=4)
+	session.save('sample')
+	return session
+
+
+def _methods(archive) -> dict:
+	with zipfile.ZipFile(archive) as zipf:
+		# Checks the CRC of every member which zipfile can decompress
+		assert zipf.testzip() is None
+		return {member.filename: member.compress_type for member in zipf.infolist()}
+
+
+def test_methods_per_file(saved, tmp_path):
+	archive = tmp_path / 'sample.konfsave.zip'
+	saved.archive('sample', destination=archive)
+	methods = _methods(archive)
+	assert methods['.oh-my-zsh/wallpaper.png'] == zipfile.ZIP_STORED
+	assert methods['.oh-my-zsh/cache/history.txt'] == zipfile.ZIP_LZMA
+	for relpath in COMPRESSED:
+		assert methods[relpath] == zipfile.ZIP_DEFLATED, relpath
+
+
+@pytest.mark.parametrize('compression', (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA))
+def test_fixed_method(saved, tmp_path, compression):
+	archive = tmp_path / 'sample.konfsave.zip'
+	saved.archive('sample', destination=archive, compression=compression)
+	methods = _methods(archive)
+	assert methods['.oh-my-zsh/wallpaper.png'] == zipfile.ZIP_STORED
+	for relpath in (*COMPRESSED, '.oh-my-zsh/cache/history.txt'):
+		assert methods[relpath] == compression, relpath
+
+
+def test_unarchive_and_load(saved, home, sample_files, tmp_path):
+	archive = tmp_path / 'sample.konfsave.zip'
+	saved.archive('sample', destination=archive)
+	assert not saved.unarchive(archive, new_name='copy', confirm=False)
+	extracted = saved.config.profile_home / 'copy' / '.bashrc'
+	assert extracted.stat().st_mode & 0o777 == 0o600
+	assert extracted.stat().st_mtime_ns // 10**9 == (home / '.bashrc').stat().st_mtime_ns // 10**9
+	remove_files(home, sample_files)
+	assert not saved.load('copy', overwrite_unsaved_configuration=True, restart=False)
+	assert_restored(home, sample_files, MODES)
+
+
+def test_load_archive(saved, home, sample_files, tmp_path):
+	archive = tmp_path / 'sample.konfsave.zip'
+	saved.archive('sample', destination=archive)
+	remove_files(home, sample_files)
+	assert not saved.run(profiles.load_archive, archive, overwrite_unsaved_configuration=True, restart=False)
+	assert_restored(home, sample_files)
+
+
+def _tar(members) -> io.BytesIO:
+	"""
+	Return a tar archive of ``members``, which map names to contents, or to the targets of symlinks.
+	"""
+	buffer = io.BytesIO()
+	with tarfile.open(fileobj=buffer, mode='w') as tar:
+		for name, data in members.items():
+			member = tarfile.TarInfo(name)
+			if isinstance(data, str):
+				member.type, member.linkname = tarfile.SYMTYPE, data
+				tar.addfile(member)
+			else:
+				member.size = len(data)
+				tar.addfile(member, io.BytesIO(data))
+	buffer.seek(0)
+	return buffer
+
+
+def test_unarchive_tar_through_symlink(saved, tmp_path):
+	victim = tmp_path / 'victim'
+	victim.mkdir()
+	archive = _tar({
+		saved.config.profile_info_filename: b'{"name": "evil"}',
+		'.config': str(victim), '.config/pwned': b'pwned\n', '.bashrc': b'ls\n'
+	})
+	assert not saved.unarchive(archive, confirm=False)
+	assert not (victim / 'pwned').exists()
+	# The file is extracted into the profile, and the symlink which would replace its directory is skipped
+	profile_dir = saved.config.profile_home / 'evil'
+	assert not (profile_dir / '.config').is_symlink()
+	assert (profile_dir / '.config/pwned').read_bytes() == b'pwned\n'
+	assert (profile_dir / '.bashrc').read_bytes() == b'ls\n'
+
+
+def test_unarchive_zip_through_symlink(saved, tmp_path):
+	victim = tmp_path / 'victim'
+	victim.mkdir()
+	archive = tmp_path / 'evil.zip'
+	with zipfile.ZipFile(archive, 'w') as zipf:
+		link = zipfile.ZipInfo('.config')
+		link.external_attr = (0o120777 << 16)
+		zipf.writestr(link, str(victim))
+		zipf.writestr('.config/pwned', b'pwned\n')
+	assert not saved.unarchive(archive, new_name='evil', confirm=False)
+	assert not (victim / 'pwned').exists()
+
+
+def test_unarchive_tar_without_info(saved):
+	archive = _tar({'.bashrc': b'ls\n'})
+	with pytest.raises(ValueError):
+		saved.unarchive(archive, confirm=False)
+	archive.seek(0)
+	assert not saved.unarchive(archive, new_name='unnamed', confirm=False)
+	assert saved.profile_info('unnamed')['name'] == 'unnamed'
+	assert (saved.config.profile_home / 'unnamed' / '.bashrc').read_bytes() == b'ls\n'
+
+
+def test_dictionary(make_session, home, sample_files, tmp_path):
+	# The dictionary consists of lines which occur in more than one file
+	for relpath in COMPRESSED:
+		sample_files[relpath] += b'[Icons]\nTheme=breeze-dark\n'
+		(home / relpath).write_bytes(sample_files[relpath])
+	saved = make_session()
+	saved.save('sample')
+	archive = tmp_path / 'sample.konfsave.zip'
+	saved.archive('sample', destination=archive, dictionary=True)
+	with zipfile.ZipFile(archive) as zipf:
+		members = [zipf.getinfo(relpath) for relpath in COMPRESSED]
+		zdict = profiles.read_dictionary(zipf)
+	for member in members:
+		assert member.compress_type == profiles.ZIP_DEFLATED_DICTIONARY, member.filename
+	contents = saved.run(
+		profiles.run_with_archive, archive, lambda z, m: archive_module._open_member(z, m, zdict).read(), members, 4
+	)
+	assert contents == [sample_files[relpath] for relpath in COMPRESSED]
+
+	assert not saved.unarchive(archive, new_name='copy', confirm=False)
+	remove_files(home, sample_files)
+	assert not saved.load('copy', overwrite_unsaved_configuration=True, restart=False)
+	assert_restored(home, sample_files)
+
+	# Loading directly from the archive decompresses the members in several threads
+	remove_files(home, sample_files)
+	assert not saved.run(profiles.load_archive, archive, overwrite_unsaved_configuration=True, restart=False)
+	assert_restored(home, sample_files)
+
+
+def test_unarchive_batch_overwrite(saved, tmp_path):
+	archive = tmp_path / 'sample.konfsave.zip'
+	saved.archive('sample', destination=archive)
+	profile_dir = saved.config.profile_home / 'sample'
+	(profile_dir / 'stale').write_text('stale')
+	(profile_dir / constants.HISTORY_DIRNAME).mkdir(exist_ok=True)
+	broken = tmp_path / 'broken.konfsave.zip'
+	with zipfile.ZipFile(broken, 'w') as zipf:
+		zipf.writestr(saved.config.profile_info_filename, '{"name": "broken"}')
+		zipf.writestr('.bashrc', b'echo konfsave\n')
+	saved.run(profiles.unarchive_profile, broken, confirm=False)
+	(saved.config.profile_home / 'broken' / 'kept').write_text('kept')
+	# The CRC of .bashrc no longer matches, so extracting it fails and the existing profile is restored
+	broken.write_bytes(broken.read_bytes().replace(b'echo konfsave', b'echo KONFSAVE'))
+
+	results = saved.run(profiles.unarchive_profiles, [archive, broken], overwrite=True, workers=2)
+	assert [ok and not failed for ok, failed in results] == [True, False]
+	assert not (profile_dir / 'stale').exists()
+	assert not (profile_dir / constants.HISTORY_DIRNAME).exists()
+	assert (profile_dir / '.bashrc').exists()
+	assert (saved.config.profile_home / 'broken' / 'kept').read_text() == 'kept'
+	assert not any(path.name.endswith('.bkp') for path in saved.config.profile_home.iterdir())
+
+
+def _zip(path, members, info_filename):
+	"""
+	Write a zip archive of ``members``, which map names to contents, or to the targets of symlinks.
+	"""
+	with zipfile.ZipFile(path, 'w') as zipf:
+		zipf.writestr(info_filename, '{"name": "evil"}')
+		for name, data in members.items():
+			if isinstance(data, str):
+				link = zipfile.ZipInfo(name)
+				link.external_attr = 0o120777 << 16
+				zipf.writestr(link, data)
+			else:
+				zipf.writestr(name, data)
+	return path
+
+
+@pytest.mark.parametrize('members', (
+	{'.config/x': 'VICTIM', '.config/x/evil': b'evil\n'},
+	{'.x': 'VICTIM', '.x/y': b'evil\n'},
+	{'.config/x/evil': b'evil\n', '.config/x': 'VICTIM'},
+))
+def test_load_archive_through_symlink(saved, home, tmp_path, members):
+	victim = tmp_path / 'victim'
+	victim.mkdir()
+	members = {name: str(victim) if data == 'VICTIM' else data for name, data in members.items()}
+	archive = _zip(tmp_path / 'evil.zip', members, saved.config.profile_info_filename)
+	saved.run(profiles.load_archive, archive, include={home}, overwrite_unsaved_configuration=True, restart=False)
+	assert not os.listdir(victim)
+	# The file is loaded, and the symlink which would replace its directory is skipped
+	evil = next(name for name, data in members.items() if isinstance(data, bytes))
+	assert (home / evil).read_bytes() == b'evil\n'
+
+
+def test_load_archive_into_symlinked_directory(saved, home, tmp_path):
+	victim = tmp_path / 'victim'
+	victim.mkdir()
+	(home / '.config/x').symlink_to(victim)
+	archive = _zip(tmp_path / 'evil.zip', {'.config/x/evil': b'evil\n'}, saved.config.profile_info_filename)
+	with zipfile.ZipFile(archive) as zipf:
+		assert saved.run(profiles.archive_load_plan, zipf, {home}) == []
+	saved.run(profiles.load_archive, archive, include={home}, overwrite_unsaved_configuration=True, restart=False)
+	assert not os.listdir(victim)
+
+
+def test_load_archive_dry_run(saved, home, sample_files, tmp_path, capsys):
+	archive = tmp_path / 'sample.konfsave.zip'
+	saved.archive('sample', destination=archive)
+	(home / '.bashrc').write_bytes(b'changed\n')
+	(home / '.config/kwinrc').write_bytes(b'changed\n')
+	capsys.readouterr()
+	actions.parse_arguments(['konfsave', 'load', str(archive), '--dry-run'])
+	assert capsys.readouterr().out.split() == [str(home / '.bashrc'), str(home / '.config/kwinrc')]
+	assert (home / '.bashrc').read_bytes() == b'changed\n'
+
+	actions.parse_arguments(['konfsave', 'load', str(archive), '--dry-run', '--exclude', '.bashrc'])
+	assert capsys.readouterr().out.split() == [str(home / '.config/kwinrc')]
+	actions.parse_arguments(['konfsave', 'load', str(archive), '--overwrite', '-n', '--exclude', '.bashrc'])
+	assert (home / '.bashrc').read_bytes() == b'changed\n'
+	assert (home / '.config/kwinrc').read_bytes() == sample_files['.config/kwinrc']
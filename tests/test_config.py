@@ -0,0 +1,68 @@
+import pytest
+
+from konfsave import actions
+from konfsave import config
+from konfsave import constants
+
+
+def test_invalid_config(make_session):
+	session = make_session()
+	config_path = session.config_path
+	config_path.write_text(config_path.read_text().replace('storage=directory', 'storage=floppy'))
+	with pytest.raises(config.ConfigError, match='floppy'):
+		session.reload()
+	assert session.config.storage == 'directory'
+	with pytest.raises(config.ConfigError):
+		type(session)(config_path)
+
+
+def test_invalid_config_exits_cli(make_session):
+	config_path = constants.DATA_PATH / constants.CONFIG_FILENAME
+	make_session()
+	config_path.write_text(config_path.read_text().replace('storage=directory', 'storage=floppy'))
+	with pytest.raises(SystemExit) as exit_info:
+		actions.parse_arguments(['konfsave', 'info'])
+	assert exit_info.value.code == 1
+
+
+@pytest.mark.parametrize('key, value', (
+	('copy-workers', 'many'),
+	('copy-workers', '-1'),
+	('history-keep-recent', 'ten'),
+	('history-keep-daily', '1.5'),
+	('history-keep-weekly', ''),
+	('hash-files', 'maybe'),
+	('history', 'sometimes'),
+	('log-level', 'LOUD'),
+))
+def test_invalid_value(make_session, key, value):
+	with pytest.raises(config.ConfigError, match=key):
+		make_session(**{key: value})
+
+
+def test_invalid_metagroup(make_session):
+	session = make_session()
+	config_path = session.config_path
+	config_path.write_text(config_path.read_text().replace(
+		'[Metagroup Definitions]\n', '[Metagroup Definitions]\nnonexistent\n'
+	))
+	with pytest.raises(config.ConfigError, match='nonexistent'):
+		session.reload()
+
+
+def test_metagroup_cycle(make_session):
+	session = make_session()
+	config_path = session.config_path
+	config_path.write_text(config_path.read_text().replace(
+		'[Metagroup Definitions]\n', '[Metagroup Definitions]\nfirst=second\nsecond=first\n'
+	))
+	with pytest.raises(config.ConfigError, match='first'):
+		session.reload()
+
+
+def test_missing_section(make_session):
+	session = make_session()
+	config_path = session.config_path
+	config_path.write_text(config_path.read_text().replace('[Home Directory Exceptions]', '[Something Else]'))
+	with pytest.raises(config.ConfigError, match='Home Directory Exceptions'):
+		session.reload()
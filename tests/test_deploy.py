@@ -0,0 +1,51 @@
+import json
+import os
+
+import pytest
+
+from helpers import assert_restored
+
+MODES = {'.bashrc': 0o600, '.config/kwinrc': 0o600, '.config/kdeglobals': 0o644}
+
+
+def test_deploy(make_session, home, sample_files, tmp_path):
+	session = make_session()
+	session.save('sample')
+	homes = [tmp_path / 'alice', tmp_path / 'bob']
+	for target in homes:
+		target.mkdir()
+	results = session.deploy('sample', homes)
+	assert results == [(True, {'written': len(sample_files), 'unchanged': 0})] * 2
+	for target in homes:
+		assert_restored(target, sample_files, MODES)
+		info_path = target / session.config.current_profile_path.relative_to(home)
+		assert json.loads(info_path.read_text())['name'] == 'sample'
+	assert session.deploy('sample', homes[:1]) == [(True, {'written': 0, 'unchanged': len(sample_files)})]
+
+
+def test_deploy_skips_symlinked_directories(make_session, home, sample_files, tmp_path):
+	session = make_session()
+	session.save('sample')
+	target = tmp_path / 'alice'
+	outside = tmp_path / 'outside'
+	target.mkdir()
+	outside.mkdir()
+	(target / '.config').symlink_to(outside)
+	(ok, result), = session.deploy('sample', [target])
+	assert ok
+	assert not os.listdir(outside)
+	assert (target / '.bashrc').read_bytes() == sample_files['.bashrc']
+	assert result['written'] == len([relpath for relpath in sample_files if not relpath.startswith('.config/')])
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='Files are only given to the owner of the home when running as root')
+def test_deploy_as_root(make_session, home, sample_files, tmp_path):
+	session = make_session()
+	session.save('sample')
+	target = tmp_path / 'nobody'
+	target.mkdir()
+	os.chown(target, 65534, 65534)
+	assert session.deploy('sample', [target])[0][0]
+	for relpath in (*sample_files, '.config', '.oh-my-zsh/themes'):
+		st = os.lstat(target / relpath)
+		assert (st.st_uid, st.st_gid) == (65534, 65534), relpath
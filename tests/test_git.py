@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from konfsave import constants
+from konfsave import profiles
+from helpers import assert_restored, remove_files
+
+pygit2 = pytest.importorskip('pygit2')
+
+MODES = {'.bashrc': 0o600, '.config/kwinrc': 0o600, '.config/kdeglobals': 0o644}
+
+
+def test_save_and_load(make_session, home, sample_files):
+	session = make_session(storage='git')
+	session.save('git')
+	repository = session.run(profiles.get_backend('git').repository)
+	assert repository.references.get('refs/heads/git') is not None
+	remove_files(home, sample_files)
+	assert not session.load('git', overwrite_unsaved_configuration=True, restart=False)
+	assert_restored(home, sample_files, MODES)
+
+
+def test_unchanged_save_makes_no_commit(make_session, sample_files):
+	session = make_session(storage='git')
+	session.save('git')
+	repository = session.run(profiles.get_backend('git').repository)
+	head = repository.references['refs/heads/git'].target
+	session.save('git')
+	assert repository.references['refs/heads/git'].target == head
+
+
+def test_checkout_keeps_permissions(make_session, home, sample_files):
+	session = make_session(storage='git')
+	session.save('git')
+	profile_dir = session.config.profile_home / 'git'
+	saved = json.loads((profile_dir / constants.MANIFEST_FILENAME).read_text())['files']
+	(profile_dir / constants.MANIFEST_FILENAME).unlink()
+	session.run(profiles.checkout_profile, 'git')
+	files = json.loads((profile_dir / constants.MANIFEST_FILENAME).read_text())['files']
+	assert {relpath: entry['mode'] for relpath, entry in files.items()} \
+		== {relpath: entry['mode'] for relpath, entry in saved.items()}
+	assert constants.GIT_MODES_FILENAME not in files
+	remove_files(home, sample_files)
+	session.load('git', overwrite_unsaved_configuration=True, restart=False)
+	assert_restored(home, sample_files, MODES)
+
+
+def test_push_and_pull(make_session, home, sample_files, tmp_path):
+	remote = tmp_path / 'remote.git'
+	first = make_session(storage='git', git_remote=str(remote))
+	first.save('git')
+	assert first.run(profiles.push_profiles) == {'git': 'pushed'}
+	assert first.run(profiles.push_profiles) == {'git': 'up-to-date'}
+
+	# Another machine, which has never seen the profile
+	second = make_session(
+		storage='git', git_remote=str(remote),
+		profile_home=str(tmp_path / 'profiles'), git_repository=str(tmp_path / 'profiles.git')
+	)
+	assert second.run(profiles.pull_profiles) == {'git': 'created'}
+	assert second.run(profiles.pull_profiles) == {'git': 'up-to-date'}
+	remove_files(home, sample_files)
+	second.load('git', overwrite_unsaved_configuration=True, restart=False)
+	assert_restored(home, sample_files, MODES)
@@ -0,0 +1,76 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from konfsave import actions
+from konfsave.groups import GroupCycleError, GroupGraph
+
+DEFINITIONS = {
+	':kwin': [Path('/home/user/.config/kwinrc'), Path('/home/user/.local/share/kwin')],
+	':plasma': [Path('/home/user/.config/plasmarc')],
+	':workspace': [':kwin', ':plasma'],
+	':kde': [':workspace', ':undefined', Path('/home/user/.config/kdeglobals')],
+}
+
+
+def test_paths():
+	graph = GroupGraph(DEFINITIONS)
+	assert graph.paths(':kde') == {
+		Path('/home/user/.config/kwinrc'), Path('/home/user/.local/share/kwin'),
+		Path('/home/user/.config/plasmarc'), Path('/home/user/.config/kdeglobals')
+	}
+	assert graph.paths(':workspace') == graph.paths(':kwin') | graph.paths(':plasma')
+	assert graph.undefined == {':undefined'}
+	with pytest.raises(KeyError):
+		graph.paths(':undefined')
+
+
+def test_closure_is_reused():
+	closure = GroupGraph(DEFINITIONS).closure()
+	# Groups with cached paths aren't resolved again, so their definitions don't matter
+	graph = GroupGraph({group: [] for group in DEFINITIONS}, closure)
+	assert graph.closure() == closure
+
+
+def test_groups_containing():
+	graph = GroupGraph(DEFINITIONS)
+	path = Path('/home/user/.local/share/kwin/scripts/tile.js')
+	assert graph.groups_containing(path) == {
+		Path('/home/user/.local/share/kwin'): {':kwin', ':workspace', ':kde'}
+	}
+	assert graph.groups_containing(Path('/home/user/.config/kdeglobals')) \
+		== {Path('/home/user/.config/kdeglobals'): {':kde'}}
+	assert graph.groups_containing(Path('/home/user/.bashrc')) == {}
+
+
+@pytest.mark.parametrize('definitions, cycle', [
+	({':a': [':a']}, [':a', ':a']),
+	({':a': [':b'], ':b': [':c'], ':c': [':a']}, [':a', ':b', ':c', ':a']),
+	# The cycle is reported without the groups leading to it
+	({':a': [':b'], ':b': [':c', Path('/file')], ':c': [':b']}, [':b', ':c', ':b']),
+])
+def test_cycle(definitions, cycle):
+	with pytest.raises(GroupCycleError) as error:
+		GroupGraph(definitions).closure()
+	assert error.value.cycle == cycle
+	assert ' -> '.join(cycle) in str(error.value)
+
+
+def test_which(make_session, home, capsys):
+	make_session()
+	capsys.readouterr()
+	actions.parse_arguments(['konfsave', 'which', '.config/lattedockrc', '.oh-my-zsh/custom/theme.zsh', '--json'])
+	results = json.loads(capsys.readouterr().out)
+	assert results[str(home / '.config/lattedockrc')] == {
+		'groups': {str(home / '.config/lattedockrc'): [':appearance', ':kde', ':kde-all', ':latte-dock']},
+		'default': True,
+		'exception': False
+	}
+	assert results[str(home / '.oh-my-zsh/custom/theme.zsh')]['groups'] \
+		== {str(home / '.oh-my-zsh'): [':shells', ':zsh']}
+
+	actions.parse_arguments(['konfsave', 'which', '.config/unknownrc'])
+	assert capsys.readouterr().out.splitlines() == [
+		str(home / '.config/unknownrc'), '  Not in any group', '  Saved by default: no'
+	]
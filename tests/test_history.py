@@ -0,0 +1,118 @@
+from datetime import datetime
+
+import pytest
+
+from konfsave import actions
+from konfsave import constants
+from konfsave import profiles
+
+DAY_NS = 24 * 3600 * 10**9
+
+
+@pytest.fixture
+def history(make_session, home, sample_files):
+	"""
+	A profile with three snapshots, each of which has a different .bashrc.
+	"""
+	session = make_session(history='yes')
+	for i in range(3):
+		(home / '.bashrc').write_bytes(b'export EDITOR=kate # %d\n' % i)
+		session.save('sample')
+	return session
+
+
+def _profile_dir(session):
+	return session.config.profile_home / 'sample'
+
+
+def test_history_is_disabled_by_default(make_session, sample_files):
+	session = make_session()
+	session.save('sample')
+	assert not (_profile_dir(session) / constants.HISTORY_DIRNAME).exists()
+
+
+def test_snapshots(history, home, sample_files):
+	snapshots = history.run(profiles.list_snapshots, _profile_dir(history))
+	assert [r['id'] for r in snapshots] == [1, 2, 3]
+	assert all(r['files'] == len(sample_files) for r in snapshots)
+	first, last = (history.run(profiles.read_snapshot, _profile_dir(history), i) for i in (1, 3))
+	# Only the changed file is stored again
+	assert first['files']['.bashrc']['digest'] != last['files']['.bashrc']['digest']
+	assert first['files']['.config/kwinrc']['digest'] == last['files']['.config/kwinrc']['digest']
+	assert not history.load('sample', snapshot='1', overwrite_unsaved_configuration=True, restart=False)
+	assert (home / '.bashrc').read_bytes() == b'export EDITOR=kate # 0\n'
+	assert (home / '.config/kwinrc').read_bytes() == sample_files['.config/kwinrc']
+
+
+def test_resolve_snapshot(history):
+	profile_dir = _profile_dir(history)
+	snapshots = history.run(profiles.list_snapshots, profile_dir)
+	resolve = lambda spec: history.run(profiles.resolve_snapshot, profile_dir, spec)['id']
+	assert resolve('2') == 2
+	assert resolve('latest') == 3
+	saved = datetime.fromtimestamp(snapshots[-1]['saved_ns'] / 10**9)
+	assert resolve(saved.date().isoformat()) == 3
+	assert resolve(saved.strftime('%Y-%m-%dT%H:%M')) == 3
+	for spec in ('4', '0', '2000-01-01', 'yesterday'):
+		with pytest.raises(profiles.SnapshotNotFoundError):
+			resolve(spec)
+	with pytest.raises(profiles.SnapshotNotFoundError):
+		history.load('sample', snapshot='4', overwrite_unsaved_configuration=True, restart=False)
+
+
+def test_malformed_history_index(history):
+	profile_dir = _profile_dir(history)
+	snapshots = history.run(profiles.list_snapshots, profile_dir)
+	(profile_dir / constants.HISTORY_DIRNAME / 'index.json').write_text('{')
+	assert history.run(profiles.list_snapshots, profile_dir) == snapshots
+
+
+def _records(*days_ago):
+	now = 1_000 * DAY_NS + DAY_NS // 2  # Midday in Europe, so that DST doesn't move records to another day
+	return [{'id': i, 'saved_ns': now - days * DAY_NS} for i, days in enumerate(days_ago, 1)]
+
+
+@pytest.mark.parametrize('days_ago, keep, kept', [
+	((3, 2, 1, 0), (2, 0, 0), [3, 4]),
+	# The newest snapshot is always kept
+	((3, 2, 1, 0), (0, 0, 0), [4]),
+	# The newest snapshot of each of the last two days which have snapshots
+	((3, 2, 2, 0, 0), (0, 2, 0), [3, 5]),
+	((35, 28, 21, 14, 7, 0), (1, 0, 3), [4, 5, 6]),
+])
+def test_retained_snapshots(days_ago, keep, kept):
+	records = _records(*days_ago)
+	assert [r['id'] for r in profiles.retained_snapshots(records, *keep)] == kept
+
+
+def test_prune_history(history, home):
+	profile_dir = _profile_dir(history)
+	objects = lambda: set(history.config.object_store.glob('*/*'))
+	before = objects()
+	assert history.run(profiles.prune_history, profile_dir, 1, 0, 0) == 2
+	assert [r['id'] for r in history.run(profiles.list_snapshots, profile_dir)] == [3]
+	assert not (profile_dir / constants.HISTORY_DIRNAME / '1.json').exists()
+	# The pruned snapshots' copies of .bashrc aren't referenced anymore
+	assert history.run(profiles.collect_garbage) == 2
+	assert len(objects()) == len(before) - 2
+	assert not history.load('sample', snapshot='latest', overwrite_unsaved_configuration=True, restart=False)
+	assert (home / '.bashrc').read_bytes() == b'export EDITOR=kate # 2\n'
+
+
+def test_save_prunes_history(make_session, home, sample_files):
+	session = make_session(history='yes', history_keep_recent=2, history_keep_daily=0, history_keep_weekly=0)
+	for i in range(4):
+		(home / '.bashrc').write_bytes(b'export EDITOR=kate # %d\n' % i)
+		session.save('sample')
+	assert [r['id'] for r in session.run(profiles.list_snapshots, _profile_dir(session))] == [3, 4]
+
+
+def test_history_command(history, make_session, capsys):
+	capsys.readouterr()
+	actions.parse_arguments(['konfsave', 'history', 'sample'])
+	lines = capsys.readouterr().out.splitlines()
+	assert lines[0] == 'Snapshots of sample:'
+	assert [line.split()[0] for line in lines[1:]] == ['3', '2', '1']
+	make_session(history='yes', history_keep_recent=1, history_keep_daily=0, history_keep_weekly=0)
+	actions.parse_arguments(['konfsave', 'history', 'sample', '--compact'])
+	assert capsys.readouterr().out.splitlines()[0] == 'Deleted 2 snapshots and 2 unreferenced files'
@@ -0,0 +1,89 @@
+import fcntl
+import json
+import threading
+
+import pytest
+
+from konfsave import actions
+from konfsave import constants
+from konfsave import profiles
+
+
+@pytest.fixture
+def saved(make_session, home, sample_files):
+	session = make_session()
+	session.save('first')
+	(home / '.bashrc').unlink()
+	session.save('second', exclude=[':bash'])
+	return session
+
+
+def _index_path(session):
+	return session.config.profile_home / constants.INDEX_FILENAME
+
+
+def test_index(saved, sample_files):
+	index = saved.list_profiles()
+	assert sorted(index) == ['first', 'second']
+	assert index['first']['files'] == len(sample_files)
+	assert index['first']['bytes'] == sum(len(data) for data in sample_files.values() if isinstance(data, bytes))
+	assert index['second']['files'] == len(sample_files) - 1
+	assert index['second']['saved_ns'] > index['first']['saved_ns']
+
+
+def test_index_follows_changes(saved):
+	saved.run(profiles.rename, 'second', 'third')
+	saved.run(profiles.change, {'description': 'Described'}, 'first')
+	assert sorted(saved.list_profiles()) == ['first', 'third']
+	assert saved.list_profiles()['first']['description'] == 'Described'
+	saved.delete('first', confirm=False)
+	assert sorted(saved.list_profiles()) == ['third']
+
+
+@pytest.mark.parametrize('contents', [None, '{"version": 1}', 'not JSON'])
+def test_rebuild_index(saved, contents):
+	index = saved.list_profiles()
+	if contents is None:
+		_index_path(saved).unlink()
+	else:
+		_index_path(saved).write_text(contents)
+	assert saved.list_profiles() == index
+	assert saved.run(profiles.read_index) == index
+	# Temporary files are never left behind
+	assert not [path for path in saved.config.profile_home.iterdir() if path.suffix == '.tmp']
+
+
+def test_rebuild_index_command(saved, capsys):
+	# A profile which was copied into the profile home without using Konfsave
+	profile_home = saved.config.profile_home
+	(profile_home / 'copied').mkdir()
+	for path in (profile_home / 'first').iterdir():
+		if path.is_file():
+			(profile_home / 'copied' / path.name).write_bytes(path.read_bytes())
+	info_path = profile_home / 'copied' / saved.config.profile_info_filename
+	info_path.write_text(json.dumps({**json.loads(info_path.read_text()), 'name': 'copied'}))
+	actions.parse_arguments(['konfsave', 'info'])
+	assert 'copied' not in capsys.readouterr().out
+	actions.parse_arguments(['konfsave', 'info', '--rebuild-index'])
+	assert 'copied' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('update', [
+	lambda: profiles.update_index('first'),
+	profiles.rebuild_index,
+	profiles.load_index,
+])
+def test_index_lock(saved, update):
+	_index_path(saved).unlink()  # So that load_index() has to rebuild it
+	lock_path = saved.config.profile_home / f'{constants.INDEX_FILENAME}.lock'
+	thread = threading.Thread(target=saved.run, args=(update,))
+	with open(lock_path, 'w') as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		thread.start()
+		thread.join(0.3)
+		# The index isn't written while another process holds the lock
+		assert thread.is_alive()
+		assert not _index_path(saved).exists()
+	thread.join(5)
+	assert not thread.is_alive()
+	assert sorted(saved.run(profiles.read_index)) == ['first', 'second']
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from konfsave import actions
+from konfsave import profiles
+from helpers import assert_restored, remove_files
+
+MODES = {'.bashrc': 0o600, '.config/kwinrc': 0o600, '.config/kdeglobals': 0o644}
+
+
+@pytest.fixture
+def saved(make_session, sample_files):
+	session = make_session()
+	session.save('sample')
+	return session
+
+
+def test_load_writes_only_changed_files(saved, home, sample_files):
+	(home / '.bashrc').write_bytes(b'changed\n')
+	(home / '.config/kdeglobals').chmod(0o600)
+	(home / '.oh-my-zsh/themes/current').unlink()
+	# Same contents, but touched since saving
+	os.utime(home / '.config/kwinrc', ns=(0, 0))
+	unchanged = ('.config/kwinrc', '.oh-my-zsh/cache/history.txt', '.oh-my-zsh/wallpaper.png')
+	before = {relpath: (home / relpath).stat() for relpath in unchanged}
+	assert [relpath for relpath, _ in saved.run(profiles.load_plan, 'sample')] \
+		== ['.bashrc', '.config/kdeglobals', '.oh-my-zsh/themes/current']
+	assert not saved.load('sample', overwrite_unsaved_configuration=True, restart=False)
+	assert_restored(home, sample_files, MODES)
+	for relpath in unchanged:
+		st = (home / relpath).stat()
+		assert (st.st_ino, st.st_mtime_ns) == (before[relpath].st_ino, before[relpath].st_mtime_ns), relpath
+	assert saved.run(profiles.load_plan, 'sample') == []
+
+
+def test_load_missing_files(saved, home, sample_files):
+	remove_files(home, sample_files)
+	assert len(saved.run(profiles.load_plan, 'sample')) == len(sample_files)
+	assert not saved.load('sample', overwrite_unsaved_configuration=True, restart=False)
+	assert_restored(home, sample_files, MODES)
+
+
+def test_load_plan_selection(saved, home, sample_files):
+	remove_files(home, sample_files)
+	plan = saved.run(profiles.load_plan, 'sample', exclude=[':zsh'])
+	assert sorted(relpath for relpath, _ in plan) == ['.bashrc', '.config/kdeglobals', '.config/kwinrc']
+
+
+def test_load_dry_run(saved, home, sample_files, capsys):
+	(home / '.bashrc').write_bytes(b'changed\n')
+	(home / '.config/kwinrc').unlink()
+	capsys.readouterr()
+	actions.parse_arguments(['konfsave', 'load', 'sample', '--dry-run'])
+	assert capsys.readouterr().out.split() == [str(home / '.bashrc'), str(home / '.config/kwinrc')]
+	assert (home / '.bashrc').read_bytes() == b'changed\n'
+	assert not (home / '.config/kwinrc').exists()
+
+	actions.parse_arguments(['konfsave', 'load', 'sample', '--dry-run', '--exclude', '.bashrc'])
+	assert capsys.readouterr().out.split() == [str(home / '.config/kwinrc')]
+	actions.parse_arguments(['konfsave', 'load', 'sample', '--overwrite', '-n'])
+	assert capsys.readouterr().out == 'Success\n'
+	actions.parse_arguments(['konfsave', 'load', 'sample', '--dry-run'])
+	assert capsys.readouterr().out == 'All files are already up-to-date.\n'
+	actions.parse_arguments(['konfsave', 'load', 'missing', '--dry-run'])
+	assert capsys.readouterr().out == 'The profile missing doesn\'t exist.\n'
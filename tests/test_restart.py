@@ -0,0 +1,147 @@
+import os
+import time
+
+import pytest
+
+from konfsave import profiles
+from konfsave.profiles import restart as restart_module
+
+# The processes of the registered KDE components
+KDE_PROCESSES = {'plasmashell', 'kwin_x11', 'latte-dock'}
+
+# Logs every call, and reports a bus name as owned once the program which claims it has been started
+DBUS_SEND = '''
+if [ "$5" = org.freedesktop.DBus.NameHasOwner ]; then
+	name="${6#string:}"
+	if [ -e "$STATE/$name" ]; then echo "$name true" >> "$LOG"; echo '   boolean true'; else echo '   boolean false'; fi
+else
+	echo "dbus-send $4" >> "$LOG"
+	sleep 0.3
+	touch "$STATE/org.kde.KWin"
+fi
+'''
+KSTART5 = '''
+echo "kstart5 $1" >> "$LOG"
+case "$1" in
+	plasmashell) touch "$STATE/org.kde.plasmashell" ;;
+	latte-dock) touch "$STATE/org.kde.lattedock" ;;
+esac
+'''
+KQUITAPP5 = '''
+if [ -e "$HOME/.config/kwinrc" ]; then loaded=after; else loaded=before; fi
+echo "kquitapp5 $1 $loaded loading" >> "$LOG"
+'''
+
+
+@pytest.fixture
+def stubs(tmp_path, monkeypatch):
+	"""
+	Put stubs of the commands which are used to restart KDE components in $PATH,
+	and return the path of the file in which they log their calls.
+	"""
+	bin_path = tmp_path / 'bin'
+	state = tmp_path / 'bus'
+	bin_path.mkdir()
+	state.mkdir()
+	for name, script in (('dbus-send', DBUS_SEND), ('kstart5', KSTART5), ('kquitapp5', KQUITAPP5)):
+		(bin_path / name).write_text(f'#!/bin/sh\n{script}')
+		(bin_path / name).chmod(0o755)
+	log = tmp_path / 'log'
+	log.touch()
+	monkeypatch.setenv('PATH', f'{bin_path}{os.pathsep}{os.environ["PATH"]}')
+	monkeypatch.setenv('STATE', str(state))
+	monkeypatch.setenv('LOG', str(log))
+	return log
+
+
+@pytest.mark.parametrize('relpaths, processes, expected', [
+	# kwinrc belongs to :appearance, which latte-dock also uses
+	(['.config/kwinrc'], KDE_PROCESSES, ['plasmashell', 'kwin', 'latte-dock']),
+	(['.config/lattedockrc'], KDE_PROCESSES, ['plasmashell', 'latte-dock']),
+	(['.config/lattedockrc'], {'kwin_wayland', 'latte-dock'}, ['latte-dock']),
+	(['.config/kwinrulesrc'], KDE_PROCESSES, ['plasmashell', 'kwin']),
+	(['.config/kwinrulesrc'], {'kwin_x11', 'latte-dock'}, ['kwin']),
+	(['.config/kwinrc'], {'dolphin'}, []),
+	(['.bashrc'], KDE_PROCESSES, []),
+	# Files outside of every group could affect any component
+	(['.bashrc', '.config/unknownrc'], KDE_PROCESSES, ['plasmashell', 'kwin', 'latte-dock']),
+	(['.config/unknownrc'], {'latte-dock'}, ['latte-dock']),
+])
+def test_plan_restart(make_session, relpaths, processes, expected):
+	components = make_session().run(profiles.plan_restart, relpaths, processes)
+	assert [component.name for component in components] == expected
+
+
+def test_running_processes(tmp_path):
+	proc = tmp_path / 'proc'
+	processes = {
+		'1': (b'systemd\n', b'/sbin/init\0splash\0'),
+		'20': (b'plasmashell\n', b'/usr/bin/plasmashell\0'),
+		# The kernel truncates long names, so the executable is needed to find the process
+		'300': (b'latte-dock-wrap\n', b'/usr/bin/latte-dock-wrapper\0--replace\0'),
+		'4000': (b'kworker/0:1\n', b''),
+	}
+	for pid, (comm, cmdline) in processes.items():
+		(proc / pid).mkdir(parents=True)
+		(proc / pid / 'comm').write_bytes(comm)
+		(proc / pid / 'cmdline').write_bytes(cmdline)
+	(proc / 'self').mkdir()
+	(proc / '50000').mkdir()  # Exited while it was being read
+	assert profiles.running_processes(str(proc)) == {
+		'systemd', 'init', 'plasmashell', 'latte-dock-wrap', 'latte-dock-wrapper', 'kworker/0:1'
+	}
+
+
+def test_load_restarts_components_in_order(make_session, home, sample_files, stubs, monkeypatch):
+	session = make_session()
+	session.save('sample')
+	(home / '.config/kwinrc').unlink()
+	monkeypatch.setattr(restart_module, 'running_processes', lambda: {'kwin_wayland', 'latte-dock'})
+	assert not session.load('sample', overwrite_unsaved_configuration=True)
+	assert stubs.read_text().splitlines() == [
+		'kquitapp5 lattedock before loading',
+		'dbus-send org.kde.KWin.reloadConfig',
+		'org.kde.KWin true',
+		'kstart5 latte-dock',
+		'org.kde.lattedock true',
+	]
+
+
+def test_load_without_restart(make_session, home, sample_files, stubs, monkeypatch):
+	session = make_session()
+	session.save('sample')
+	(home / '.config/kwinrc').unlink()
+	monkeypatch.setattr(restart_module, 'running_processes', lambda: KDE_PROCESSES)
+	assert not session.load('sample', overwrite_unsaved_configuration=True, restart=False)
+	assert (home / '.config/kwinrc').is_file()
+	assert not stubs.read_text()
+
+
+def test_start_components_waits_for_dependencies(make_session, stubs):
+	# Without waiting for kwin, latte-dock would be started while kwin is still reloading
+	session = make_session()
+	components = [profiles.get_component('latte-dock'), profiles.get_component('kwin')]
+	session.run(profiles.start_components, components)
+	log = stubs.read_text().splitlines()
+	assert log.index('org.kde.KWin true') < log.index('kstart5 latte-dock')
+
+
+def test_wait_for_bus_name(stubs, tmp_path):
+	(tmp_path / 'bus' / 'org.example.Ready').touch()
+	assert profiles.wait_for_bus_name('org.example.Ready', timeout=1)
+	assert stubs.read_text() == 'org.example.Ready true\n'
+
+
+def test_wait_for_bus_name_timeout(stubs, caplog):
+	start = time.monotonic()
+	assert not profiles.wait_for_bus_name('org.example.Missing', timeout=0.3)
+	assert time.monotonic() - start >= 0.3
+	assert 'org.example.Missing didn\'t appear on D-Bus within 0.3 seconds' in caplog.text
+
+
+def test_wait_for_bus_name_without_dbus(tmp_path, monkeypatch):
+	# If D-Bus can't be queried, there's nothing to wait for
+	monkeypatch.setenv('PATH', str(tmp_path))
+	start = time.monotonic()
+	assert profiles.wait_for_bus_name('org.example.Missing', timeout=5)
+	assert time.monotonic() - start < 1
@@ -0,0 +1,49 @@
+import json
+import os
+
+import pytest
+
+from konfsave import constants
+
+
+@pytest.mark.parametrize('storage', ['directory', 'objects'])
+def test_incremental_save(make_session, home, sample_files, storage):
+	session = make_session(storage=storage)
+	assert session.save('sample') == {'added': len(sample_files), 'changed': 0, 'unchanged': 0}
+	assert session.save('sample') == {'added': 0, 'changed': 0, 'unchanged': len(sample_files)}
+	(home / '.config/kwinrc').write_bytes(b'[Compositing]\nBackend=XRender\n')
+	(home / '.zshrc').write_bytes(b'source ~/.oh-my-zsh/oh-my-zsh.sh\n')
+	assert session.save('sample') == {'added': 1, 'changed': 1, 'unchanged': len(sample_files) - 1}
+	assert session.save('sample') == {'added': 0, 'changed': 0, 'unchanged': len(sample_files) + 1}
+
+
+def test_save_detects_changes_with_the_same_size(make_session, home, sample_files):
+	session = make_session()
+	session.save('sample')
+	path = home / '.config/kdeglobals'
+	st = path.stat()
+	# Replacing the file changes its inode even if the size and modification time are kept
+	tmp = path.with_name('kdeglobals.new')
+	tmp.write_bytes(sample_files['.config/kdeglobals'].replace(b'Dark', b'Blue'))
+	os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+	tmp.replace(path)
+	assert session.save('sample')['changed'] == 1
+	assert (session.config.profile_home / 'sample/.config/kdeglobals').read_bytes() == path.read_bytes()
+
+
+def test_save_restores_missing_copies(make_session, home, sample_files):
+	session = make_session()
+	session.save('sample')
+	profile_dir = session.config.profile_home / 'sample'
+	(profile_dir / '.bashrc').unlink()
+	assert session.save('sample') == {'added': 0, 'changed': 1, 'unchanged': len(sample_files) - 1}
+	assert (profile_dir / '.bashrc').read_bytes() == sample_files['.bashrc']
+
+
+def test_save_keeps_unselected_files(make_session, home, sample_files):
+	session = make_session()
+	session.save('sample')
+	(home / '.bashrc').unlink()
+	session.save('sample', include=[':zsh'])
+	manifest = json.loads((session.config.profile_home / 'sample' / constants.MANIFEST_FILENAME).read_text())
+	assert set(manifest['files']) == set(sample_files)
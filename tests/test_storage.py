@@ -0,0 +1,80 @@
+import json
+
+from konfsave import constants
+from konfsave import profiles
+from helpers import assert_restored, remove_files
+
+MODES = {'.bashrc': 0o600, '.config/kwinrc': 0o600, '.config/kdeglobals': 0o644}
+
+
+def _objects(session) -> set:
+	return {
+		path.parent.name + path.name for path in session.config.object_store.glob('*/*')
+		if not path.name.startswith('.')
+	}
+
+
+def test_objects_round_trip(make_session, home, sample_files):
+	session = make_session(storage='objects')
+	session.save('sample')
+	profile_dir = session.config.profile_home / 'sample'
+	assert sorted(path.name for path in profile_dir.iterdir()) \
+		== sorted([session.config.profile_info_filename, constants.MANIFEST_FILENAME])
+	manifest = json.loads((profile_dir / constants.MANIFEST_FILENAME).read_text())
+	assert manifest['storage'] == 'objects'
+	assert manifest['files']['.oh-my-zsh/themes/current']['link'] == 'konfsave.zsh-theme'
+	digests = {e['digest'] for e in manifest['files'].values() if 'digest' in e}
+	assert _objects(session) == digests
+	for relpath, data in sample_files.items():
+		if isinstance(data, bytes):
+			digest = manifest['files'][relpath]['digest']
+			assert session.run(profiles.object_path, digest).read_bytes() == data
+	remove_files(home, sample_files)
+	assert not session.load('sample', overwrite_unsaved_configuration=True, restart=False)
+	assert_restored(home, sample_files, MODES)
+
+
+def test_objects_are_shared(make_session, home, sample_files):
+	session = make_session(storage='objects')
+	session.save('first')
+	session.save('second')
+	assert len(_objects(session)) == len([data for data in sample_files.values() if isinstance(data, bytes)])
+	(home / '.bashrc').write_bytes(b'export EDITOR=vim\n')
+	session.save('second')
+	assert len(_objects(session)) == len([data for data in sample_files.values() if isinstance(data, bytes)]) + 1
+
+
+def test_collect_garbage(make_session, home, sample_files):
+	session = make_session(storage='objects')
+	session.save('first')
+	shared = _objects(session)
+	(home / '.bashrc').write_bytes(b'export EDITOR=vim\n')
+	session.save('second')
+	# Objects which are still referenced by another profile are kept
+	session.delete('second', confirm=False)
+	assert _objects(session) == shared
+	session.delete('first', confirm=False)
+	assert not _objects(session)
+
+
+def test_collect_garbage_with_malformed_manifest(make_session, home, sample_files):
+	session = make_session(storage='objects')
+	session.save('first')
+	session.save('second')
+	objects = _objects(session)
+	(session.config.profile_home / 'second' / constants.MANIFEST_FILENAME).write_text('{')
+	# The objects of the malformed manifest are unknown, so none of them can be removed
+	session.delete('first', confirm=False)
+	assert _objects(session) == objects
+	assert session.run(profiles.collect_garbage) == 0
+
+
+def test_convert_to_objects(make_session, home, sample_files):
+	make_session().save('sample')
+	session = make_session(storage='objects')
+	profile_dir = session.config.profile_home / 'sample'
+	assert session.save('sample') == {'added': 0, 'changed': 0, 'unchanged': len(sample_files)}
+	assert not (profile_dir / '.bashrc').exists()
+	remove_files(home, sample_files)
+	assert not session.load('sample', overwrite_unsaved_configuration=True, restart=False)
+	assert_restored(home, sample_files, MODES)
@@ -0,0 +1,101 @@
+import importlib
+import json
+import subprocess
+import sys
+
+import pytest
+
+from konfsave import constants
+from konfsave import profiles
+
+# ``profiles.watch`` is the function, which hides the module
+watch_module = importlib.import_module('konfsave.profiles.watch')
+
+
+@pytest.fixture
+def watcher(make_session, sample_files):
+	"""
+	A session and a watcher of its default selection, which processes events only when
+	``flush()`` is called, instead of running ``watch()``.
+	"""
+	session = make_session()
+	watcher = session.run(watch_module._Watcher)
+	session.run(watcher.watch_roots)
+	session.run(watcher.write_journal)
+
+	def flush():
+		while events := watcher.inotify.read(0.1):
+			session.run(watcher.handle, events)
+		session.run(watcher.write_journal)
+	yield session, flush
+	watcher.close()
+
+
+def test_save_uses_journal(watcher, home, sample_files):
+	session, flush = watcher
+	assert session.save('sample')['added'] == len(sample_files)
+	assert session.save('sample') == {'added': 0, 'changed': 0, 'unchanged': 0}
+	(home / '.config/kwinrc').write_bytes(b'[Compositing]\nBackend=XRender\n')
+	(home / '.oh-my-zsh/custom').mkdir()
+	(home / '.oh-my-zsh/custom/aliases.zsh').write_bytes(b'alias k=konfsave\n')
+	(home / '.unselected').write_bytes(b'')
+	flush()
+	assert session.save('sample') == {'added': 1, 'changed': 1, 'unchanged': 0}
+	# Changes which were saved already are skipped
+	flush()
+	assert session.save('sample') == {'added': 0, 'changed': 0, 'unchanged': 0}
+	profile_dir = session.config.profile_home / 'sample'
+	assert (profile_dir / '.oh-my-zsh/custom/aliases.zsh').read_bytes() == b'alias k=konfsave\n'
+	assert (profile_dir / '.config/kwinrc').read_bytes() == b'[Compositing]\nBackend=XRender\n'
+
+
+def test_save_without_journal(watcher, home, sample_files):
+	session, flush = watcher
+	session.save('sample')
+	# Saving a custom selection or to another profile checks every file
+	assert session.save('sample', exclude=[':bash']) == {'added': 0, 'changed': 0, 'unchanged': len(sample_files) - 1}
+	assert session.save('other')['added'] == len(sample_files)
+	session.run(watch_module._journal_path).unlink()
+	assert session.save('sample')['unchanged'] == len(sample_files)
+
+
+def test_stale_journal(watcher, make_session, home):
+	session, flush = watcher
+	journal_path = session.run(watch_module._journal_path)
+	journal = json.loads(journal_path.read_text())
+	assert session.run(profiles.read_journal) == journal
+	# The watcher which wrote the journal has exited
+	process = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], stdout=subprocess.PIPE)
+	journal_path.write_text(json.dumps({**journal, 'pid': int(process.stdout)}))
+	assert session.run(profiles.read_journal) is None
+	journal_path.write_text('{')
+	assert session.run(profiles.read_journal) is None
+
+
+@pytest.mark.parametrize('changes, since, expected', [
+	({}, 100, {'.bashrc'}),
+	({}, 300, set()),
+	({}, None, None),
+	# The watcher was started after the last save
+	({'started_ns': 150}, 100, None),
+	({'incomplete': True}, 100, None),
+	({'overflow_ns': 150}, 100, None),
+	# Events that were dropped before the last save are irrelevant
+	({'overflow_ns': 50}, 100, {'.bashrc'}),
+	({'selection': {}}, 100, None),
+])
+def test_journaled_paths(make_session, changes, since, expected):
+	session = make_session()
+	journal = {
+		'started_ns': 10, 'updated_ns': 300, 'selection': session.run(watch_module._selection),
+		'overflow_ns': None, 'incomplete': False, 'paths': {'.bashrc': 200, '.zshrc': 50},
+		**changes
+	}
+	assert session.run(profiles.journaled_paths, journal, since) == expected
+
+
+def test_only_one_watcher(watcher):
+	session, flush = watcher
+	with pytest.raises(RuntimeError, match='Another watcher is already running'):
+		session.run(profiles.watch)
+	assert (constants.DATA_PATH / constants.JOURNAL_FILENAME).exists()